@@ -1,3 +1,4 @@
+import asyncio
 from dataclasses import dataclass, field
 from typing import TypedDict, Union, Literal, Generic, TypeVar
 
@@ -7,7 +8,14 @@ from .utils import EmbeddingFunc
 
 TextChunkSchema = TypedDict(
     "TextChunkSchema",
-    {"tokens": int, "content": str, "full_doc_id": str, "chunk_order_index": int},
+    {
+        "tokens": int,
+        "content": str,
+        "full_doc_id": str,
+        "chunk_order_index": int,
+        "start": int,
+        "end": int,
+    },
 )
 
 T = TypeVar("T")
@@ -36,6 +44,12 @@ class StorageNameSpace:
     namespace: str
     global_config: dict
 
+    # approximate bytes changed since the last commit; clean namespaces are skipped
+    dirty_bytes = 0
+
+    def mark_dirty(self, nbytes: int = 1):
+        self.dirty_bytes += max(nbytes, 1)
+
     async def index_done_callback(self):
         """commit the storage operations after indexing"""
         pass
@@ -50,15 +64,29 @@ class BaseVectorStorage(StorageNameSpace):
     embedding_func: EmbeddingFunc
     meta_fields: set = field(default_factory=set)
 
+    # bumped on every upsert or delete, so query results can be cached per generation
+    index_generation = 0
+
     async def query(self, query: str, top_k: int) -> list[dict]:
         raise NotImplementedError
 
+    async def query_batch(self, queries: list[str], top_k: int) -> list[list[dict]]:
+        """Results of query() for every query, in order"""
+        return list(await asyncio.gather(*[self.query(q, top_k) for q in queries]))
+
     async def upsert(self, data: dict[str, dict]):
         """Use 'content' field from value for embedding, use key as id.
         If embedding_func is None, use 'embedding' field from value
         """
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        raise NotImplementedError
+
+    async def all_items(self) -> list[dict]:
+        """id and meta fields of every stored vector"""
+        raise NotImplementedError
+
 
 @dataclass
 class BaseKVStorage(Generic[T], StorageNameSpace):
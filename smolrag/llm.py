@@ -1,48 +1,660 @@
+import asyncio
+import base64
 import os
-import torch
+import sys
 import copy
+import queue
+import threading
+import time
+import weakref
 import numpy as np
-from functools import lru_cache
-from openai import (
-    AsyncOpenAI,
-    APIConnectionError,
-    RateLimitError,
-    Timeout,
-    AsyncAzureOpenAI,
-)
+from collections import OrderedDict
+from dataclasses import dataclass
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, Union
 
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_exponential,
-    retry_if_exception_type,
+    retry_if_exception,
 )
-from transformers import AutoTokenizer, AutoModelForCausalLM
 
-from .utils import wrap_embedding_func_with_attrs, compute_args_hash
+from .utils import (
+    wrap_embedding_func_with_attrs,
+    compute_args_hash,
+    StopSequenceFilter,
+)
 from .base import BaseKVStorage
 
+# torch, transformers and openai take seconds to import, so each backend
+# imports them on first use
+
+
+def is_transient_openai_error(e: BaseException) -> bool:
+    if "openai" not in sys.modules:
+        return False
+    from openai import APIConnectionError, RateLimitError, Timeout
+
+    return isinstance(e, (RateLimitError, APIConnectionError, Timeout))
+
+
+# clients per running loop, as a connection pool cannot be used from another
+# loop; an entry goes away with its loop
+_openai_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_max_openai_clients_per_loop = 16
+_closing_openai_clients: set[asyncio.Task] = set()
+
+
+def get_openai_async_client(base_url: str = None, api_key: str = None):
+    """Shared keep-alive client per endpoint and key on the running loop.
+
+    The least recently used client is closed once a loop holds more than 16.
+    A missing api_key falls back to OPENAI_API_KEY.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _openai_clients.setdefault(loop, OrderedDict())
+    key = (base_url, api_key)
+    if key in clients:
+        clients.move_to_end(key)
+        return clients[key]
+    from openai import AsyncOpenAI
+
+    clients[key] = AsyncOpenAI(base_url=base_url, api_key=api_key)
+    if len(clients) > _max_openai_clients_per_loop:
+        _, evicted = clients.popitem(last=False)
+        task = loop.create_task(evicted.close())
+        _closing_openai_clients.add(task)
+        task.add_done_callback(_closing_openai_clients.discard)
+    return clients[key]
+
+
+async def close_openai_clients():
+    """Close the shared clients of the running loop, e.g. before it ends.
+
+    They are shared by everything on the loop, so SmolRAG.aclose() leaves
+    them open; call this once nothing on the loop uses them anymore.
+    """
+    clients = _openai_clients.pop(asyncio.get_running_loop(), {})
+    await asyncio.gather(*[client.close() for client in clients.values()])
+
+
+def _stop_list(stop) -> list[str]:
+    if isinstance(stop, str):
+        stop = [stop]
+    return [s for s in stop or [] if s]
+
+
+async def _once(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+async def _stream_text(
+    pieces: AsyncIterator[str],
+    stop: list[str] = None,
+    on_done: Callable[[str], Awaitable[None]] = None,
+) -> AsyncIterator[str]:
+    """Re-yields streamed text up to the first stop sequence; once it is
+    complete, ``on_done`` gets the whole text, e.g. to cache it"""
+    stop_filter = StopSequenceFilter(_stop_list(stop))
+    async with aclosing(pieces):
+        async for piece in pieces:
+            if text := stop_filter.feed(piece):
+                yield text
+            if stop_filter.stopped:
+                break
+    if text := stop_filter.flush():
+        yield text
+    if on_done is not None:
+        await on_done(stop_filter.result)
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=retry_if_exception(is_transient_openai_error),
+)
+async def openai_complete_if_cache(
+    model,
+    prompt,
+    system_prompt=None,
+    history_messages=[],
+    base_url=None,
+    api_key=None,
+    stream=False,
+    **kwargs,
+) -> Union[str, AsyncIterator[str]]:
+    openai_async_client = get_openai_async_client(base_url, api_key)
+    hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    kwargs.pop("global_config", None)
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend(history_messages)
+    messages.append({"role": "user", "content": prompt})
+
+    if hashing_kv is not None:
+        args_hash = compute_args_hash(model, messages)
+        if_cache_return = await hashing_kv.get_by_id(args_hash)
+        if if_cache_return is not None:
+            if stream:
+                return _stream_text(_once(if_cache_return["return"]))
+            return if_cache_return["return"]
+
+    if stream:
+        response = await openai_async_client.chat.completions.create(
+            model=model, messages=messages, stream=True, **kwargs
+        )
+
+        async def pieces():
+            try:
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await response.close()
+
+        on_done = None
+        if hashing_kv is not None:
+
+            async def on_done(content):
+                await hashing_kv.upsert(
+                    {args_hash: {"return": content, "model": model}}
+                )
+
+        # servers that ignore ``stop`` are cut client side
+        return _stream_text(pieces(), kwargs.get("stop"), on_done)
+
+    response = await openai_async_client.chat.completions.create(
+        model=model, messages=messages, **kwargs
+    )
+    content = response.choices[0].message.content
+
+    if hashing_kv is not None:
+        await hashing_kv.upsert({args_hash: {"return": content, "model": model}})
+    return content
+
+
+async def gpt_4o_mini_complete(
+    prompt, system_prompt=None, history_messages=[], **kwargs
+) -> str:
+    return await openai_complete_if_cache(
+        "gpt-4o-mini",
+        prompt,
+        system_prompt=system_prompt,
+        history_messages=history_messages,
+        **kwargs,
+    )
+
+
+def select_torch_device(device: str = None) -> str:
+    import torch
+
+    if device:
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def prepare_hf_model(hf_model, device=None, dtype=None, quantize=None):
+    """Casts or quantizes a loaded model and moves it to ``device``.
+
+    ``dtype`` is a torch dtype name such as "bfloat16". ``quantize="int8"``
+    replaces the Linear layers with dynamically quantized int8 ones, which
+    only run on cpu.
+    """
+    import torch
 
-@lru_cache(maxsize=1)
-def initialize_hf_model(model_name):
+    device = select_torch_device(device)
+    if quantize not in (None, "int8"):
+        raise ValueError(f"Unsupported quantization: {quantize}")
+    if quantize == "int8":
+        if device != "cpu":
+            raise ValueError("Dynamic int8 quantization only runs on cpu")
+        hf_model = torch.ao.quantization.quantize_dynamic(
+            hf_model.float(), {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif dtype:
+        hf_model = hf_model.to(getattr(torch, dtype))
+    # models dispatched with a device_map are already placed
+    if getattr(hf_model, "hf_device_map", None) is None:
+        hf_model = hf_model.to(device)
+    return hf_model.eval()
+
+
+def initialize_hf_model(
+    model_name, device=None, dtype=None, quantize=None, num_threads=None
+):
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    device = select_torch_device(device)
+    if num_threads:
+        torch.set_num_threads(num_threads)
     hf_tokenizer = AutoTokenizer.from_pretrained(
-        model_name, device_map="auto", trust_remote_code=True  # False
+        model_name, trust_remote_code=True  # False
     )
     hf_model = AutoModelForCausalLM.from_pretrained(
-        model_name, device_map="auto", trust_remote_code=True
+        model_name,
+        device_map="auto" if device == "cuda" else None,
+        # quantization needs float32 weights
+        torch_dtype=getattr(torch, dtype) if dtype and not quantize else None,
+        trust_remote_code=True,
     )
+    hf_model = prepare_hf_model(hf_model, device, dtype, quantize)
     if hf_tokenizer.pad_token is None:
         hf_tokenizer.pad_token = hf_tokenizer.eos_token
 
     return hf_model, hf_tokenizer
 
 
+def _resolve_future(future: asyncio.Future, result=None, exception=None):
+    def resolve():
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    try:
+        future.get_loop().call_soon_threadsafe(resolve)
+    except RuntimeError:
+        pass  # the caller's loop is closed, nobody is waiting
+
+
+def _common_prefix_len(a: list[int], b: list[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+@dataclass
+class _GenerationRequest:
+    prompt: str
+    future: asyncio.Future
+    stop: list[str]
+    # called from the worker thread with each newly decoded piece of text
+    on_text: Callable[[str], None] = None
+    sent: int = 0
+
+
+class HFGenerationScheduler:
+    """Batches concurrent generations on one HF model.
+
+    Prompts submitted from any event loop are queued for a worker thread, which
+    takes up to ``max_batch_size`` of them, waiting at most ``max_wait`` seconds
+    for the batch to fill, and generates them as one left-padded batch. Each
+    caller's future is resolved as soon as its own sequence reaches EOS or a
+    stop sequence; the batch runs until its last sequence is done. Prompts
+    arriving meanwhile form the next batch.
+    """
+
+    def __init__(
+        self,
+        hf_model,
+        hf_tokenizer,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        max_new_tokens: int = 500,
+        stop: Union[str, list[str]] = "<|COMPLETE|>",
+        min_prefix_tokens: int = 64,
+    ):
+        self.hf_model = hf_model
+        self.hf_tokenizer = hf_tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self.stop = _stop_list(stop)
+        # 0 disables prefix caching
+        self.min_prefix_tokens = min_prefix_tokens
+        # owned by the worker thread
+        self._prefix_ids: list[int] = []
+        self._prefix_cache = None
+        self._last_ids: list[int] = []
+        self._queue = queue.Queue()
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.batches = 0
+        self.sequences = 0
+        self.prefix_builds = 0
+        self.prefix_tokens_reused = 0
+
+    async def generate(self, prompt: str, stop=None) -> str:
+        """The generated text, cut after the first stop sequence"""
+        return await self._submit(prompt, stop)
+
+    async def stream(self, prompt: str, stop=None) -> AsyncIterator[str]:
+        """Yields the generated text as it is decoded. Generation ends at a
+        stop sequence, but the last piece may run past it."""
+        loop = asyncio.get_running_loop()
+        pieces = asyncio.Queue()
+
+        def on_text(text):
+            try:
+                loop.call_soon_threadsafe(pieces.put_nowait, text)
+            except RuntimeError:
+                pass
+
+        future = self._submit(prompt, stop, on_text)
+        # queued after every piece, since both go through call_soon_threadsafe
+        future.add_done_callback(lambda _: pieces.put_nowait(None))
+        try:
+            while (text := await pieces.get()) is not None:
+                yield text
+            future.result()
+        finally:
+            # a consumer that stops early frees its row in the batch
+            future.cancel()
+
+    def _submit(self, prompt: str, stop=None, on_text=None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("HFGenerationScheduler is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="hf-generate", daemon=True
+                )
+                self._thread.start()
+        stop = self.stop if stop is None else _stop_list(stop)
+        self._queue.put(_GenerationRequest(prompt, future, stop, on_text))
+        return future
+
+    def close(self, wait: bool = True):
+        """Stop the worker once the queued generations are done; new ones are
+        refused from now on"""
+        with self._lock:
+            self._closed = True
+            if self._thread is None:
+                self._release()
+            else:
+                self._queue.put(None)
+                if wait:
+                    self._thread.join()
+                self._thread = None
+
+    def _release(self):
+        # the model lives as long as its scheduler, see get_hf_scheduler
+        self.hf_model = None
+        self._prefix_cache = None
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        # callers that were cancelled while queued are dropped
+        return [request for request in batch if not request.future.done()]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                self._release()
+                return
+            if not batch:
+                continue
+            try:
+                self._generate(batch)
+            except Exception as e:
+                for request in batch:
+                    _resolve_future(request.future, exception=e)
+
+    def _send(self, request: _GenerationRequest, text: str, final=False):
+        # an incomplete multi-byte character decodes to U+FFFD, wait for the rest
+        if request.on_text is None or (not final and text.endswith("\ufffd")):
+            return
+        if len(text) > request.sent:
+            request.on_text(text[request.sent :])
+            request.sent = len(text)
+
+    def _finish(self, request: _GenerationRequest, token_ids):
+        text = self.hf_tokenizer.decode(token_ids, skip_special_tokens=True)
+        self._send(request, text, final=True)
+        found = [i + len(s) for s in request.stop if (i := text.find(s)) != -1]
+        _resolve_future(request.future, text[: min(found)] if found else text)
+
+    def _build_prefix(self, prefix_ids: list[int]):
+        import torch
+        from transformers import DynamicCache
+
+        input_ids = torch.tensor([prefix_ids], device=self.hf_model.device)
+        output = self.hf_model(
+            input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True
+        )
+        self._prefix_ids = prefix_ids
+        self._prefix_cache = output.past_key_values
+        self.prefix_builds += 1
+
+    def _shared_prefix(self, prompt_ids: list[list[int]]):
+        """How many leading tokens every prompt shares with the cached prefix,
+        and a copy of its past key values for the batch.
+
+        The prefix is learned rather than declared: it is what a prompt has in
+        common with the previous one, e.g. the chat template and the static
+        part of the system prompt. When prompts stop matching it (the template
+        or the system prompt changed) it is rebuilt the same way. A scheduler
+        serves a single model, so a model change starts from scratch.
+        """
+        if not self.min_prefix_tokens:
+            return 0, None
+        # at least one token per prompt must be left to run through the model
+        longest = min(len(ids) for ids in prompt_ids) - 1
+
+        def shared():
+            return min(
+                [longest]
+                + [_common_prefix_len(self._prefix_ids, i) for i in prompt_ids]
+            )
+
+        if shared() < self.min_prefix_tokens:
+            reference = prompt_ids[0]
+            learned = max(
+                _common_prefix_len(reference, other)
+                for other in prompt_ids[1:] + [self._last_ids]
+            )
+            if min(learned, longest) >= self.min_prefix_tokens:
+                self._build_prefix(reference[:learned])
+        self._last_ids = prompt_ids[-1]
+        length = shared()
+        if length < self.min_prefix_tokens:
+            return 0, None
+        cache = copy.deepcopy(self._prefix_cache)
+        if length < len(self._prefix_ids):
+            cache.crop(length - len(self._prefix_ids))
+        cache.batch_repeat_interleave(len(prompt_ids))
+        self.prefix_tokens_reused += length * len(prompt_ids)
+        return length, cache
+
+    def _generate(self, batch: list[_GenerationRequest]):
+        import torch
+
+        tokenizer = self.hf_tokenizer
+        tokenizer.padding_side = "left"
+        prompt_ids = tokenizer([request.prompt for request in batch], truncation=True)[
+            "input_ids"
+        ]
+        with torch.inference_mode():
+            prefix_len, past_key_values = self._shared_prefix(prompt_ids)
+        # the shared prefix goes first, padding sits between it and the rest
+        inputs = tokenizer.pad(
+            {"input_ids": [ids[prefix_len:] for ids in prompt_ids]},
+            return_tensors="pt",
+        )
+        if prefix_len:
+            prefix = torch.tensor([prompt_ids[0][:prefix_len]] * len(batch))
+            inputs["input_ids"] = torch.cat([prefix, inputs["input_ids"]], dim=1)
+            inputs["attention_mask"] = torch.cat(
+                [torch.ones_like(prefix), inputs["attention_mask"]], dim=1
+            )
+        inputs = inputs.to(self.hf_model.device)
+        prompt_len = inputs["input_ids"].shape[1]
+        eos_token_id = self.hf_model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        if not isinstance(eos_token_id, (list, tuple)):
+            eos_token_id = [eos_token_id]
+        eos_token_ids = set(eos_token_id) - {None}
+        # a stop sequence can span several tokens, only the tail is re-decoded
+        stop_windows = [
+            max((len(tokenizer.encode(s)) for s in request.stop), default=0) + 2
+            for request in batch
+        ]
+        finished = [False] * len(batch)
+
+        def resolve_finished(input_ids, scores, **kwargs):
+            for i, request in enumerate(batch):
+                if finished[i]:
+                    continue
+                new_ids = input_ids[i, prompt_len:]
+                if request.future.done():
+                    finished[i] = True
+                    continue
+                tail = None
+                if request.on_text is not None:
+                    tail = tokenizer.decode(new_ids, skip_special_tokens=True)
+                    self._send(request, tail)
+                if new_ids[-1].item() in eos_token_ids:
+                    finished[i] = True
+                elif request.stop:
+                    if tail is None:
+                        tail = tokenizer.decode(
+                            new_ids[-stop_windows[i] :], skip_special_tokens=True
+                        )
+                    finished[i] = any(s in tail for s in request.stop)
+                if finished[i]:
+                    self._finish(request, new_ids)
+            return torch.tensor(finished, device=input_ids.device)
+
+        with torch.inference_mode():
+            output = self.hf_model.generate(
+                **inputs,
+                past_key_values=past_key_values,
+                max_new_tokens=self.max_new_tokens,
+                num_return_sequences=1,
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=[resolve_finished],
+            )
+        self.batches += 1
+        self.sequences += len(batch)
+        for i, request in enumerate(batch):
+            if not finished[i]:
+                self._finish(request, output[i][prompt_len:])
+
+
+# schedulers by model and settings; each loads its own model and releases it
+# when closed, so the least recently used one is closed once there are more
+# than this
+_hf_schedulers: OrderedDict = OrderedDict()
+_max_hf_schedulers = 1
+_hf_schedulers_lock = threading.Lock()
+
+
+def get_hf_scheduler(
+    model_name,
+    max_batch_size=8,
+    max_wait=0.01,
+    device=None,
+    dtype=None,
+    quantize=None,
+    num_threads=None,
+    max_new_tokens=500,
+    min_prefix_tokens=64,
+):
+    key = (
+        model_name,
+        max_batch_size,
+        max_wait,
+        device,
+        dtype,
+        quantize,
+        num_threads,
+        max_new_tokens,
+        min_prefix_tokens,
+    )
+    with _hf_schedulers_lock:
+        if key in _hf_schedulers:
+            _hf_schedulers.move_to_end(key)
+            return _hf_schedulers[key]
+        hf_model, hf_tokenizer = initialize_hf_model(
+            model_name, device, dtype, quantize, num_threads
+        )
+        scheduler = _hf_schedulers[key] = HFGenerationScheduler(
+            hf_model,
+            hf_tokenizer,
+            max_batch_size=max_batch_size,
+            max_wait=max_wait,
+            max_new_tokens=max_new_tokens,
+            min_prefix_tokens=min_prefix_tokens,
+        )
+        evicted = []
+        while len(_hf_schedulers) > _max_hf_schedulers:
+            evicted.append(_hf_schedulers.popitem(last=False)[1])
+    # queued generations still finish, without blocking the caller's loop
+    for old in evicted:
+        old.close(wait=False)
+    return scheduler
+
+
+def close_hf_schedulers():
+    """Close every scheduler made by get_hf_scheduler"""
+    with _hf_schedulers_lock:
+        schedulers = list(_hf_schedulers.values())
+        _hf_schedulers.clear()
+    for scheduler in schedulers:
+        scheduler.close()
+
+
 async def hf_model_if_cache(
-    model, prompt, system_prompt=None, history_messages=[], **kwargs
-) -> str:
+    model,
+    prompt,
+    system_prompt=None,
+    history_messages=[],
+    max_batch_size=8,
+    max_wait=0.01,
+    device=None,
+    dtype=None,
+    quantize=None,
+    num_threads=None,
+    max_new_tokens=500,
+    min_prefix_tokens=64,
+    stream=False,
+    stop=None,
+    **kwargs,
+) -> Union[str, AsyncIterator[str]]:
     model_name = model
-    hf_model, hf_tokenizer = initialize_hf_model(model_name)
+    scheduler = get_hf_scheduler(
+        model_name,
+        max_batch_size,
+        max_wait,
+        device,
+        dtype,
+        quantize,
+        num_threads,
+        max_new_tokens,
+        min_prefix_tokens,
+    )
+    hf_tokenizer = scheduler.hf_tokenizer
+    stop = scheduler.stop if stop is None else _stop_list(stop)
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    kwargs.pop("global_config", None)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -53,6 +665,8 @@ async def hf_model_if_cache(
         args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
         if if_cache_return is not None:
+            if stream:
+                return _stream_text(_once(if_cache_return["return"]), stop)
             return if_cache_return["return"]
     input_prompt = ""
     try:
@@ -87,25 +701,18 @@ async def hf_model_if_cache(
                     + ">\n"
                 )
 
-    input_ids = hf_tokenizer(
-        input_prompt, return_tensors="pt", padding=True, truncation=True
-    ).to("cuda")
-    torch.cuda.empty_cache()
-    # inputs = {k: v.to(hf_model.device) for k, v in input_ids.items()}
-    output = hf_model.generate(
-        **input_ids, max_new_tokens=500, num_return_sequences=1, early_stopping=True
-    )
-    response_text = hf_tokenizer.decode(
-        output[0][len(input_ids[0]) :], skip_special_tokens=True
-    )
+    if stream:
+        on_done = None
+        if hashing_kv is not None:
+
+            async def on_done(response_text):
+                await hashing_kv.upsert(
+                    {args_hash: {"return": response_text, "model": model}}
+                )
 
-    FINDSTRING = "<|COMPLETE|>"
-    last_assistant_index = response_text.find(FINDSTRING)
+        return _stream_text(scheduler.stream(input_prompt, stop), stop, on_done)
 
-    if last_assistant_index != -1:
-        response_text = response_text[: last_assistant_index + len(FINDSTRING)]
-    else:
-        response_text = response_text
+    response_text = await scheduler.generate(input_prompt, stop)
 
     if hashing_kv is not None:
         await hashing_kv.upsert({args_hash: {"return": response_text, "model": model}})
@@ -116,21 +723,37 @@ async def hf_model_if_cache(
 async def hf_model_complete(
     prompt, system_prompt=None, history_messages=[], **kwargs
 ) -> str:
-    model_name = kwargs["hashing_kv"].global_config["llm_model_name"]
+    # SmolRAG passes its config; a hashing_kv carries it when called directly
+    global_config = kwargs.pop("global_config", None)
+    if global_config is None:
+        global_config = kwargs["hashing_kv"].global_config
     return await hf_model_if_cache(
-        model_name,
+        global_config["llm_model_name"],
         prompt,
         system_prompt=system_prompt,
         history_messages=history_messages,
+        max_batch_size=global_config["llm_model_max_batch_size"],
+        max_wait=global_config["llm_model_batch_wait"],
+        device=global_config["llm_model_device"],
+        dtype=global_config["llm_model_dtype"],
+        quantize=global_config["llm_model_quantize"],
+        num_threads=global_config["llm_model_num_threads"],
+        max_new_tokens=global_config["llm_model_max_new_tokens"],
+        min_prefix_tokens=global_config["llm_model_prefix_cache_tokens"],
         **kwargs,
     )
 
 
-@wrap_embedding_func_with_attrs(embedding_dim=1536, max_token_size=8192)
+@wrap_embedding_func_with_attrs(
+    embedding_dim=1536,
+    max_token_size=8192,
+    model_name="text-embedding-3-small",
+    max_batch_tokens=300000,
+)
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=60),
-    retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    retry=retry_if_exception(is_transient_openai_error),
 )
 async def openai_embedding(
     texts: list[str],
@@ -138,13 +761,12 @@ async def openai_embedding(
     base_url: str = None,
     api_key: str = None,
 ) -> np.ndarray:
-    if api_key:
-        os.environ["OPENAI_API_KEY"] = api_key
-
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = get_openai_async_client(base_url, api_key)
     response = await openai_async_client.embeddings.create(
-        model=model, input=texts, encoding_format="float"
+        model=model, input=texts, encoding_format="base64"
     )
-    return np.array([dp.embedding for dp in response.data])
+    if isinstance(response.data[0].embedding, str):
+        raw = b"".join(base64.b64decode(dp.embedding) for dp in response.data)
+        return np.frombuffer(raw, dtype=np.float32).reshape(len(response.data), -1)
+    # some OpenAI-compatible servers ignore encoding_format
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
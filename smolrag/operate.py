@@ -1,3 +1,11 @@
+import asyncio
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from typing import AsyncIterator
+import numpy as np
+
 from .utils import *
 from .base import (
     BaseKVStorage,
@@ -6,72 +14,491 @@ from .base import (
     QueryParam,
 )
 from .prompts import GRAPH_FIELD_SEP, PROMPTS
+from .storage import SemanticResponseCache
+from .llm import _once, _stream_text
 
 
 def chunking_by_token_size(
     content: str, overlap_token_size=128, max_token_size=1024, tiktoken_model="gpt-4o"
 ):
-    tokens = encode_string_by_tiktoken(content, model_name=tiktoken_model)
+    """Split content into windows of max_token_size tokens overlapping by
+    overlap_token_size. Token boundaries are computed once and each window is
+    sliced from content by character offset; start/end locate the (stripped)
+    chunk content in content."""
+    offsets = get_tokenizer(tiktoken_model).token_offsets(content)
     results = []
     for index, start in enumerate(
-        range(0, len(tokens), max_token_size - overlap_token_size)
+        range(0, len(offsets), max_token_size - overlap_token_size)
     ):
-        chunk_content = decode_tokens_by_tiktoken(
-            tokens[start : start + max_token_size], model_name=tiktoken_model
-        )
+        end = start + max_token_size
+        raw = content[offsets[start] : offsets[end] if end < len(offsets) else None]
+        chunk_content = raw.strip()
+        chunk_start = offsets[start] + len(raw) - len(raw.lstrip())
         results.append(
             {
-                "tokens": min(max_token_size, len(tokens) - start),
-                "content": chunk_content.strip(),
+                "tokens": min(max_token_size, len(offsets) - start),
+                "content": chunk_content,
                 "chunk_order_index": index,
+                "start": chunk_start,
+                "end": chunk_start + len(chunk_content),
             }
         )
     return results
 
 
-async def naive_query(
-    query,
+def _init_chunking_worker(tiktoken_model):
+    # build this worker's tokenizer once instead of on its first task
+    get_tokenizer(tiktoken_model)
+
+
+def _chunking_worker(
+    contents: list[str], overlap_token_size, max_token_size, tiktoken_model
+) -> list[list[dict]]:
+    return [
+        chunking_by_token_size(
+            content,
+            overlap_token_size=overlap_token_size,
+            max_token_size=max_token_size,
+            tiktoken_model=tiktoken_model,
+        )
+        for content in contents
+    ]
+
+
+def create_chunking_pool(max_workers: int, tiktoken_model="gpt-4o", mp_context=None):
+    """Process pool for chunking_by_token_size_parallel.
+
+    Workers start with forkserver (spawn where it is unavailable) rather than
+    forking a parent that may hold threads, and resolve their tokenizer from
+    tiktoken_model, so tokenizers added with register_tokenizer are not seen.
+    """
+    if mp_context is None:
+        mp_context = multiprocessing.get_context(
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp_context,
+        initializer=_init_chunking_worker,
+        initargs=(tiktoken_model,),
+    )
+
+
+async def chunking_by_token_size_parallel(
+    contents: list[str],
+    pool: ProcessPoolExecutor,
+    max_workers: int,
+    overlap_token_size=128,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o",
+) -> list[list[dict]]:
+    """chunking_by_token_size for every content on a process pool, in input order"""
+    loop = asyncio.get_running_loop()
+    # a few tasks per worker so one long document does not stall a whole share
+    n_tasks = min(len(contents), max_workers * 4)
+    bounds = [len(contents) * i // n_tasks for i in range(n_tasks + 1)]
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(
+                pool,
+                _chunking_worker,
+                contents[start:end],
+                overlap_token_size,
+                max_token_size,
+                tiktoken_model,
+            )
+            for start, end in zip(bounds, bounds[1:])
+        ]
+    )
+    return [chunks for group in results for chunks in group]
+
+
+async def _retrieve(
+    queries: list[str],
     chunks_vdb: BaseVectorStorage,
-    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    retrieval_cache: RetrievalCache = None,
+) -> list[list[dict]]:
+    """Vector search results for every query; cache hits skip the embedding
+    request and the search entirely"""
+    top_k = query_param.top_k
+
+    async def search(queries):
+        if len(queries) == 1:
+            return [await chunks_vdb.query(queries[0], top_k=top_k)]
+        return await chunks_vdb.query_batch(queries, top_k=top_k)
+
+    if retrieval_cache is None:
+        return await search(queries)
+    generation = chunks_vdb.index_generation
+    results_list = [retrieval_cache.get(q, top_k, generation) for q in queries]
+    missing = [i for i, results in enumerate(results_list) if results is None]
+    if missing:
+        searched = await search([queries[i] for i in missing])
+        for i, results in zip(missing, searched):
+            retrieval_cache.put(queries[i], top_k, generation, results)
+            results_list[i] = results
+    return results_list
+
+
+def _merge_overlapping_chunks(chunks: list[dict], scores: list[float]) -> list[dict]:
+    """Joins consecutive chunks of the same document whose start/end offsets
+    overlap into one unit, keeping the shared text once. A unit scores the sum
+    of its chunks and ranks as its best one."""
+    order = sorted(
+        range(len(chunks)),
+        key=lambda i: (
+            str(chunks[i].get("full_doc_id")),
+            chunks[i].get("chunk_order_index", 0),
+        ),
+    )
+    units = []
+    last = None
+    for rank in order:
+        chunk = chunks[rank]
+        if (
+            last is not None
+            and chunk.get("full_doc_id") is not None
+            and chunk.get("full_doc_id") == last["full_doc_id"]
+            and chunk.get("chunk_order_index") == last["chunk_order_index"] + 1
+            and chunk.get("start") is not None
+            and last["start"] is not None
+            and last["start"] <= chunk["start"] < last["end"]
+        ):
+            overlap = last["end"] - chunk["start"]
+            # token count of the overlap, pro rata: no tokenizer on this path
+            overlap_tokens = round(
+                chunk["tokens"] * overlap / max(len(chunk["content"]), 1)
+            )
+            last["content"] += chunk["content"][overlap:]
+            last["tokens"] += max(chunk["tokens"] - overlap_tokens, 0)
+            last["end"] = max(last["end"], chunk["end"])
+            last["chunk_order_index"] = chunk["chunk_order_index"]
+            last["score"] += scores[rank]
+            last["rank"] = min(last["rank"], rank)
+            continue
+        last = {
+            "content": chunk["content"],
+            "tokens": chunk["tokens"],
+            "full_doc_id": chunk.get("full_doc_id"),
+            "chunk_order_index": chunk.get("chunk_order_index", 0),
+            "start": chunk.get("start"),
+            "end": chunk.get("end"),
+            "score": scores[rank],
+            "rank": rank,
+        }
+        units.append(last)
+    return units
+
+
+def _knapsack(weights: list[int], values: list[float], capacity: int) -> list[int]:
+    """Indexes of the items with the largest total value whose weights fit in
+    capacity. Weights are rounded up to capacity / 1024 sized steps to bound
+    the table, which never overfills."""
+    step = max(1, -(-capacity // 1024))
+    slots = capacity // step
+    best = np.zeros(slots + 1)
+    taken = []
+    for weight, value in zip(weights, values):
+        weight = -(-weight // step)
+        take = np.zeros(slots + 1, dtype=bool)
+        if weight <= slots:
+            candidate = best[: slots + 1 - weight] + value
+            take[weight:] = candidate > best[weight:]
+            best[weight:] = np.where(take[weight:], candidate, best[weight:])
+        taken.append(take)
+    chosen = []
+    slot = slots
+    for i in reversed(range(len(weights))):
+        if taken[i][slot]:
+            chosen.append(i)
+            slot -= -(-weights[i] // step)
+    return chosen[::-1]
+
+
+def pack_chunks_by_token_size(
+    chunks: list[dict], scores: list[float], max_token_size: int
+) -> list[dict]:
+    """Packs retrieved chunks, most relevant first, into max_token_size tokens.
+
+    Overlapping neighbours are merged (see _merge_overlapping_chunks), then the
+    units with the largest total score that fit are kept. Token counts are the
+    ones stored with each chunk. Returns the units in relevance order.
+    """
+    if max_token_size <= 0 or not chunks:
+        return []
+    # vector similarity when the storage reports it, else the retrieval rank
+    scores = [
+        max(score, 1e-6) if score is not None else 1 / (rank + 1)
+        for rank, score in enumerate(scores)
+    ]
+    chunks = [
+        (
+            chunk
+            if "tokens" in chunk
+            else {**chunk, "tokens": len(encode_string_by_tiktoken(chunk["content"]))}
+        )
+        for chunk in chunks
+    ]
+    units = _merge_overlapping_chunks(chunks, scores)
+    if sum(u["tokens"] for u in units) > max_token_size:
+        chosen = _knapsack(
+            [u["tokens"] for u in units], [u["score"] for u in units], max_token_size
+        )
+        units = [units[i] for i in chosen]
+    return sorted(units, key=lambda u: u["rank"])
+
+
+def _build_naive_context(
+    results: list[dict], chunks: list[dict], query_param: QueryParam
+) -> str:
+    # a crash between the vector and chunk commits can leave a vector without
+    # its chunk
+    found = [(r, c) for r, c in zip(results, chunks) if c is not None]
+    units = pack_chunks_by_token_size(
+        [c for _, c in found],
+        [r.get("distance") for r, _ in found],
+        query_param.max_token_for_text_unit,
+    )
+    logger.info(
+        f"Packed {len(found)} chunks into {len(units)} units, "
+        f"{sum(u['tokens'] for u in units)} tokens"
+    )
+    return "--New Chunk--\n".join([u["content"] for u in units])
+
+
+def _answer_fingerprint(
+    chunks_ids: list[str], query_param: QueryParam, global_config: dict
+) -> str:
+    """What a cached answer depends on besides the question itself"""
+    return compute_mdhash_id(
+        json.dumps(
+            [
+                global_config["llm_model_name"],
+                query_param.response_type,
+                query_param.max_token_for_text_unit,
+                sorted(chunks_ids),
+            ]
+        )
+    )
+
+
+def _naive_system_prompt(section: str, query_param: QueryParam) -> str:
+    sys_prompt_temp = PROMPTS["naive_rag_response"]
+    return sys_prompt_temp.format(
+        content_data=section, response_type=query_param.response_type
+    )
+
+
+def _strip_leading_echo(
+    text: str, echoes: list[str], tags: list[str], final: bool
+) -> tuple[str, bool]:
+    """text without a prompt echo at its start, and whether the rest of the
+    answer can follow. Role tags only count once an echo was found."""
+    detected = False
+    while True:
+        text = text.lstrip()
+        candidates = echoes + tags if detected else echoes
+        echo = next((e for e in candidates if text.startswith(e)), None)
+        if echo is None:
+            break
+        text = text[len(echo) :]
+        detected = True
+    if final or not text:
+        return text, final
+    # wait until the text can no longer grow into an echo
+    if any(e.startswith(text) for e in candidates):
+        return text, False
+    return text, True
+
+
+async def _strip_echoes(
+    pieces: AsyncIterator[str], echoes: list[str], tags: list[str]
+) -> AsyncIterator[str]:
+    """Re-yields pieces without an echo of the prompt at the start and
+    without surrounding whitespace; the rest of the answer is untouched"""
+    echoes = [echo for echo in echoes if echo]
+    pending, started = "", False
+    async with aclosing(pieces):
+        async for piece in pieces:
+            pending += piece
+            if not started:
+                text, started = _strip_leading_echo(pending, echoes, tags, False)
+                if not started:
+                    continue
+                pending = text
+            # trailing whitespace is held back, the answer is stripped
+            end = len(pending.rstrip())
+            text, pending = pending[:end], pending[end:]
+            if text:
+                yield text
+    if not started:
+        pending, _ = _strip_leading_echo(pending, echoes, tags, True)
+    if text := pending.strip():
+        yield text
+
+
+def _naive_answer_pieces(pieces, query, sys_prompt, global_config):
+    """The answer cut at the first of ``llm_stop_sequences``, without a prompt
+    echoed at its start; streamed or not, it comes out the same"""
+    pieces = _stream_text(pieces, global_config["llm_stop_sequences"])
+    echoes = [sys_prompt, "<system>", query]
+    tags = ["</system>", "user", "model"]
+    return _strip_echoes(pieces, echoes, tags)
+
+
+async def _naive_answer(
+    query,
+    section: str,
     query_param: QueryParam,
     global_config: dict,
+    chunks_ids: list[str] = None,
+    response_cache: SemanticResponseCache = None,
 ):
+    if response_cache is not None:
+        fingerprint = _answer_fingerprint(chunks_ids, query_param, global_config)
+        response = await response_cache.get(query, fingerprint)
+        if response is not None:
+            return response
+
     use_model_func = global_config["llm_model_func"]
-    results = await chunks_vdb.query(query, top_k=query_param.top_k)
+    sys_prompt = _naive_system_prompt(section, query_param)
+    response = await use_model_func(
+        query,
+        system_prompt=sys_prompt,
+        stop=global_config["llm_stop_sequences"],
+    )
+    pieces = _naive_answer_pieces(_once(response), query, sys_prompt, global_config)
+    response = "".join([piece async for piece in pieces])
+
+    if response_cache is not None:
+        await response_cache.put(query, fingerprint, response)
+    return response
+
+
+async def _naive_retrieve(
+    query,
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    retrieval_cache: RetrievalCache = None,
+):
+    """The context section and the retrieved chunk ids, None if nothing matched"""
+    results = (await _retrieve([query], chunks_vdb, query_param, retrieval_cache))[0]
     if not len(results):
-        return PROMPTS["fail_response"]
+        return None
     chunks_ids = [r["id"] for r in results]
-
     chunks = await text_chunks_db.get_by_ids(chunks_ids)
+    return _build_naive_context(results, chunks, query_param), chunks_ids
 
-    maybe_trun_chunks = truncate_list_by_token_size(
-        chunks,
-        key=lambda x: x["content"],
-        max_token_size=query_param.max_token_for_text_unit,
+
+async def naive_query(
+    query,
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+    response_cache: SemanticResponseCache = None,
+    retrieval_cache: RetrievalCache = None,
+):
+    retrieved = await _naive_retrieve(
+        query, chunks_vdb, text_chunks_db, query_param, retrieval_cache
     )
-    logger.info(f"Truncate {len(chunks)} to {len(maybe_trun_chunks)} chunks")
-    section = "--New Chunk--\n".join([c["content"] for c in maybe_trun_chunks])
+    if retrieved is None:
+        return PROMPTS["fail_response"]
+    section, chunks_ids = retrieved
     if query_param.only_need_context:
         return section
-    sys_prompt_temp = PROMPTS["naive_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        content_data=section, response_type=query_param.response_type
+    return await _naive_answer(
+        query, section, query_param, global_config, chunks_ids, response_cache
     )
-    response = await use_model_func(
+
+
+async def naive_query_stream(
+    query,
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+    response_cache: SemanticResponseCache = None,
+    retrieval_cache: RetrievalCache = None,
+) -> AsyncIterator[str]:
+    """naive_query yielding the answer as the model generates it"""
+    retrieved = await _naive_retrieve(
+        query, chunks_vdb, text_chunks_db, query_param, retrieval_cache
+    )
+    if retrieved is None:
+        yield PROMPTS["fail_response"]
+        return
+    section, chunks_ids = retrieved
+    if query_param.only_need_context:
+        yield section
+        return
+    if response_cache is not None:
+        fingerprint = _answer_fingerprint(chunks_ids, query_param, global_config)
+        response = await response_cache.get(query, fingerprint)
+        if response is not None:
+            yield response
+            return
+
+    use_model_func = global_config["llm_model_func"]
+    sys_prompt = _naive_system_prompt(section, query_param)
+    pieces = await use_model_func(
         query,
         system_prompt=sys_prompt,
+        stream=True,
+        stop=global_config["llm_stop_sequences"],
     )
+    # a custom llm_model_func may ignore stop, so the stream is cut here too
+    pieces = _naive_answer_pieces(pieces, query, sys_prompt, global_config)
+    response = ""
+    async with aclosing(pieces):
+        async for piece in pieces:
+            response += piece
+            yield piece
+
+    if response_cache is not None:
+        await response_cache.put(query, fingerprint, response)
 
-    if len(response) > len(sys_prompt):
-        response = (
-            response[len(sys_prompt) :]
-            .replace(sys_prompt, "")
-            .replace("user", "")
-            .replace("model", "")
-            .replace(query, "")
-            .replace("<system>", "")
-            .replace("</system>", "")
-            .strip()
+
+async def naive_query_batch(
+    queries: list[str],
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+    response_cache: SemanticResponseCache = None,
+    retrieval_cache: RetrievalCache = None,
+) -> list[str]:
+    """naive_query for many questions: one embedding request and vector search
+    for all of them, one chunk fetch, then concurrent LLM calls"""
+    results_list = await _retrieve(queries, chunks_vdb, query_param, retrieval_cache)
+    chunks_ids = list(
+        dict.fromkeys(r["id"] for results in results_list for r in results)
+    )
+    chunks_by_id = dict(zip(chunks_ids, await text_chunks_db.get_by_ids(chunks_ids)))
+
+    async def _answer(query, results):
+        if not len(results):
+            return PROMPTS["fail_response"]
+        section = _build_naive_context(
+            results, [chunks_by_id[r["id"]] for r in results], query_param
+        )
+        if query_param.only_need_context:
+            return section
+        return await _naive_answer(
+            query,
+            section,
+            query_param,
+            global_config,
+            [r["id"] for r in results],
+            response_cache,
         )
 
-    return response
+    return list(
+        await asyncio.gather(
+            *[_answer(query, results) for query, results in zip(queries, results_list)]
+        )
+    )
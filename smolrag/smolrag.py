@@ -1,18 +1,38 @@
 import os
+import json
+import atexit
+import weakref
 import asyncio
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
-from typing import Type, cast
+from functools import partial, wraps
+from contextlib import aclosing
+from typing import AsyncIterator, Type
 from .utils import (
     EmbeddingFunc,
+    CachedEmbeddingFunc,
     logger,
     set_logger,
     limit_async_func_call,
+    SingleFlight,
+    blocking_calls_inline,
+    RetrievalCache,
+    normalize_query,
+    count_embedding_tokens,
+    count_llm_tokens,
+    compute_args_hash,
     compute_mdhash_id,
 )
 from .llm import *
 
-from .operate import chunking_by_token_size, naive_query
+from .operate import (
+    chunking_by_token_size,
+    chunking_by_token_size_parallel,
+    create_chunking_pool,
+    naive_query,
+    naive_query_batch,
+    naive_query_stream,
+)
 from .base import (
     BaseKVStorage,
     BaseVectorStorage,
@@ -21,8 +41,17 @@ from .base import (
 )
 
 from .storage import (
+    embed_in_batches,
     JsonKVStorage,
+    LogKVStorage,
+    SqliteKVStorage,
     NanoVectorDBStorage,
+    MemmapVectorDBStorage,
+    IVFVectorDBStorage,
+    QuantizedVectorDBStorage,
+    SemanticResponseCache,
+    TieredResponseCache,
+    StorageFlusher,
 )
 
 
@@ -38,6 +67,37 @@ def always_get_an_event_loop() -> asyncio.AbstractEventLoop:
         return loop
 
 
+def _close_at_exit(ref: weakref.ref):
+    rag = ref()
+    if rag is not None:
+        with blocking_calls_inline():
+            rag.close()
+
+
+# vectors before chunks before docs: a crash in between leaves a doc that is
+# re-chunked and deduped on the next run, never a chunk without its vector
+NAMESPACE_COMMIT_ORDER = [
+    "chunks_vdb",
+    "text_chunks",
+    "full_docs",
+    "entities_vdb",
+    "entity_name_vdb",
+    "relationships_vdb",
+    "llm_response_cache",
+    "semantic_llm_cache",
+]
+INGEST_ONLY_NAMESPACES = {
+    "full_docs",
+    "entities_vdb",
+    "entity_name_vdb",
+    "relationships_vdb",
+}
+
+
+def _namespace(name: str) -> property:
+    return property(lambda self: self._open_namespace(name))
+
+
 @dataclass
 class SmolRAG:
     working_dir: str = field(
@@ -49,7 +109,21 @@ class SmolRAG:
 
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
     embedding_batch_num: int = 32
+    # total tokens allowed in one embedding request, overriding the
+    # max_batch_tokens of embedding_func (the server-side limit)
+    embedding_batch_max_tokens: int = None
     embedding_func_max_async: int = 16
+    # provider rate limits, None disables the budget
+    embedding_func_rpm: int = None
+    embedding_func_tpm: int = None
+    enable_embedding_cache: bool = True
+    embedding_cache_max_items: int = 10000
+    # defaults to working_dir; point several working dirs at one cache to share it
+    embedding_cache_dir: str = None
+
+    # streaming insert
+    insert_stream_queue_size: int = 8
+    insert_checkpoint_chunks: int = 512
 
     current_log_level = logger.level
     log_level: str = field(default=current_log_level)
@@ -58,17 +132,58 @@ class SmolRAG:
     chunk_token_size: int = 1200
     chunk_overlap_token_size: int = 100
     tiktoken_model_name: str = "gpt-4o-mini"
+    # batches with at least this many docs are chunked on a process pool
+    chunk_parallel_min_docs: int = 16
+    chunk_parallel_max_workers: int = field(default_factory=lambda: os.cpu_count() or 1)
 
     # LLM
     llm_model_func: callable = hf_model_complete#gpt_4o_mini_complete  # 
     llm_model_name: str = "/data/share/LLM_Model/Qwen2.5-7B-Instruct" 
     llm_model_max_token_size: int = 32768
     llm_model_max_async: int = 16
+    # local HF models: concurrent calls are generated together in batches
+    llm_model_max_batch_size: int = 8
+    llm_model_batch_wait: float = 0.01
+    llm_model_max_new_tokens: int = 500
+    # reuse the KV cache of a prompt prefix shared by consecutive requests
+    # (chat template and static system prompt) when it is at least this many
+    # tokens; 0 disables
+    llm_model_prefix_cache_tokens: int = 64
+    # streamed answers end at the first of these
+    llm_stop_sequences: list[str] = field(default_factory=lambda: ["<|COMPLETE|>"])
+    # None picks cuda, then mps, then cpu
+    llm_model_device: str = None
+    # torch dtype name, e.g. "bfloat16"; None loads float32
+    llm_model_dtype: str = None
+    # "int8": dynamically quantized Linear layers, cpu only
+    llm_model_quantize: str = None
+    # torch intra-op threads; None keeps torch's default (one per core)
+    llm_model_num_threads: int = None
+    llm_model_rpm: int = None
+    llm_model_tpm: int = None
     llm_model_kwargs: dict = field(default_factory=dict)
 
     # storage
+    kv_storage_cls_kwargs: dict = field(default_factory=dict)
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
     enable_llm_cache: bool = True
+    llm_cache_memory_bytes: int = 64 * 1024 * 1024
+    llm_cache_disk_bytes: int = 1024 * 1024 * 1024
+    llm_cache_ttl: float = None  # seconds
+    # answers to near-duplicate questions over the same retrieved chunks
+    enable_semantic_llm_cache: bool = False
+    semantic_llm_cache_threshold: float = 0.95
+    semantic_llm_cache_max_entries: int = 10000
+    semantic_llm_cache_ttl: float = None  # seconds
+    # vector search results per query, dropped whenever the chunk index changes
+    enable_retrieval_cache: bool = True
+    retrieval_cache_max_items: int = 4096
+    # storage commits are coalesced: dirty namespaces are written flush_interval
+    # seconds after a change, or at once past flush_dirty_bytes (0 = every call)
+    flush_interval: float = 5.0
+    flush_dirty_bytes: int = 64 * 1024 * 1024
+    # serve queries only: ingest-only namespaces are never opened and inserts fail
+    query_only: bool = False
 
     def __post_init__(self):
         set_logger(os.path.join(self.working_dir, "smolrag.log"))
@@ -79,6 +194,14 @@ class SmolRAG:
         _print_config = ",\n  ".join([f"{k} = {v}" for k, v in asdict(self).items()])
         logger.debug(f"SmolRAG init with param:\n  {_print_config}\n")
 
+        self._chunking_pool = None
+        self._query_flights = SingleFlight()
+        self.retrieval_cache = (
+            RetrievalCache(self.retrieval_cache_max_items)
+            if self.enable_retrieval_cache
+            else None
+        )
+
         self.key_string_value_json_storage_cls: Type[BaseKVStorage] = (
             self._get_storage_class()[self.kv_storage]
         )
@@ -90,75 +213,282 @@ class SmolRAG:
             logger.info(f"Creating working directory {self.working_dir}")
             os.makedirs(self.working_dir)
 
-        self.llm_response_cache = (
-            self.key_string_value_json_storage_cls(
-                namespace="llm_response_cache",
-                global_config=asdict(self),
-                embedding_func=None,
+        limited_embedding_func = limit_async_func_call(
+            self.embedding_func_max_async,
+            requests_per_minute=self.embedding_func_rpm,
+            tokens_per_minute=self.embedding_func_tpm,
+            token_counter=partial(
+                count_embedding_tokens, model_name=self.tiktoken_model_name
+            ),
+        )(self.embedding_func)
+        self.embedding_limiter = limited_embedding_func.limiter
+        # identical concurrent requests share one call, cached or not
+        self._embedding_flights = SingleFlight()
+        limited_embedding_func = self._with_embedding_flights(limited_embedding_func)
+        use_embedding_cache = self.enable_embedding_cache
+        if use_embedding_cache and not getattr(self.embedding_func, "model_name", ""):
+            logger.warning(
+                "Embedding cache disabled: set model_name on embedding_func to "
+                "identify its vectors"
             )
-            if self.enable_llm_cache
-            else None
-        )
-
-        self.embedding_func = limit_async_func_call(self.embedding_func_max_async)(
-            self.embedding_func
-        )
-
-        ####
-        # add embedding func
-        ####
-        self.full_docs = self.key_string_value_json_storage_cls(
-            namespace="full_docs",
-            global_config=asdict(self),
-            embedding_func=self.embedding_func,
-        )
-        self.text_chunks = self.key_string_value_json_storage_cls(
-            namespace="text_chunks",
-            global_config=asdict(self),
-            embedding_func=self.embedding_func,
+            use_embedding_cache = False
+        if use_embedding_cache:
+            # hits are answered before taking a concurrency slot
+            self.embedding_func = CachedEmbeddingFunc(
+                embedding_dim=self.embedding_func.embedding_dim,
+                max_token_size=self.embedding_func.max_token_size,
+                func=limited_embedding_func,
+                model_name=self.embedding_func.model_name,
+                max_batch_tokens=getattr(self.embedding_func, "max_batch_tokens", None),
+                cache_dir=self.embedding_cache_dir or self.working_dir,
+                max_memory_items=self.embedding_cache_max_items,
+            )
+        else:
+            self.embedding_func = limited_embedding_func
+        limited_llm_model_func = limit_async_func_call(
+            self.llm_model_max_async,
+            requests_per_minute=self.llm_model_rpm,
+            tokens_per_minute=self.llm_model_tpm,
+            token_counter=partial(
+                count_llm_tokens, model_name=self.tiktoken_model_name
+            ),
+        )(self._with_llm_config(self.llm_model_func))
+        self.llm_limiter = limited_llm_model_func.limiter
+        # like embeddings, cache hits are answered before taking a slot
+        self.llm_model_func = self._with_llm_cache(limited_llm_model_func)
+
+        # namespaces are opened on first access, see _open_namespace
+        self._namespaces = {}
+        self._flusher = StorageFlusher(
+            self._opened_storages,
+            interval=self.flush_interval,
+            max_dirty_bytes=self.flush_dirty_bytes,
         )
+        if self.query_only:
+            # a query-only server loads what every query reads before the first one
+            for name in ("chunks_vdb", "text_chunks"):
+                self._open_namespace(name)
+        self._closed = False
+        # a weak reference, so an instance dropped without close() can be freed
+        atexit.register(_close_at_exit, weakref.ref(self))
+
+    def _with_embedding_flights(self, func):
+        @wraps(func)
+        async def embedding_func(texts, *args, **kwargs):
+            key = compute_args_hash(texts, args, sorted(kwargs.items()))
+            return await self._embedding_flights.do(key, func, texts, *args, **kwargs)
+
+        return embedding_func
+
+    def _with_llm_config(self, func):
+        @wraps(func)
+        async def llm_model_func(*args, **kwargs):
+            kwargs = {
+                "global_config": asdict(self),
+                **self.llm_model_kwargs,
+                **kwargs,
+            }
+            return await func(*args, **kwargs)
+
+        return llm_model_func
+
+    def _with_llm_cache(self, func):
+        @wraps(func)
+        async def llm_model_func(
+            prompt, system_prompt=None, history_messages=[], **kwargs
+        ):
+            # resolved per call, so the cache is only opened once an LLM is used
+            cache = self.llm_response_cache
+            if cache is None:
+                return await func(
+                    prompt,
+                    system_prompt=system_prompt,
+                    history_messages=history_messages,
+                    **kwargs,
+                )
+            stream = kwargs.get("stream", False)
+            args_hash = compute_args_hash(
+                func.__name__,
+                self.llm_model_name,
+                self.llm_model_kwargs,
+                system_prompt,
+                history_messages,
+                prompt,
+                sorted((k, v) for k, v in kwargs.items() if k != "stream"),
+            )
+            cached = await cache.get_by_id(args_hash)
+            if cached is not None:
+                if not stream:
+                    return cached["return"]
+
+                async def replay():
+                    yield cached["return"]
+
+                return replay()
+
+            async def store(response):
+                await cache.upsert(
+                    {args_hash: {"return": response, "model": self.llm_model_name}}
+                )
+
+            response = await func(
+                prompt,
+                system_prompt=system_prompt,
+                history_messages=history_messages,
+                **kwargs,
+            )
+            if not stream:
+                await store(response)
+                return response
+
+            async def record(pieces):
+                response = ""
+                async with aclosing(pieces):
+                    async for piece in pieces:
+                        response += piece
+                        yield piece
+                # only a complete answer is cached
+                await store(response)
+
+            return record(response)
+
+        return llm_model_func
+
+    def _create_namespace(self, name: str):
+        global_config = asdict(self)
+
+        def kv(namespace):
+            return self.key_string_value_json_storage_cls(
+                namespace=namespace,
+                global_config=global_config,
+                embedding_func=self.embedding_func,
+            )
 
-        self.entities_vdb = self.vector_db_storage_cls(
-            namespace="entities",
-            global_config=asdict(self),
-            embedding_func=self.embedding_func,
-            meta_fields={"entity_name"},
-        )
+        def vdb(namespace, meta_fields=set()):
+            return self.vector_db_storage_cls(
+                namespace=namespace,
+                global_config=global_config,
+                embedding_func=self.embedding_func,
+                meta_fields=meta_fields,
+            )
 
-        self.entity_name_vdb = self.vector_db_storage_cls(
-            namespace="entities_name",
-            global_config=asdict(self),
-            embedding_func=self.embedding_func,
-            meta_fields={"entity_name"},
-        )
+        if name in ("full_docs", "text_chunks"):
+            return kv(name)
+        if name == "entities_vdb":
+            return vdb("entities", {"entity_name"})
+        if name == "entity_name_vdb":
+            return vdb("entities_name", {"entity_name"})
+        if name == "relationships_vdb":
+            return vdb("relationships", {"src_id", "tgt_id"})
+        if name == "chunks_vdb":
+            return vdb("chunks")
+        if name == "llm_response_cache":
+            if not self.enable_llm_cache:
+                return None
+            return TieredResponseCache(
+                namespace="llm_response_cache",
+                global_config=global_config,
+                embedding_func=None,
+            )
+        if name == "semantic_llm_cache":
+            if not self.enable_semantic_llm_cache:
+                return None
+            return SemanticResponseCache(
+                vdb("llm_semantic_cache", {"fingerprint", "response", "created"}),
+                similarity_threshold=self.semantic_llm_cache_threshold,
+                max_entries=self.semantic_llm_cache_max_entries,
+                ttl=self.semantic_llm_cache_ttl,
+            )
+        raise KeyError(name)
+
+    def _open_namespace(self, name: str):
+        if name not in self._namespaces:
+            if self.query_only and name in INGEST_ONLY_NAMESPACES:
+                raise RuntimeError(f"{name} is not available with query_only=True")
+            self._namespaces[name] = self._create_namespace(name)
+        return self._namespaces[name]
+
+    def _check_writable(self):
+        if self.query_only:
+            raise RuntimeError(
+                "Cannot insert into a SmolRAG created with query_only=True"
+            )
 
-        self.relationships_vdb = self.vector_db_storage_cls(
-            namespace="relationships",
-            global_config=asdict(self),
-            embedding_func=self.embedding_func,
-            meta_fields={"src_id", "tgt_id"},
-        )
-        self.chunks_vdb = self.vector_db_storage_cls(
-            namespace="chunks",
-            global_config=asdict(self),
-            embedding_func=self.embedding_func,
-        )
+    def _opened_storages(self) -> list[StorageNameSpace]:
+        storages = []
+        for name in NAMESPACE_COMMIT_ORDER:
+            storage = self._namespaces.get(name)
+            if isinstance(storage, SemanticResponseCache):
+                storage = storage.vdb
+            if storage is not None:
+                storages.append(storage)
+        return storages
+
+    full_docs = _namespace("full_docs")
+    text_chunks = _namespace("text_chunks")
+    entities_vdb = _namespace("entities_vdb")
+    entity_name_vdb = _namespace("entity_name_vdb")
+    relationships_vdb = _namespace("relationships_vdb")
+    chunks_vdb = _namespace("chunks_vdb")
+    llm_response_cache = _namespace("llm_response_cache")
+    semantic_llm_cache = _namespace("semantic_llm_cache")
+
+    def _run(self, coro):
+        loop = always_get_an_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            # leave no commit timer or task behind on a loop that stops here
+            loop.run_until_complete(self._flusher.detach())
+
+    def flush(self):
+        return self._run(self.aflush())
+
+    async def aflush(self):
+        """Commit every namespace with pending changes"""
+        await self._flusher.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        return self._run(self.aclose())
+
+    async def aclose(self):
+        """Flush pending changes and release background resources"""
+        if self._closed:
+            return
+        self._closed = True
+        await self._flusher.close()
+        if self._chunking_pool is not None:
+            self._chunking_pool.shutdown()
+            self._chunking_pool = None
+
+    def limiter_stats(self) -> dict:
+        return {
+            "embedding": self.embedding_limiter.stats(),
+            "llm": self.llm_limiter.stats(),
+        }
 
     def _get_storage_class(self) -> Type[StorageNameSpace]:
         return {
             # kv storage
             "JsonKVStorage": JsonKVStorage,
+            "LogKVStorage": LogKVStorage,
+            "SqliteKVStorage": SqliteKVStorage,
             # vector storage
             "NanoVectorDBStorage": NanoVectorDBStorage,
+            "MemmapVectorDBStorage": MemmapVectorDBStorage,
+            "IVFVectorDBStorage": IVFVectorDBStorage,
+            "QuantizedVectorDBStorage": QuantizedVectorDBStorage,
             # @TODO graph storage
             # @TODO "ArangoDBStorage": ArangoDBStorage
         }
 
     def insert(self, string_or_strings):
-        loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.ainsert(string_or_strings))
+        return self._run(self.ainsert(string_or_strings))
 
     async def ainsert(self, string_or_strings):
+        self._check_writable()
         update_storage = False
         try:
             if isinstance(string_or_strings, str):
@@ -176,21 +506,7 @@ class SmolRAG:
             update_storage = True
             logger.info(f"[New Docs] inserting {len(new_docs)} docs")
 
-            inserting_chunks = {}
-            for doc_key, doc in new_docs.items():
-                chunks = {
-                    compute_mdhash_id(dp["content"], prefix="chunk-"): {
-                        **dp,
-                        "full_doc_id": doc_key,
-                    }
-                    for dp in chunking_by_token_size(
-                        doc["content"],
-                        overlap_token_size=self.chunk_overlap_token_size,
-                        max_token_size=self.chunk_token_size,
-                        tiktoken_model=self.tiktoken_model_name,
-                    )
-                }
-                inserting_chunks.update(chunks)
+            inserting_chunks = await self._chunk_docs(new_docs)
             _add_chunk_keys = await self.text_chunks.filter_keys(
                 list(inserting_chunks.keys())
             )
@@ -224,28 +540,183 @@ class SmolRAG:
             if update_storage:
                 await self._insert_done()
 
+    async def _chunk_docs(self, docs: dict[str, dict]) -> dict[str, dict]:
+        contents = [doc["content"] for doc in docs.values()]
+        if (
+            len(docs) >= self.chunk_parallel_min_docs
+            and self.chunk_parallel_max_workers > 1
+        ):
+            if self._chunking_pool is None:
+                self._chunking_pool = create_chunking_pool(
+                    self.chunk_parallel_max_workers, self.tiktoken_model_name
+                )
+            chunks_list = await chunking_by_token_size_parallel(
+                contents,
+                self._chunking_pool,
+                self.chunk_parallel_max_workers,
+                overlap_token_size=self.chunk_overlap_token_size,
+                max_token_size=self.chunk_token_size,
+                tiktoken_model=self.tiktoken_model_name,
+            )
+        else:
+            chunks_list = [
+                chunking_by_token_size(
+                    content,
+                    overlap_token_size=self.chunk_overlap_token_size,
+                    max_token_size=self.chunk_token_size,
+                    tiktoken_model=self.tiktoken_model_name,
+                )
+                for content in contents
+            ]
+        inserting_chunks = {}
+        for doc_key, chunks in zip(docs.keys(), chunks_list):
+            inserting_chunks.update(
+                {
+                    compute_mdhash_id(dp["content"], prefix="chunk-"): {
+                        **dp,
+                        "full_doc_id": doc_key,
+                    }
+                    for dp in chunks
+                }
+            )
+        return inserting_chunks
+
+    def insert_stream(self, docs):
+        return self._run(self.ainsert_stream(docs))
+
+    async def ainsert_stream(self, docs) -> int:
+        """Insert an (async) iterable of documents with bounded memory.
+
+        Chunking, dedupe, embedding and upsert run as concurrent stages joined by
+        queues of ``insert_stream_queue_size`` docs, so a slow stage applies
+        backpressure to the ones before it. Storages are committed every
+        ``insert_checkpoint_chunks`` chunks. A doc is only written to ``full_docs``
+        together with its chunks, so after a crash re-running the same stream
+        skips what was committed and re-embeds the rest.
+
+        Returns the number of inserted chunks.
+        """
+        self._check_writable()
+        chunk_queue = asyncio.Queue(self.insert_stream_queue_size)
+        dedupe_queue = asyncio.Queue(self.insert_stream_queue_size)
+        upsert_queue = asyncio.Queue(self.insert_stream_queue_size)
+        in_flight_docs, in_flight_chunks = set(), set()
+        inserted = {"chunks": 0, "since_checkpoint": 0}
+
+        async def iterate_docs():
+            if hasattr(docs, "__aiter__"):
+                async for doc in docs:
+                    yield doc
+            else:
+                for doc in docs:
+                    yield doc
+
+        async def chunk_stage():
+            async for content in iterate_docs():
+                doc = {"content": content.strip()}
+                doc_key = compute_mdhash_id(doc["content"], prefix="doc-")
+                if doc_key in in_flight_docs or not await self.full_docs.filter_keys(
+                    [doc_key]
+                ):
+                    continue
+                in_flight_docs.add(doc_key)
+                chunks = await self._chunk_docs({doc_key: doc})
+                await chunk_queue.put((doc_key, doc, chunks))
+            await chunk_queue.put(None)
+
+        async def dedupe_stage():
+            while (item := await chunk_queue.get()) is not None:
+                doc_key, doc, chunks = item
+                new_keys = await self.text_chunks.filter_keys(list(chunks.keys()))
+                chunks = {
+                    k: v
+                    for k, v in chunks.items()
+                    if k in new_keys and k not in in_flight_chunks
+                }
+                in_flight_chunks.update(chunks.keys())
+                await dedupe_queue.put((doc_key, doc, chunks))
+            await dedupe_queue.put(None)
+
+        async def embedding_stage():
+            done = False
+            while not done:
+                items = [await dedupe_queue.get()]
+                # pack small docs together up to one embedding batch
+                while (
+                    items[-1] is not None
+                    and sum(len(item[2]) for item in items) < self.embedding_batch_num
+                    and not dedupe_queue.empty()
+                ):
+                    items.append(dedupe_queue.get_nowait())
+                if items[-1] is None:
+                    done = True
+                    items.pop()
+                chunks = [c for _, _, doc_chunks in items for c in doc_chunks.values()]
+                if chunks:
+                    embeddings = await embed_in_batches(
+                        self.embedding_func,
+                        [c["content"] for c in chunks],
+                        self.embedding_batch_num,
+                        self.embedding_batch_max_tokens,
+                        [c["tokens"] for c in chunks],
+                        self.tiktoken_model_name,
+                    )
+                    for chunk, embedding in zip(chunks, embeddings):
+                        chunk["embedding"] = embedding
+                for item in items:
+                    await upsert_queue.put(item)
+            await upsert_queue.put(None)
+
+        async def upsert_stage():
+            while (item := await upsert_queue.get()) is not None:
+                doc_key, doc, chunks = item
+                if chunks:
+                    await self.chunks_vdb.upsert(chunks)
+                    await self.text_chunks.upsert(
+                        {
+                            k: {k1: v1 for k1, v1 in v.items() if k1 != "embedding"}
+                            for k, v in chunks.items()
+                        }
+                    )
+                await self.full_docs.upsert({doc_key: doc})
+                in_flight_docs.discard(doc_key)
+                in_flight_chunks.difference_update(chunks.keys())
+                inserted["chunks"] += len(chunks)
+                inserted["since_checkpoint"] += max(len(chunks), 1)
+                if inserted["since_checkpoint"] >= self.insert_checkpoint_chunks:
+                    await self._checkpoint()
+                    inserted["since_checkpoint"] = 0
+
+        stages = [
+            asyncio.ensure_future(stage())
+            for stage in (chunk_stage, dedupe_stage, embedding_stage, upsert_stage)
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await self._checkpoint()
+        logger.info(f"[Stream] inserted {inserted['chunks']} chunks")
+        return inserted["chunks"]
+
+    async def _checkpoint(self):
+        await self._flusher.flush([self.chunks_vdb, self.text_chunks, self.full_docs])
+
     async def _insert_done(self):
-        tasks = []
-        for storage_inst in [
-            self.full_docs,
-            self.text_chunks,
-            self.llm_response_cache,
-            self.entities_vdb,
-            self.entity_name_vdb,
-            self.relationships_vdb,
-            self.chunks_vdb,
-        ]:
-            if storage_inst is None:
-                continue
-            tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
-        await asyncio.gather(*tasks)
+        await self._flusher.schedule()
 
 
     def query(self, query: str, param: QueryParam = QueryParam()):
-        loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.aquery(query, param))
+        return self._run(self.aquery(query, param))
 
     async def aquery(self, query: str, param: QueryParam = QueryParam()):
+        # identical concurrent queries share one retrieval and generation
+        return await self._query_flights.do(
+            self._query_key(query, param), self._aquery, query, param
+        )
+
+    async def _aquery(self, query: str, param: QueryParam):
         if param.mode == "naive":
             response = await naive_query(
                 query,
@@ -253,16 +724,75 @@ class SmolRAG:
                 self.text_chunks,
                 param,
                 asdict(self),
+                self.semantic_llm_cache,
+                self.retrieval_cache,
             )
         else:
             raise ValueError(f"Unknown mode {param.mode}")
         await self._query_done()
         return response
 
+    def query_stream(self, query: str, param: QueryParam = QueryParam()):
+        stream = self.aquery_stream(query, param)
+        try:
+            while True:
+                try:
+                    yield self._run(stream.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(stream.aclose())
+
+    async def aquery_stream(
+        self, query: str, param: QueryParam = QueryParam()
+    ) -> AsyncIterator[str]:
+        """aquery yielding the answer as it is generated"""
+        if param.mode == "naive":
+            stream = naive_query_stream(
+                query,
+                self.chunks_vdb,
+                self.text_chunks,
+                param,
+                asdict(self),
+                self.semantic_llm_cache,
+                self.retrieval_cache,
+            )
+        else:
+            raise ValueError(f"Unknown mode {param.mode}")
+        async with aclosing(stream):
+            async for piece in stream:
+                yield piece
+        await self._query_done()
+
+    @staticmethod
+    def _query_key(query: str, param: QueryParam) -> str:
+        return json.dumps([normalize_query(query), asdict(param)])
+
+    def query_batch(self, queries: list[str], param: QueryParam = QueryParam()):
+        return self._run(self.aquery_batch(queries, param))
+
+    async def aquery_batch(
+        self, queries: list[str], param: QueryParam = QueryParam()
+    ) -> list[str]:
+        # duplicates within the batch are answered once
+        unique = {}
+        for query in queries:
+            unique.setdefault(self._query_key(query, param), query)
+        if param.mode == "naive":
+            responses = await naive_query_batch(
+                list(unique.values()),
+                self.chunks_vdb,
+                self.text_chunks,
+                param,
+                asdict(self),
+                self.semantic_llm_cache,
+                self.retrieval_cache,
+            )
+        else:
+            raise ValueError(f"Unknown mode {param.mode}")
+        await self._query_done()
+        by_key = dict(zip(unique.keys(), responses))
+        return [by_key[self._query_key(query, param)] for query in queries]
+
     async def _query_done(self):
-        tasks = []
-        for storage_inst in [self.llm_response_cache]:
-            if storage_inst is None:
-                continue
-            tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
-        await asyncio.gather(*tasks)
\ No newline at end of file
+        await self._flusher.schedule()
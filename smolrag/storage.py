@@ -1,18 +1,194 @@
 import asyncio
+import heapq
 import html
+import json
 import os
+import sqlite3
+import sys
+import time
+import zlib
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from typing import Callable, Union
 from nano_vectordb import NanoVectorDB
 
-from .utils import logger, load_json, write_json, compute_mdhash_id
+from .utils import (
+    logger,
+    load_json,
+    write_json,
+    write_bytes_atomic,
+    compute_mdhash_id,
+    decode_tokens_by_tiktoken,
+    encode_string_by_tiktoken,
+    normalize_embeddings,
+    run_blocking,
+)
 
 from .base import (
     BaseKVStorage,
     BaseVectorStorage,
+    StorageNameSpace,
 )
 
 
+def approx_nbytes(data: dict[str, dict]) -> int:
+    """Size estimate of records for dirty tracking, without serializing them"""
+    return sum(
+        len(k) + sum(len(v) if isinstance(v, str) else 8 for v in value.values())
+        for k, value in data.items()
+    )
+
+
+def pack_batches(
+    token_counts: list[int], max_batch_size: int, max_batch_tokens: int = None
+) -> list[list[int]]:
+    """Group indices into batches of at most max_batch_size items and
+    max_batch_tokens tokens, shortest texts first so similar lengths share a
+    batch. A text over the token budget gets a batch of its own."""
+    batches, batch, batch_tokens = [], [], 0
+    for i in sorted(range(len(token_counts)), key=token_counts.__getitem__):
+        if batch and (
+            len(batch) >= max_batch_size
+            or (max_batch_tokens and batch_tokens + token_counts[i] > max_batch_tokens)
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += token_counts[i]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+_SIZE_ERROR_HINTS = (
+    "token",
+    "too large",
+    "too long",
+    "too many",
+    "maximum",
+    "context length",
+)
+
+
+def is_batch_rejection(e: Exception) -> bool:
+    """Errors a smaller request could avoid: payload too large, a bad request
+    that complains about size, or a local backend running out of memory"""
+    message = str(e).lower()
+    if "openai" in sys.modules:
+        from openai import APIStatusError, BadRequestError
+
+        if isinstance(e, BadRequestError):
+            return any(hint in message for hint in _SIZE_ERROR_HINTS)
+        if isinstance(e, APIStatusError):
+            return e.status_code == 413
+    return "out of memory" in message
+
+
+async def embed_in_batches(
+    embedding_func,
+    contents: list[str],
+    max_batch_size: int,
+    max_batch_tokens: int = None,
+    token_counts: list[int] = None,
+    tiktoken_model: str = "gpt-4o",
+) -> np.ndarray:
+    """Embed contents in batches of at most max_batch_size texts and
+    max_batch_tokens tokens (embedding_func.max_batch_tokens when None). Texts
+    over embedding_func.max_token_size are truncated to it, and a batch the
+    server rejects for its size is split in half and retried."""
+    if not contents:
+        return np.zeros((0, embedding_func.embedding_dim), np.float32)
+    max_batch_tokens = max_batch_tokens or getattr(
+        embedding_func, "max_batch_tokens", None
+    )
+    max_token_size = embedding_func.max_token_size
+    if token_counts is None:
+        # a token covers at least one byte, so without a batch budget only
+        # long texts need counting
+        token_counts = [
+            (
+                len(encode_string_by_tiktoken(c, tiktoken_model))
+                if max_batch_tokens or len(c.encode()) > max_token_size
+                else 0
+            )
+            for c in contents
+        ]
+    too_long = [i for i, n in enumerate(token_counts) if n > max_token_size]
+    if too_long:
+        logger.warning(
+            f"Truncating {len(too_long)} texts to {max_token_size} tokens for embedding"
+        )
+        contents, token_counts = list(contents), list(token_counts)
+        for i in too_long:
+            contents[i] = decode_tokens_by_tiktoken(
+                encode_string_by_tiktoken(contents[i], tiktoken_model)[:max_token_size],
+                tiktoken_model,
+            )
+            token_counts[i] = max_token_size
+
+    async def embed_batch(batch: list[int]) -> np.ndarray:
+        try:
+            return await embedding_func([contents[i] for i in batch])
+        except Exception as e:
+            if len(batch) == 1 or not is_batch_rejection(e):
+                raise
+            half = len(batch) // 2
+            logger.warning(
+                f"Embedding batch of {len(batch)} texts "
+                f"({sum(token_counts[i] for i in batch)} tokens) rejected, "
+                f"retrying as {half} + {len(batch) - half}: {e}"
+            )
+            return np.concatenate(
+                await asyncio.gather(
+                    embed_batch(batch[:half]), embed_batch(batch[half:])
+                )
+            )
+
+    batches = pack_batches(token_counts, max_batch_size, max_batch_tokens)
+    embeddings_list = await asyncio.gather(*[embed_batch(b) for b in batches])
+    order = np.concatenate(batches)
+    embeddings = np.empty(
+        (len(contents), embeddings_list[0].shape[1]), embeddings_list[0].dtype
+    )
+    embeddings[order] = np.concatenate(embeddings_list)
+    return embeddings
+
+
+async def embed_data(
+    embedding_func,
+    data: dict[str, dict],
+    max_batch_size: int,
+    max_batch_tokens: int = None,
+    tiktoken_model: str = "gpt-4o",
+) -> np.ndarray:
+    """Embed the 'content' of every value, reusing a precomputed 'embedding'
+    field and the chunk 'tokens' count when present"""
+    values = list(data.values())
+    missing = [i for i, v in enumerate(values) if "embedding" not in v]
+    if not missing:
+        return np.stack([v["embedding"] for v in values])
+    token_counts = None
+    if all("tokens" in values[i] for i in missing):
+        token_counts = [values[i]["tokens"] for i in missing]
+    computed = await embed_in_batches(
+        embedding_func,
+        [values[i]["content"] for i in missing],
+        max_batch_size,
+        max_batch_tokens,
+        token_counts,
+        tiktoken_model,
+    )
+    if len(missing) == len(values):
+        return computed
+    present = [i for i, v in enumerate(values) if "embedding" in v]
+    embeddings = np.zeros((len(values), embedding_func.embedding_dim), np.float32)
+    embeddings[present] = np.stack([values[i]["embedding"] for i in present])
+    embeddings[missing] = computed
+    return embeddings
+
+
 @dataclass
 class JsonKVStorage(BaseKVStorage):
     def __post_init__(self):
@@ -25,7 +201,8 @@ class JsonKVStorage(BaseKVStorage):
         return list(self._data.keys())
 
     async def index_done_callback(self):
-        write_json(self._data, self._file_name)
+        # serialize a snapshot off the event loop; values are never mutated
+        await run_blocking(None, write_json, dict(self._data), self._file_name)
 
     async def get_by_id(self, id):
         return self._data.get(id, None)
@@ -48,10 +225,513 @@ class JsonKVStorage(BaseKVStorage):
     async def upsert(self, data: dict[str, dict]):
         left_data = {k: v for k, v in data.items() if k not in self._data}
         self._data.update(left_data)
+        if left_data:
+            self.mark_dirty(approx_nbytes(left_data))
         return left_data
 
     async def drop(self):
         self._data = {}
+        self.mark_dirty()
+
+
+@dataclass
+class LogKVStorage(BaseKVStorage):
+    """Append-only KV storage.
+
+    Records live in ``kv_store_<namespace>.log`` as ``crc\tkey\tvalue`` lines.
+    ``index_done_callback`` only appends the records upserted since the last
+    commit, and the key -> (offset, length) index is rebuilt from the log on open.
+    Like the other KV storages, upsert never overwrites a key, so the log holds
+    one record per key and needs no compaction; ``drop`` rewrites it empty.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.log")
+        self._index: dict[str, tuple[int, int]] = {}
+        self._pending: dict[str, dict] = {}
+        self._dropped = False
+        self._file_size = 0
+        self._lock = asyncio.Lock()
+
+        if not os.path.exists(self._file_name):
+            # written in one atomic step, so a crash cannot leave an empty log
+            # that hides the legacy file on the next open
+            legacy = self._load_legacy_json()
+            write_bytes_atomic(
+                b"".join(self._encode_record(k, v) for k, v in legacy.items()),
+                self._file_name,
+            )
+        self._rebuild_index()
+        self._reader = open(self._file_name, "rb")
+        logger.info(
+            f"Load KV {self.namespace} with {len(self._index) + len(self._pending)} data"
+        )
+
+    def _load_legacy_json(self) -> dict:
+        legacy_file = os.path.join(
+            self.global_config["working_dir"], f"kv_store_{self.namespace}.json"
+        )
+        data = load_json(legacy_file) or {}
+        if data:
+            logger.info(f"Migrating {len(data)} records from {legacy_file}")
+        return data
+
+    @staticmethod
+    def _encode_record(key: str, value) -> bytes:
+        body = (
+            json.dumps(key, ensure_ascii=False)
+            + "\t"
+            + json.dumps(value, ensure_ascii=False)
+        ).encode("utf-8")
+        return b"%08x\t%s\n" % (zlib.crc32(body), body)
+
+    @staticmethod
+    def _decode_record(line: bytes):
+        """Return (key, value_bytes) or None if the line is torn or corrupted"""
+        if not line.endswith(b"\n"):
+            return None
+        crc, _, body = line[:-1].partition(b"\t")
+        try:
+            if int(crc, 16) != zlib.crc32(body):
+                return None
+        except ValueError:
+            return None
+        key, _, value = body.partition(b"\t")
+        return json.loads(key), value
+
+    def _rebuild_index(self):
+        offset = 0
+        with open(self._file_name, "rb") as f:
+            for line in f:
+                record = self._decode_record(line)
+                if record is None:
+                    break
+                self._index[record[0]] = (offset, len(line))
+                offset += len(line)
+        if offset != os.path.getsize(self._file_name):
+            logger.warning(
+                f"Truncating torn tail of {self._file_name} at byte {offset}"
+            )
+            with open(self._file_name, "r+b") as f:
+                f.truncate(offset)
+        self._file_size = offset
+
+    def _read_value(self, key: str):
+        offset, length = self._index[key]
+        self._reader.seek(offset)
+        return json.loads(self._decode_record(self._reader.read(length))[1])
+
+    def _get(self, id):
+        if id in self._pending:
+            return self._pending[id]
+        if id in self._index:
+            return self._read_value(id)
+        return None
+
+    async def all_keys(self) -> list[str]:
+        return list(self._index.keys()) + [
+            k for k in self._pending if k not in self._index
+        ]
+
+    async def get_by_id(self, id):
+        return self._get(id)
+
+    async def get_by_ids(self, ids, fields=None):
+        values = [self._get(id) for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._index and s not in self._pending])
+
+    async def upsert(self, data: dict[str, dict]):
+        left_data = {
+            k: v
+            for k, v in data.items()
+            if k not in self._index and k not in self._pending
+        }
+        self._pending.update(left_data)
+        if left_data:
+            self.mark_dirty(approx_nbytes(left_data))
+        return left_data
+
+    async def drop(self):
+        async with self._lock:
+            self._index, self._pending = {}, {}
+            self._dropped = True
+        self.mark_dirty()
+
+    def _append_pending(self):
+        if self._dropped:
+            self._reader.close()
+            write_bytes_atomic(b"", self._file_name)
+            self._reader = open(self._file_name, "rb")
+            self._index, self._file_size = {}, 0
+            self._dropped = False
+        if not self._pending:
+            return
+        records = [self._encode_record(k, v) for k, v in self._pending.items()]
+        with open(self._file_name, "ab") as f:
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        offset = self._file_size
+        for key, record in zip(self._pending, records):
+            self._index[key] = (offset, len(record))
+            offset += len(record)
+        self._file_size = offset
+        self._pending = {}
+
+    async def index_done_callback(self):
+        async with self._lock:
+            self._append_pending()
+
+
+@dataclass
+class SqliteKVStorage(BaseKVStorage):
+    """KV storage in ``kv_store_<namespace>.sqlite`` (WAL mode).
+
+    Values are stored as JSON text, so lookups and ``fields`` projections are
+    answered by SQLite instead of a Python dict holding the whole namespace.
+    All connection calls go through a single worker thread.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.sqlite")
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"sqlite-{self.namespace}"
+        )
+        self._conn = self._executor.submit(self._connect).result()
+        count = self._executor.submit(self._count).result()
+        logger.info(f"Load KV {self.namespace} with {count} data")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._file_name, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (id TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        conn.commit()
+        return conn
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+
+    async def _run(self, func, *args):
+        return await run_blocking(self._executor, func, *args)
+
+    def _all_keys(self) -> list[str]:
+        return [row[0] for row in self._conn.execute("SELECT id FROM kv")]
+
+    def _get_by_ids(self, ids: list[str], fields):
+        fields = sorted(fields) if fields is not None else None
+        columns = (
+            "kv.value" if fields is None else ", ".join("kv.value -> ?" for _ in fields)
+        )
+        paths = [] if fields is None else [f"$.{json.dumps(f)}" for f in fields]
+        rows = self._conn.execute(
+            f"SELECT kv.id, {columns} FROM json_each(?) AS ids "
+            "LEFT JOIN kv ON kv.id = ids.value ORDER BY ids.key",
+            (*paths, json.dumps(ids)),
+        ).fetchall()
+        if fields is None:
+            return [json.loads(row[1]) if row[0] is not None else None for row in rows]
+        return [
+            (
+                {f: json.loads(v) for f, v in zip(fields, row[1:]) if v is not None}
+                if row[0] is not None
+                else None
+            )
+            for row in rows
+        ]
+
+    def _filter_keys(self, data: list[str]) -> set[str]:
+        rows = self._conn.execute(
+            "SELECT ids.value FROM json_each(?) AS ids "
+            "LEFT JOIN kv ON kv.id = ids.value WHERE kv.id IS NULL",
+            (json.dumps(data),),
+        )
+        return set(row[0] for row in rows)
+
+    def _upsert(self, data: dict[str, dict]):
+        with self._conn:
+            new_keys = self._filter_keys(list(data.keys()))
+            left_data = {k: v for k, v in data.items() if k in new_keys}
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO kv (id, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in left_data.items()],
+            )
+        return left_data
+
+    def _drop(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM kv")
+
+    async def all_keys(self) -> list[str]:
+        return await self._run(self._all_keys)
+
+    async def get_by_id(self, id):
+        return (await self._run(self._get_by_ids, [id], None))[0]
+
+    async def get_by_ids(self, ids, fields=None):
+        return await self._run(self._get_by_ids, ids, fields)
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return await self._run(self._filter_keys, data)
+
+    async def upsert(self, data: dict[str, dict]):
+        left_data = await self._run(self._upsert, data)
+        if left_data:
+            self.mark_dirty(approx_nbytes(left_data))
+        return left_data
+
+    async def drop(self):
+        await self._run(self._drop)
+        self.mark_dirty()
+
+    async def index_done_callback(self):
+        await self._run(self._conn.execute, "PRAGMA wal_checkpoint(PASSIVE)")
+
+
+@dataclass
+class TieredResponseCache(BaseKVStorage):
+    """Bounded LLM response cache: an in-memory LRU over an SQLite file.
+
+    The memory tier holds up to ``llm_cache_memory_bytes`` of serialized
+    values. Every write goes straight to ``llm_cache_<namespace>.sqlite``,
+    which is trimmed to ``llm_cache_disk_bytes`` by least recent access.
+    Entries older than ``llm_cache_ttl`` seconds (when set) are treated as
+    misses and removed. Disk access times are batched until
+    ``index_done_callback``.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(
+            working_dir, f"llm_cache_{self.namespace}.sqlite"
+        )
+        self.memory_bytes_limit = self.global_config.get(
+            "llm_cache_memory_bytes", 64 * 1024 * 1024
+        )
+        self.disk_bytes_limit = self.global_config.get(
+            "llm_cache_disk_bytes", 1024 * 1024 * 1024
+        )
+        self.ttl = self.global_config.get("llm_cache_ttl")
+        # id -> (value, size, created), least recently used first
+        self._memory: OrderedDict[str, tuple[dict, int, float]] = OrderedDict()
+        self._memory_bytes = 0
+        self._touched: dict[str, float] = {}
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"sqlite-{self.namespace}"
+        )
+        self._conn = self._executor.submit(self._connect).result()
+        self._disk_bytes, count = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache"
+        ).fetchone()
+        logger.info(f"Load KV {self.namespace} with {count} data")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._file_name, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (id TEXT PRIMARY KEY, "
+            "value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        conn.commit()
+        legacy_file = os.path.join(
+            self.global_config["working_dir"], f"kv_store_{self.namespace}.json"
+        )
+        empty = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 0
+        if empty and os.path.exists(legacy_file):
+            now = time.time()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (k, v, len(v), now, now)
+                        for k, v in (
+                            (k, json.dumps(v, ensure_ascii=False))
+                            for k, v in (load_json(legacy_file) or {}).items()
+                        )
+                    ],
+                )
+            logger.info(f"Migrated {legacy_file} into {self._file_name}")
+        return conn
+
+    async def _run(self, func, *args):
+        return await run_blocking(self._executor, func, *args)
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, id: str, value: dict, size: int, created: float):
+        if id in self._memory:
+            self._memory_bytes -= self._memory.pop(id)[1]
+        if size > self.memory_bytes_limit:
+            return
+        self._memory[id] = (value, size, created)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_bytes_limit:
+            self._memory_bytes -= self._memory.popitem(last=False)[1][1]
+            self._stats["memory_evictions"] += 1
+
+    def _read(self, ids: list[str]) -> dict[str, tuple[str, float]]:
+        rows = self._conn.execute(
+            "SELECT cache.id, cache.value, cache.created FROM json_each(?) AS ids "
+            "JOIN cache ON cache.id = ids.value",
+            (json.dumps(ids),),
+        )
+        return {id: (value, created) for id, value, created in rows}
+
+    def _write(self, rows: list[tuple]):
+        with self._conn:
+            for id, *_ in rows:
+                old = self._conn.execute(
+                    "SELECT size FROM cache WHERE id = ?", (id,)
+                ).fetchone()
+                self._disk_bytes -= old[0] if old else 0
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._disk_bytes += sum(row[2] for row in rows)
+        if self._disk_bytes > self.disk_bytes_limit:
+            self._evict_disk()
+
+    def _evict_disk(self, expired_before: float = None) -> list[str]:
+        evicted = []
+        with self._conn:
+            if expired_before is not None:
+                evicted += [
+                    row
+                    for row in self._conn.execute(
+                        "DELETE FROM cache WHERE created < ? RETURNING id, size",
+                        (expired_before,),
+                    )
+                ]
+            # oldest accessed first, in pages, until under the byte budget
+            disk_bytes = self._disk_bytes - sum(size for _, size in evicted)
+            while disk_bytes > self.disk_bytes_limit:
+                page = self._conn.execute(
+                    "DELETE FROM cache WHERE id IN (SELECT id FROM cache "
+                    "ORDER BY accessed LIMIT 256) RETURNING id, size"
+                ).fetchall()
+                if not page:
+                    break
+                evicted += page
+                disk_bytes -= sum(size for _, size in page)
+        self._disk_bytes -= sum(size for _, size in evicted)
+        self._stats["disk_evictions"] += len(evicted)
+        return [id for id, _ in evicted]
+
+    def _touch(self, touched: dict[str, float]):
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE cache SET accessed = ? WHERE id = ?",
+                [(accessed, id) for id, accessed in touched.items()],
+            )
+
+    async def all_keys(self) -> list[str]:
+        return await self._run(
+            lambda: [row[0] for row in self._conn.execute("SELECT id FROM cache")]
+        )
+
+    async def get_by_id(self, id):
+        return (await self.get_by_ids([id]))[0]
+
+    async def get_by_ids(self, ids, fields=None):
+        found, missing = {}, []
+        for id in ids:
+            entry = self._memory.get(id)
+            if entry is not None and not self._expired(entry[2]):
+                self._memory.move_to_end(id)
+                found[id] = entry[0]
+                self._stats["memory_hits"] += 1
+            else:
+                missing.append(id)
+        if missing:
+            for id, (value, created) in (await self._run(self._read, missing)).items():
+                if self._expired(created):
+                    continue
+                found[id] = json.loads(value)
+                self._remember(id, found[id], len(value), created)
+                self._stats["disk_hits"] += 1
+        now = time.time()
+        results = []
+        for id in ids:
+            value = found.get(id)
+            if value is None:
+                self._stats["misses"] += 1
+                results.append(None)
+                continue
+            self._touched[id] = now
+            self.mark_dirty()
+            results.append(
+                value
+                if fields is None
+                else {k: v for k, v in value.items() if k in fields}
+            )
+        return results
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        found = await self._run(self._read, [k for k in data if k not in self._memory])
+        return set(k for k in data if k not in self._memory and k not in found)
+
+    async def upsert(self, data: dict[str, dict]):
+        now = time.time()
+        rows = []
+        for id, value in data.items():
+            serialized = json.dumps(value, ensure_ascii=False)
+            self._remember(id, value, len(serialized), now)
+            rows.append((id, serialized, len(serialized), now, now))
+        await self._run(self._write, rows)
+        self.mark_dirty(sum(row[2] for row in rows))
+        return data
+
+    async def drop(self):
+        self.mark_dirty()
+        self._memory.clear()
+        self._memory_bytes = 0
+        self._touched.clear()
+
+        def _drop():
+            with self._conn:
+                self._conn.execute("DELETE FROM cache")
+            self._disk_bytes = 0
+
+        await self._run(_drop)
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "memory_bytes": self._memory_bytes,
+            "disk_bytes": self._disk_bytes,
+        }
+
+    async def index_done_callback(self):
+        touched, self._touched = self._touched, {}
+        if touched:
+            await self._run(self._touch, touched)
+        if self.ttl is not None:
+            for id in await self._run(self._evict_disk, time.time() - self.ttl):
+                if id in self._memory:
+                    self._memory_bytes -= self._memory.pop(id)[1]
 
 
 @dataclass
@@ -63,9 +743,13 @@ class NanoVectorDBStorage(BaseVectorStorage):
             self.global_config["working_dir"], f"vdb_{self.namespace}.json"
         )
         self._max_batch_size = self.global_config["embedding_batch_num"]
+        self._max_batch_tokens = self.global_config.get("embedding_batch_max_tokens")
+        self._tiktoken_model = self.global_config.get("tiktoken_model_name", "gpt-4o")
         self._client = NanoVectorDB(
             self.embedding_func.embedding_dim, storage_file=self._client_file_name
         )
+        # held while the client is saved from a worker thread
+        self._lock = asyncio.Lock()
         self.cosine_better_than_threshold = self.global_config.get(
             "cosine_better_than_threshold", self.cosine_better_than_threshold
         )
@@ -82,18 +766,19 @@ class NanoVectorDBStorage(BaseVectorStorage):
             }
             for k, v in data.items()
         ]
-        contents = [v["content"] for v in data.values()]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-        embeddings_list = await asyncio.gather(
-            *[self.embedding_func(batch) for batch in batches]
+        embeddings = await embed_data(
+            self.embedding_func,
+            data,
+            self._max_batch_size,
+            self._max_batch_tokens,
+            self._tiktoken_model,
         )
-        embeddings = np.concatenate(embeddings_list)
         for i, d in enumerate(list_data):
             d["__vector__"] = embeddings[i]
-        results = self._client.upsert(datas=list_data)
+        async with self._lock:
+            results = self._client.upsert(datas=list_data)
+        self.index_generation += 1
+        self.mark_dirty(embeddings.nbytes + approx_nbytes(data))
         return results
 
     async def query(self, query: str, top_k=5):
@@ -110,16 +795,54 @@ class NanoVectorDBStorage(BaseVectorStorage):
         ]
         return results
 
+    async def query_batch(self, queries: list[str], top_k=5):
+        embeddings = await embed_in_batches(
+            self.embedding_func,
+            queries,
+            self._max_batch_size,
+            self._max_batch_tokens,
+            tiktoken_model=self._tiktoken_model,
+        )
+        storage = self.client_storage
+        if not len(storage["data"]):
+            return [[] for _ in queries]
+        scores = storage["matrix"] @ normalize_embeddings(embeddings).T
+        results = []
+        for column in scores.T:
+            top = np.argsort(-column)[:top_k]
+            results.append(
+                [
+                    {
+                        **storage["data"][i],
+                        "__metrics__": column[i],
+                        "id": storage["data"][i]["__id__"],
+                        "distance": column[i],
+                    }
+                    for i in top
+                    if column[i] >= self.cosine_better_than_threshold
+                ]
+            )
+        return results
+
     @property
     def client_storage(self):
         return getattr(self._client, "_NanoVectorDB__storage")
 
+    async def delete(self, ids: list[str]):
+        async with self._lock:
+            self._client.delete(ids)
+        self.index_generation += 1
+        self.mark_dirty(len(ids))
+
+    async def all_items(self) -> list[dict]:
+        return [{**dp, "id": dp["__id__"]} for dp in self.client_storage["data"]]
+
     async def delete_entity(self, entity_name: str):
         try:
             entity_id = [compute_mdhash_id(entity_name, prefix="ent-")]
 
             if self._client.get(entity_id):
-                self._client.delete(entity_id)
+                await self.delete(entity_id)
                 logger.info(f"Entity {entity_name} have been deleted.")
             else:
                 logger.info(f"No entity found with name {entity_name}.")
@@ -136,7 +859,7 @@ class NanoVectorDBStorage(BaseVectorStorage):
             ids_to_delete = [relation["__id__"] for relation in relations]
 
             if ids_to_delete:
-                self._client.delete(ids_to_delete)
+                await self.delete(ids_to_delete)
                 logger.info(
                     f"All relations related to entity {entity_name} have been deleted."
                 )
@@ -148,4 +871,1005 @@ class NanoVectorDBStorage(BaseVectorStorage):
             )
 
     async def index_done_callback(self):
-        self._client.save()
+        async with self._lock:
+            await run_blocking(None, self._client.save)
+
+
+@dataclass
+class MemmapVectorDBStorage(BaseVectorStorage):
+    """Vector storage backed by a raw float32 file opened with ``np.memmap``.
+
+    Rows are appended to ``vdb_<namespace>.f32`` and ids/meta fields to the
+    ``vdb_<namespace>.meta.jsonl`` sidecar as ``[row, id, meta]`` lines
+    (``[row, null]`` marks a deleted row). A sidecar line is only written after
+    its vector, so rows without one are discarded on open.
+
+    Deleted rows are reused by later inserts. Once the sidecar holds more than
+    ``meta_compaction_ratio`` lines per live row it is rewritten with one line
+    per live row on commit, and trailing deleted rows are cut from the matrix.
+
+    Subclasses can store a different row encoding by overriding ``_row_dtype``,
+    ``_row_width``, ``_encode``, ``_decode`` and ``_score``.
+    """
+
+    cosine_better_than_threshold: float = 0.0
+    meta_compaction_ratio: float = 2.0
+
+    _vector_suffix = "f32"
+    _meta_compaction_min_lines = 1024
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._vector_file = os.path.join(
+            working_dir, f"vdb_{self.namespace}.{self._vector_suffix}"
+        )
+        self._meta_file = os.path.join(working_dir, f"vdb_{self.namespace}.meta.jsonl")
+        self._max_batch_size = self.global_config["embedding_batch_num"]
+        self._max_batch_tokens = self.global_config.get("embedding_batch_max_tokens")
+        self._tiktoken_model = self.global_config.get("tiktoken_model_name", "gpt-4o")
+        self.cosine_better_than_threshold = self.global_config.get(
+            "cosine_better_than_threshold", self.cosine_better_than_threshold
+        )
+        self._dim = self.embedding_func.embedding_dim
+        self._row_bytes = self._row_width() * np.dtype(self._row_dtype()).itemsize
+
+        self._ids: list[Union[str, None]] = []
+        self._metas: list[Union[dict, None]] = []
+        self._rows: dict[str, int] = {}
+        self._free_rows: list[int] = []
+        self._meta_lines = 0
+        # set by subclasses while a worker thread reads the matrix
+        self._written_while_training = None
+        self._load_meta()
+        if not os.path.exists(self._vector_file):
+            open(self._vector_file, "wb").close()
+        self._vector_fh = open(self._vector_file, "r+b")
+        self._vector_fh.truncate(len(self._ids) * self._row_bytes)
+        self._meta_fh = open(self._meta_file, "a", encoding="utf-8")
+        self._open_matrix()
+        logger.info(f"Load {self.namespace} vectors with {len(self._rows)} data")
+
+    def _row_dtype(self):
+        return np.float32
+
+    def _row_width(self) -> int:
+        return self._dim
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors
+
+    def _decode(self, block: np.ndarray) -> np.ndarray:
+        return np.asarray(block, dtype=np.float32)
+
+    def _score(self, block: np.ndarray, embedding: np.ndarray) -> np.ndarray:
+        return block @ embedding
+
+    def _load_meta(self):
+        if not os.path.exists(self._meta_file):
+            return
+        vector_rows = (
+            os.path.getsize(self._vector_file) // self._row_bytes
+            if os.path.exists(self._vector_file)
+            else 0
+        )
+        offset = 0
+        with open(self._meta_file, "rb") as f:
+            for line in f:
+                try:
+                    row, id, *meta = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n") or row >= vector_rows:
+                    break
+                offset += len(line)
+                self._meta_lines += 1
+                if row >= len(self._ids):
+                    self._ids.extend([None] * (row + 1 - len(self._ids)))
+                    self._metas.extend([None] * (row + 1 - len(self._metas)))
+                if self._ids[row] is not None:
+                    self._rows.pop(self._ids[row], None)
+                self._ids[row] = id
+                self._metas[row] = meta[0] if id is not None else None
+                if id is not None:
+                    self._rows[id] = row
+        self._free_rows = [row for row, id in enumerate(self._ids) if id is None]
+        if offset != os.path.getsize(self._meta_file):
+            logger.warning(
+                f"Truncating torn tail of {self._meta_file} at byte {offset}"
+            )
+            with open(self._meta_file, "r+b") as f:
+                f.truncate(offset)
+
+    def _open_matrix(self):
+        n = len(self._ids)
+        self._matrix = (
+            np.memmap(
+                self._vector_file,
+                dtype=self._row_dtype(),
+                mode="r",
+                shape=(n, self._row_width()),
+            )
+            if n
+            else np.zeros((0, self._row_width()), dtype=self._row_dtype())
+        )
+
+    def _allocate_rows(self, ids: list[str]) -> tuple[list[int], int]:
+        """Return the row of every id (existing, reused or appended) and the number of new rows"""
+        rows, next_row = [], len(self._ids)
+        for id in ids:
+            if id in self._rows:
+                rows.append(self._rows[id])
+            elif self._free_rows:
+                rows.append(heapq.heappop(self._free_rows))
+            else:
+                rows.append(next_row)
+                next_row += 1
+        return rows, next_row - len(self._ids)
+
+    @staticmethod
+    def _write_block(fh, rows: list[int], block: np.ndarray):
+        """Write block[i] at rows[i], with one write per run of consecutive rows"""
+        data = np.ascontiguousarray(block).view(np.uint8).reshape(len(rows), -1)
+        row_bytes = data.shape[1]
+        run_start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i] != rows[i - 1] + 1:
+                fh.seek(rows[run_start] * row_bytes)
+                fh.write(data[run_start:i].tobytes())
+                run_start = i
+        fh.flush()
+
+    def _commit_rows(
+        self, ids: list[str], metas: list[dict], rows: list[int], n_new: int
+    ):
+        self._meta_fh.write(
+            "".join(
+                json.dumps([row, id, meta], ensure_ascii=False) + "\n"
+                for id, meta, row in zip(ids, metas, rows)
+            )
+        )
+        self._meta_fh.flush()
+        self._meta_lines += len(ids)
+        self._ids.extend([None] * n_new)
+        self._metas.extend([None] * n_new)
+        for id, meta, row in zip(ids, metas, rows):
+            self._ids[row] = id
+            self._metas[row] = meta
+            self._rows[id] = row
+        self.index_generation += 1
+        self.mark_dirty(
+            len(ids) * self._row_bytes + approx_nbytes(dict(zip(ids, metas)))
+        )
+        if n_new:
+            self._open_matrix()
+
+    def _write_rows(self, ids: list[str], metas: list[dict], vectors: np.ndarray):
+        rows, n_new = self._allocate_rows(ids)
+        self._write_block(self._vector_fh, rows, self._encode(vectors))
+        self._commit_rows(ids, metas, rows, n_new)
+
+    async def upsert(self, data: dict[str, dict]):
+        logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
+        if not len(data):
+            logger.warning("You insert an empty data to vector DB")
+            return []
+        ids = list(data.keys())
+        metas = [
+            {k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields}
+            for v in data.values()
+        ]
+        embeddings = await embed_data(
+            self.embedding_func,
+            data,
+            self._max_batch_size,
+            self._max_batch_tokens,
+            self._tiktoken_model,
+        )
+        embeddings = normalize_embeddings(embeddings)
+        report = {
+            "update": [k for k in ids if k in self._rows],
+            "insert": [k for k in ids if k not in self._rows],
+        }
+        self._write_rows(ids, metas, embeddings)
+        return report
+
+    def _rank(self, scores: np.ndarray, top_k: int, rows: np.ndarray = None):
+        """Turn the scores of ``rows`` (every row when None) into top_k results"""
+        n_candidates = min(len(scores), top_k + len(self._ids) - len(self._rows))
+        if n_candidates <= 0:
+            return []
+        candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        results = []
+        for i in candidates[np.argsort(-scores[candidates])]:
+            row = int(rows[i]) if rows is not None else int(i)
+            if self._ids[row] is None:
+                continue
+            if scores[i] < self.cosine_better_than_threshold or len(results) >= top_k:
+                break
+            results.append(self._result(row, float(scores[i])))
+        return results
+
+    def _search(self, embedding: np.ndarray, top_k: int) -> list[dict]:
+        if not len(self._rows):
+            return []
+        return self._rank(self._score(self._matrix, embedding), top_k)
+
+    def _result(self, row: int, score: float) -> dict:
+        id = self._ids[row]
+        return {
+            **self._metas[row],
+            "__id__": id,
+            "__metrics__": score,
+            "id": id,
+            "distance": score,
+        }
+
+    def _search_many(self, embeddings: np.ndarray, top_k: int) -> list[list[dict]]:
+        """One matrix-matrix product for a block of queries"""
+        if not len(self._rows):
+            return [[] for _ in embeddings]
+        results = []
+        for start in range(0, len(embeddings), 256):
+            scores = self._score(self._matrix, embeddings[start : start + 256].T)
+            results.extend(self._rank(column, top_k) for column in scores.T)
+        return results
+
+    async def query(self, query: str, top_k=5):
+        embedding = await self.embedding_func([query])
+        embedding = normalize_embeddings(embedding)[0]
+        return self._search(embedding, top_k)
+
+    async def query_batch(self, queries: list[str], top_k=5):
+        embeddings = await embed_in_batches(
+            self.embedding_func,
+            queries,
+            self._max_batch_size,
+            self._max_batch_tokens,
+            tiktoken_model=self._tiktoken_model,
+        )
+        return self._search_many(normalize_embeddings(embeddings), top_k)
+
+    def _delete(self, ids: list[str]):
+        rows = [self._rows.pop(id) for id in ids if id in self._rows]
+        if not rows:
+            return
+        self._meta_fh.write("".join(json.dumps([row, None]) + "\n" for row in rows))
+        self._meta_fh.flush()
+        self._meta_lines += len(rows)
+        for row in rows:
+            self._ids[row] = None
+            self._metas[row] = None
+            heapq.heappush(self._free_rows, row)
+        self.index_generation += 1
+        self.mark_dirty(len(rows))
+
+    async def delete(self, ids: list[str]):
+        self._delete(ids)
+
+    async def all_items(self) -> list[dict]:
+        return [{**self._metas[row], "id": id} for id, row in self._rows.items()]
+
+    async def delete_entity(self, entity_name: str):
+        entity_id = compute_mdhash_id(entity_name, prefix="ent-")
+        if entity_id in self._rows:
+            self._delete([entity_id])
+            logger.info(f"Entity {entity_name} have been deleted.")
+        else:
+            logger.info(f"No entity found with name {entity_name}.")
+
+    async def delete_relation(self, entity_name: str):
+        ids_to_delete = [
+            id
+            for id, row in self._rows.items()
+            if self._metas[row].get("src_id") == entity_name
+            or self._metas[row].get("tgt_id") == entity_name
+        ]
+        if ids_to_delete:
+            self._delete(ids_to_delete)
+            logger.info(
+                f"All relations related to entity {entity_name} have been deleted."
+            )
+        else:
+            logger.info(f"No relations found for entity {entity_name}.")
+
+    def _log_train_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                f"Training the index of {self.namespace} failed: {task.exception()!r}"
+            )
+
+    def _compact_meta(self):
+        """Rewrite the sidecar with one line per live row, then drop trailing free rows"""
+        self._meta_fh.close()
+        write_bytes_atomic(
+            "".join(
+                json.dumps([row, id, self._metas[row]], ensure_ascii=False) + "\n"
+                for row, id in enumerate(self._ids)
+                if id is not None
+            ).encode("utf-8"),
+            self._meta_file,
+        )
+        self._meta_fh = open(self._meta_file, "a", encoding="utf-8")
+        self._meta_lines = len(self._rows)
+        n = max(self._rows.values(), default=-1) + 1
+        # a training thread may still read rows past n through the old matrix
+        if n == len(self._ids) or self._written_while_training is not None:
+            return
+        del self._ids[n:], self._metas[n:]
+        self._free_rows = [row for row in self._free_rows if row < n]
+        heapq.heapify(self._free_rows)
+        self._open_matrix()
+        self._vector_fh.truncate(n * self._row_bytes)
+
+    async def index_done_callback(self):
+        await run_blocking(None, os.fsync, self._vector_fh.fileno())
+        await run_blocking(None, os.fsync, self._meta_fh.fileno())
+        if self._meta_lines > max(
+            self.meta_compaction_ratio * len(self._rows),
+            self._meta_compaction_min_lines,
+        ):
+            self._compact_meta()
+
+
+@dataclass
+class IVFVectorDBStorage(MemmapVectorDBStorage):
+    """Inverted-file ANN index on top of ``MemmapVectorDBStorage``.
+
+    Rows are clustered with spherical k-means into ``n_lists`` lists and a
+    query only scores the rows of its ``n_probe`` closest centroids. Centroids
+    live in ``vdb_<namespace>.ivf.npz`` and the per-row list assignment in
+    ``vdb_<namespace>.ivf.i32``. Until ``min_train_size`` rows exist the index
+    falls back to exact search; it is retrained once the number of rows grows
+    by ``retrain_growth``. All four are read from ``vector_db_storage_cls_kwargs``.
+    """
+
+    n_lists: int = 0  # 0 means sqrt(number of rows) at training time
+    n_probe: int = 8
+    min_train_size: int = 1024
+    retrain_growth: float = 4.0
+    kmeans_iters: int = 10
+
+    def __post_init__(self):
+        kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        for name in (
+            "n_lists",
+            "n_probe",
+            "min_train_size",
+            "retrain_growth",
+            "kmeans_iters",
+        ):
+            setattr(self, name, kwargs.get(name, getattr(self, name)))
+        working_dir = self.global_config["working_dir"]
+        self._centroid_file = os.path.join(working_dir, f"vdb_{self.namespace}.ivf.npz")
+        self._assign_file = os.path.join(working_dir, f"vdb_{self.namespace}.ivf.i32")
+        super().__post_init__()
+        self._centroids = None
+        self._trained_size = 0
+        self._assign: list[int] = []
+        self._lists: list[set[int]] = []
+        self._train_task = None
+        self._load_ivf()
+
+    def _load_ivf(self):
+        if not os.path.exists(self._centroid_file):
+            return
+        with np.load(self._centroid_file) as f:
+            centroids, trained_size = f["centroids"], int(f["trained_size"])
+        assign = (
+            np.fromfile(self._assign_file, dtype=np.int32)[: len(self._ids)].tolist()
+            if os.path.exists(self._assign_file)
+            else []
+        )
+        self._set_index(centroids, trained_size, assign)
+        missing = list(range(len(assign), len(self._ids)))
+        if missing:
+            logger.info(f"Assigning {len(missing)} unindexed rows in {self.namespace}")
+            self._assign_rows(missing, self._decode(self._matrix[missing]))
+
+    def _set_index(self, centroids: np.ndarray, trained_size: int, assign: list[int]):
+        self._centroids = centroids
+        self._trained_size = trained_size
+        self._assign = assign
+        self._lists = [set() for _ in range(len(centroids))]
+        self._list_arrays: dict[int, np.ndarray] = {}
+        for row, list_id in enumerate(assign):
+            if self._ids[row] is not None:
+                self._lists[list_id].add(row)
+        if hasattr(self, "_assign_fh"):
+            self._assign_fh.close()
+        if not os.path.exists(self._assign_file):
+            open(self._assign_file, "wb").close()
+        self._assign_fh = open(self._assign_file, "r+b")
+
+    def _list_rows(self, list_id: int) -> np.ndarray:
+        if list_id not in self._list_arrays:
+            self._list_arrays[list_id] = np.fromiter(
+                self._lists[list_id], dtype=np.int64, count=len(self._lists[list_id])
+            )
+        return self._list_arrays[list_id]
+
+    def _assign_rows(self, rows: list[int], vectors: np.ndarray):
+        list_ids = np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+        for row, list_id in zip(rows, list_ids.tolist()):
+            if row < len(self._assign):
+                self._lists[self._assign[row]].discard(row)
+                self._list_arrays.pop(self._assign[row], None)
+            else:
+                self._assign.extend([0] * (row + 1 - len(self._assign)))
+            self._assign[row] = list_id
+            self._lists[list_id].add(row)
+            self._list_arrays.pop(list_id, None)
+            self._assign_fh.seek(row * 4)
+            self._assign_fh.write(np.int32(list_id).tobytes())
+        self._assign_fh.flush()
+
+    def _write_rows(self, ids: list[str], metas: list[dict], vectors: np.ndarray):
+        super()._write_rows(ids, metas, vectors)
+        if self._written_while_training is not None:
+            self._written_while_training.update(self._rows[id] for id in ids)
+        if self._centroids is not None:
+            self._assign_rows([self._rows[id] for id in ids], vectors)
+
+    def _delete(self, ids: list[str]):
+        if self._centroids is not None:
+            for id in ids:
+                if id in self._rows:
+                    row = self._rows[id]
+                    self._lists[self._assign[row]].discard(row)
+                    self._list_arrays.pop(self._assign[row], None)
+        super()._delete(ids)
+
+    def _train(self, matrix: np.ndarray, live_rows: np.ndarray):
+        """Spherical k-means over a sample of the live rows, then assign all rows.
+
+        Runs in a worker thread, so it only reads the snapshot it is given.
+        """
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(live_rows))))
+        rng = np.random.default_rng(0)
+        sample = np.sort(
+            rng.choice(live_rows, min(len(live_rows), 256 * n_lists), replace=False)
+        )
+        sample_vectors = self._decode(matrix[sample])
+        centroids = sample_vectors[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(self.kmeans_iters):
+            labels = np.argmax(sample_vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample_vectors)
+            empty = ~np.any(sums, axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize_embeddings(sums)
+
+        assign = np.zeros(len(matrix), dtype=np.int32)
+        for start in range(0, len(matrix), 65536):
+            block = self._decode(matrix[start : start + 65536])
+            assign[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return centroids, len(live_rows), assign
+
+    def _needs_training(self) -> bool:
+        if len(self._rows) < self.min_train_size:
+            return False
+        return (
+            self._centroids is None
+            or len(self._rows) >= self._trained_size * self.retrain_growth
+        )
+
+    async def _retrain(self):
+        self._written_while_training = set()
+        live_rows = np.array(sorted(self._rows.values()))
+        try:
+            centroids, trained_size, assign = await run_blocking(
+                None, self._train, self._matrix, live_rows
+            )
+        finally:
+            written, self._written_while_training = self._written_while_training, None
+        write_bytes_atomic(assign.tobytes(), self._assign_file)
+        with open(self._centroid_file + ".tmp", "wb") as f:
+            np.savez(f, centroids=centroids, trained_size=trained_size)
+        os.replace(self._centroid_file + ".tmp", self._centroid_file)
+        self._set_index(centroids, trained_size, assign.tolist())
+        # searches now go through the index and can return other neighbours
+        self.index_generation += 1
+        # rows upserted while the worker thread was training
+        rows = sorted(written | set(range(len(assign), len(self._ids))))
+        if rows:
+            self._assign_rows(rows, self._decode(self._matrix[rows]))
+        logger.info(
+            f"Trained IVF index for {self.namespace} with {len(centroids)} lists "
+            f"on {trained_size} vectors"
+        )
+
+    def _search_many(self, embeddings: np.ndarray, top_k: int) -> list[list[dict]]:
+        if self._centroids is None:
+            return super()._search_many(embeddings, top_k)
+        return [self._search(embedding, top_k) for embedding in embeddings]
+
+    def _search(self, embedding: np.ndarray, top_k: int) -> list[dict]:
+        if self._centroids is None:
+            return super()._search(embedding, top_k)
+        probe = np.argsort(-(self._centroids @ embedding))[: self.n_probe]
+        rows = np.sort(np.concatenate([self._list_rows(i) for i in probe]))
+        if not len(rows):
+            return []
+        return self._rank(self._score(self._matrix[rows], embedding), top_k, rows)
+
+    async def index_done_callback(self):
+        await super().index_done_callback()
+        if self._centroids is not None:
+            os.fsync(self._assign_fh.fileno())
+        if self._needs_training() and (
+            self._train_task is None or self._train_task.done()
+        ):
+            self._train_task = asyncio.create_task(self._retrain())
+            self._train_task.add_done_callback(self._log_train_failure)
+
+
+@dataclass
+class QuantizedVectorDBStorage(MemmapVectorDBStorage):
+    """``MemmapVectorDBStorage`` that stores and searches compressed codes.
+
+    ``quantization`` (read from ``vector_db_storage_cls_kwargs``) selects the
+    row encoding in ``vdb_<namespace>.<quantization>``:
+
+    - ``"float16"``: half precision, 2x smaller
+    - ``"int8"``: int8 codes plus a float32 scale per vector, ~4x smaller
+    - ``"pq"``: product quantization with ``pq_subspaces`` uint8 codes per
+      vector, scored with per-query lookup tables. The codebooks are trained
+      on a sample of ``pq_train_sample`` vectors once ``pq_train_size``
+      vectors exist; until then search is exact.
+
+    With ``rescore_candidates > 0`` the float32 vectors are kept in
+    ``vdb_<namespace>.f32`` and the best candidates by code score are
+    re-scored exactly before taking ``top_k``.
+    """
+
+    quantization: str = "int8"
+    rescore_candidates: int = 0
+    pq_subspaces: int = 64
+    pq_train_size: int = 4096
+    pq_train_sample: int = 256 * 64
+    kmeans_iters: int = 10
+
+    _score_block_rows = 16384
+
+    def __post_init__(self):
+        kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        for name in (
+            "quantization",
+            "rescore_candidates",
+            "pq_subspaces",
+            "pq_train_size",
+            "pq_train_sample",
+            "kmeans_iters",
+        ):
+            setattr(self, name, kwargs.get(name, getattr(self, name)))
+        if self.quantization not in ("float16", "int8", "pq"):
+            raise ValueError(f"Unknown quantization {self.quantization}")
+        if (
+            self.quantization == "pq"
+            and self.embedding_func.embedding_dim % self.pq_subspaces
+        ):
+            raise ValueError(
+                f"embedding_dim {self.embedding_func.embedding_dim} is not divisible "
+                f"by pq_subspaces {self.pq_subspaces}"
+            )
+        self._vector_suffix = self.quantization
+        working_dir = self.global_config["working_dir"]
+        self._float_file = os.path.join(working_dir, f"vdb_{self.namespace}.f32")
+        self._codebook_file = os.path.join(working_dir, f"vdb_{self.namespace}.pq.npy")
+        self._codebook = (
+            np.load(self._codebook_file)
+            if self.quantization == "pq" and os.path.exists(self._codebook_file)
+            else None
+        )
+        self._keep_float = self.rescore_candidates > 0 or (
+            self.quantization == "pq" and self._codebook is None
+        )
+        self._float_fh = None
+        self._float_matrix = None
+        self._train_task = None
+        super().__post_init__()
+
+        if self._keep_float:
+            if not os.path.exists(self._float_file):
+                open(self._float_file, "wb").close()
+            float_rows = os.path.getsize(self._float_file) // (self._dim * 4)
+            if float_rows < len(self._ids):
+                logger.warning(
+                    f"{self._float_file} only has {float_rows} of {len(self._ids)} "
+                    "rows, exact re-scoring is disabled"
+                )
+                self._keep_float = False
+                self.rescore_candidates = 0
+            else:
+                self._float_fh = open(self._float_file, "r+b")
+                self._float_fh.truncate(len(self._ids) * self._dim * 4)
+                self._open_matrix()
+
+    def _row_dtype(self):
+        return {"float16": np.float16, "int8": np.int8, "pq": np.uint8}[
+            self.quantization
+        ]
+
+    def _row_width(self) -> int:
+        if self.quantization == "int8":
+            return self._dim + 4  # codes followed by the float32 scale
+        if self.quantization == "pq":
+            return self.pq_subspaces
+        return self._dim
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.quantization == "float16":
+            return vectors.astype(np.float16)
+        if self.quantization == "int8":
+            scale = np.maximum(
+                np.abs(vectors).max(axis=1, keepdims=True) / 127,
+                np.finfo(np.float32).tiny,
+            ).astype(np.float32)
+            codes = np.round(vectors / scale).astype(np.int8)
+            return np.concatenate([codes, scale.view(np.int8)], axis=1)
+        if self._codebook is None:
+            return np.zeros((len(vectors), self.pq_subspaces), dtype=np.uint8)
+        return self._pq_encode(vectors, self._codebook)
+
+    def _decode(self, block: np.ndarray) -> np.ndarray:
+        if self.quantization == "float16":
+            return np.asarray(block, dtype=np.float32)
+        if self.quantization == "int8":
+            block = np.asarray(block)
+            return block[:, : self._dim].astype(np.float32) * block[
+                :, self._dim :
+            ].view(np.float32)
+        block = np.asarray(block)
+        return self._codebook[np.arange(self.pq_subspaces), block].reshape(
+            len(block), self._dim
+        )
+
+    def _score(self, block: np.ndarray, embedding: np.ndarray) -> np.ndarray:
+        if len(block) > self._score_block_rows:
+            return np.concatenate(
+                [
+                    self._score(block[i : i + self._score_block_rows], embedding)
+                    for i in range(0, len(block), self._score_block_rows)
+                ]
+            )
+        block = np.asarray(block)
+        if self.quantization == "float16":
+            return block.astype(np.float32) @ embedding
+        if self.quantization == "int8":
+            scale = block[:, self._dim :].view(np.float32)[:, 0]
+            return (block[:, : self._dim].astype(np.float32) @ embedding) * scale
+        table = np.einsum(
+            "mkd,md->mk",
+            self._codebook,
+            embedding.reshape(self.pq_subspaces, -1),
+        )
+        return table[np.arange(self.pq_subspaces), block].sum(axis=1)
+
+    @staticmethod
+    def _pq_encode(vectors: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+        n_sub = len(codebook)
+        sub = vectors.reshape(len(vectors), n_sub, -1)
+        half_norms = 0.5 * np.einsum("mkd,mkd->mk", codebook, codebook)
+        return np.argmax(
+            np.einsum("nmd,mkd->nmk", sub, codebook) - half_norms, axis=2
+        ).astype(np.uint8)
+
+    def _open_matrix(self):
+        super()._open_matrix()
+        if self._float_fh is None:
+            return
+        n = len(self._ids)
+        self._float_matrix = (
+            np.memmap(
+                self._float_file, dtype=np.float32, mode="r", shape=(n, self._dim)
+            )
+            if n
+            else np.zeros((0, self._dim), dtype=np.float32)
+        )
+
+    def _write_rows(self, ids: list[str], metas: list[dict], vectors: np.ndarray):
+        rows, n_new = self._allocate_rows(ids)
+        if self._float_fh is not None:
+            self._write_block(self._float_fh, rows, vectors)
+        self._write_block(self._vector_fh, rows, self._encode(vectors))
+        self._commit_rows(ids, metas, rows, n_new)
+        if self._written_while_training is not None:
+            self._written_while_training.update(rows)
+
+    def _search_many(self, embeddings: np.ndarray, top_k: int) -> list[list[dict]]:
+        return [self._search(embedding, top_k) for embedding in embeddings]
+
+    def _search(self, embedding: np.ndarray, top_k: int) -> list[dict]:
+        if not len(self._rows):
+            return []
+        if self.quantization == "pq" and self._codebook is None:
+            return self._rank(self._float_matrix @ embedding, top_k)
+        if not self.rescore_candidates:
+            return self._rank(self._score(self._matrix, embedding), top_k)
+        candidates = self._rank(
+            self._score(self._matrix, embedding),
+            max(self.rescore_candidates, top_k),
+        )
+        rows = np.array(sorted(self._rows[r["id"]] for r in candidates), dtype=np.int64)
+        if not len(rows):
+            return []
+        return self._rank(self._float_matrix[rows] @ embedding, top_k, rows)
+
+    def _train_pq(self, float_matrix: np.ndarray, live_rows: np.ndarray):
+        """k-means with 256 centroids per subspace, then encode every row.
+
+        Runs in a worker thread, so it only reads the snapshot it is given.
+        """
+        n = len(float_matrix)
+        n_sub, dim_sub = self.pq_subspaces, self._dim // self.pq_subspaces
+        rng = np.random.default_rng(0)
+        sample = np.sort(
+            rng.choice(
+                live_rows, min(len(live_rows), self.pq_train_sample), replace=False
+            )
+        )
+        sample_vectors = np.asarray(float_matrix[sample]).reshape(
+            len(sample), n_sub, dim_sub
+        )
+        n_centroids = min(256, len(sample))
+        codebook = np.empty((n_sub, 256, dim_sub), dtype=np.float32)
+        for j in range(n_sub):
+            x = sample_vectors[:, j]
+            centroids = x[rng.choice(len(x), n_centroids, replace=False)]
+            for _ in range(self.kmeans_iters):
+                labels = np.argmax(
+                    x @ centroids.T - 0.5 * np.sum(centroids**2, axis=1), axis=1
+                )
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, x)
+                counts = np.bincount(labels, minlength=n_centroids)[:, None]
+                centroids = np.where(
+                    counts > 0, sums / np.maximum(counts, 1), centroids
+                )
+            codebook[j, :n_centroids] = centroids
+            # unused slots never win the argmax in _pq_encode
+            codebook[j, n_centroids:] = 1e6
+
+        codes = np.empty((n, n_sub), dtype=np.uint8)
+        for start in range(0, n, 4096):
+            codes[start : start + 4096] = self._pq_encode(
+                np.asarray(float_matrix[start : start + 4096]), codebook
+            )
+        return codebook, codes
+
+    async def _train(self):
+        self._written_while_training = set()
+        live_rows = np.array(sorted(self._rows.values()))
+        try:
+            codebook, codes = await run_blocking(
+                None, self._train_pq, self._float_matrix, live_rows
+            )
+        finally:
+            written, self._written_while_training = self._written_while_training, None
+        # rows upserted while the worker thread was training get codes too
+        n, trained = len(self._ids), len(codes)
+        codes = np.concatenate(
+            [codes, np.zeros((n - trained, self.pq_subspaces), dtype=np.uint8)]
+        )
+        rows = sorted(written | set(range(trained, n)))
+        if rows:
+            codes[rows] = self._pq_encode(
+                np.asarray(self._float_matrix[rows]), codebook
+            )
+        # vectors before the codebook: placeholder codes are never read as PQ
+        write_bytes_atomic(codes.tobytes(), self._vector_file)
+        with open(self._codebook_file + ".tmp", "wb") as f:
+            np.save(f, codebook)
+        os.replace(self._codebook_file + ".tmp", self._codebook_file)
+        self._vector_fh.close()
+        self._vector_fh = open(self._vector_file, "r+b")
+        self._codebook = codebook
+        self._open_matrix()
+        # scores now come from the PQ codes
+        self.index_generation += 1
+        if not self.rescore_candidates:
+            self._float_fh.close()
+            self._float_fh, self._float_matrix = None, None
+            self._keep_float = False
+            os.remove(self._float_file)
+        logger.info(
+            f"Trained PQ codebook for {self.namespace} with {self.pq_subspaces} "
+            f"subspaces on {trained} vectors"
+        )
+
+    async def index_done_callback(self):
+        await super().index_done_callback()
+        if self._float_fh is not None:
+            await run_blocking(None, os.fsync, self._float_fh.fileno())
+        if (
+            self.quantization == "pq"
+            and self._codebook is None
+            and len(self._rows) >= self.pq_train_size
+            and (self._train_task is None or self._train_task.done())
+        ):
+            self._train_task = asyncio.create_task(self._train())
+            self._train_task.add_done_callback(self._log_train_failure)
+
+
+@dataclass
+class SemanticResponseCache:
+    """Answers of past questions, looked up by question similarity.
+
+    Entries live in their own vector namespace: the question is embedded and
+    stored with the answer, its creation time and a fingerprint of what the
+    answer depended on (retrieved chunks, model, response type). A lookup only
+    returns answers with the same fingerprint whose similarity reaches
+    ``similarity_threshold``. Past ``max_entries`` the least recently used
+    entries are evicted; entries older than ``ttl`` seconds are ignored and
+    evicted on the next insert.
+    """
+
+    vdb: BaseVectorStorage
+    similarity_threshold: float = 0.95
+    max_entries: int = 10000
+    ttl: float = None
+    candidates: int = 5
+
+    def __post_init__(self):
+        # id -> creation time, least recently used first; loaded on first use
+        self._entries: OrderedDict[str, float] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def _load(self):
+        if self._entries is None:
+            items = await self.vdb.all_items()
+            self._entries = OrderedDict(
+                (item["id"], item["created"])
+                for item in sorted(items, key=lambda item: item["created"])
+            )
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    async def get(self, question: str, fingerprint: str) -> Union[str, None]:
+        await self._load()
+        if self._entries:
+            for result in await self.vdb.query(question, top_k=self.candidates):
+                if result["distance"] < self.similarity_threshold:
+                    break
+                if (
+                    result["fingerprint"] == fingerprint
+                    and result["id"] in self._entries
+                    and not self._expired(result["created"])
+                ):
+                    self._entries.move_to_end(result["id"])
+                    self.hits += 1
+                    return result["response"]
+        self.misses += 1
+        return None
+
+    async def put(self, question: str, fingerprint: str, response: str):
+        await self._load()
+        id = compute_mdhash_id(question + fingerprint, prefix="llm-")
+        created = time.time()
+        await self.vdb.upsert(
+            {
+                id: {
+                    "content": question,
+                    "fingerprint": fingerprint,
+                    "response": response,
+                    "created": created,
+                }
+            }
+        )
+        self._entries.pop(id, None)
+        self._entries[id] = created
+        evict = [id for id, created in self._entries.items() if self._expired(created)]
+        for id in evict:
+            del self._entries[id]
+        while len(self._entries) > self.max_entries:
+            evict.append(self._entries.popitem(last=False)[0])
+        if evict:
+            await self.vdb.delete(evict)
+            self.evictions += len(evict)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries or ()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def index_done_callback(self):
+        await self.vdb.index_done_callback()
+
+
+class StorageFlusher:
+    """Coalesces the commits (``index_done_callback``) of a set of storages.
+
+    ``storages`` returns the storages to manage in commit order, so ones
+    opened later are picked up. ``schedule()`` is called after writes. Dirty
+    storages are committed ``interval`` seconds after they became dirty, or
+    right away once their dirty bytes reach ``max_dirty_bytes`` (or when
+    ``interval`` is 0). Commits are serialized and clean storages are skipped.
+
+    The delayed commit is a timer on the running loop; call ``detach()``
+    before that loop stops, and pending changes wait for the next
+    ``schedule()``, ``flush()`` or ``close()``.
+    """
+
+    def __init__(
+        self,
+        storages: Callable[[], list[StorageNameSpace]],
+        interval: float = 5.0,
+        max_dirty_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.storages = storages
+        self.interval = interval
+        self.max_dirty_bytes = max_dirty_bytes
+        self._lock = asyncio.Lock()
+        self._dirty_since: float = None
+        self._timer: asyncio.TimerHandle = None
+        self._timer_loop: asyncio.AbstractEventLoop = None
+        self._task: asyncio.Task = None
+        self.flushes = 0
+
+    def dirty_bytes(self) -> int:
+        return sum(s.dirty_bytes for s in self.storages())
+
+    async def flush(self, storages: list[StorageNameSpace] = None):
+        """Commit the dirty ones of storages (all by default), in order"""
+        async with self._lock:
+            if storages is None:
+                self._dirty_since = None
+            for storage in storages or self.storages():
+                if storage is None or not storage.dirty_bytes:
+                    continue
+                nbytes, storage.dirty_bytes = storage.dirty_bytes, 0
+                try:
+                    await storage.index_done_callback()
+                except BaseException:
+                    storage.mark_dirty(nbytes)
+                    raise
+                self.flushes += 1
+
+    async def schedule(self):
+        if not self.dirty_bytes():
+            return
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        delay = self._dirty_since + self.interval - now
+        if delay <= 0 or self.dirty_bytes() >= self.max_dirty_bytes:
+            self._cancel_timer()
+            await self.flush()
+        elif self._timer is None or self._timer_loop is not asyncio.get_running_loop():
+            # a timer left on a loop that stopped without detach() never fires
+            self._cancel_timer()
+            self._timer_loop = asyncio.get_running_loop()
+            self._timer = self._timer_loop.call_later(delay, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.flush())
+            self._task.add_done_callback(self._log_failure)
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Scheduled commit failed: {task.exception()!r}")
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def detach(self):
+        """Drop the timer and finish a running commit, before the loop stops"""
+        self._cancel_timer()
+        task, self._task = self._task, None
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            # a failure was already logged by the task
+            await asyncio.wait([task])
+
+    async def close(self):
+        await self.detach()
+        await self.flush()
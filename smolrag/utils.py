@@ -1,19 +1,22 @@
 import asyncio
 import json
 import os
+import re
+import time
 import logging
 import tiktoken
 import numpy as np
 
-import pandas as pd
-from openai import APIStatusError, AsyncOpenAI, BadRequestError
 from .prompts import describe_code_prompt
 
-from functools import wraps
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import AsyncIterator
+from functools import partial, wraps
 from dataclasses import dataclass
 from hashlib import md5
 
-ENCODER = None
+TOKENIZERS = {}
 
 logger = logging.getLogger("smolrag")
 
@@ -33,26 +36,281 @@ def set_logger(log_file: str):
         logger.addHandler(file_handler)
 
 
-def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
-    """Add restriction of maximum async calling times for a async func"""
+# executors stop taking work before atexit hooks run, so blocking calls made
+# while closing at interpreter exit run inline instead
+_run_blocking_inline = False
 
-    def final_decro(func):
-        """Not using async.Semaphore to aovid use nest-asyncio"""
-        __current_size = 0
 
+@contextmanager
+def blocking_calls_inline():
+    global _run_blocking_inline
+    _run_blocking_inline = True
+    try:
+        yield
+    finally:
+        _run_blocking_inline = False
+
+
+async def run_blocking(executor, func, *args):
+    """Run func(*args) in executor (the default one if None)"""
+    if _run_blocking_inline:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+class FifoSemaphore:
+    """Semaphore that hands a released slot to the longest waiting caller.
+
+    Futures are created on the running loop at acquire time, so the semaphore
+    can be built outside of any event loop.
+    """
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for fut in self._waiters if not fut.done())
+
+    async def acquire(self):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release()
+            elif fut in self._waiters:
+                # release() may already have popped the cancelled future
+                self._waiters.remove(fut)
+            raise
+
+    def release(self):
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._value += 1
+
+
+class TokenBucket:
+    """Refills per_minute units per minute, holding at most one minute's worth"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    async def take(self, amount: float):
+        # a request larger than the bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AsyncLimiter:
+    """Concurrency limit plus optional requests/tokens-per-minute budgets.
+
+    Callers are admitted in FIFO order: they first wait for the rate buckets
+    (one at a time, so the order holds), then for a concurrency slot. The slot
+    is released however the call ends.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        token_counter: callable = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self._semaphore = FifoSemaphore(max_concurrency)
+        self._rate_lock = asyncio.Lock()
+        self._request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self._token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self._token_counter = token_counter
+        self.in_flight = 0
+        self.rate_waiting = 0
+        self.calls = 0
+        self.failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.rate_waiting + self._semaphore.waiting,
+            "calls": self.calls,
+            "failures": self.failures,
+            "avg_wait": self.total_wait / self.calls if self.calls else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def _wait_for_rate(self, args, kwargs):
+        if self._request_bucket is None and self._token_bucket is None:
+            return
+        self.rate_waiting += 1
+        try:
+            async with self._rate_lock:
+                if self._request_bucket is not None:
+                    await self._request_bucket.take(1)
+                if self._token_bucket is not None and self._token_counter is not None:
+                    await self._token_bucket.take(self._token_counter(*args, **kwargs))
+        finally:
+            self.rate_waiting -= 1
+
+    def __call__(self, func):
         @wraps(func)
         async def wait_func(*args, **kwargs):
-            nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
-            result = await func(*args, **kwargs)
-            __current_size -= 1
+            start = time.monotonic()
+            await self._wait_for_rate(args, kwargs)
+            await self._semaphore.acquire()
+            waited = time.monotonic() - start
+            self.calls += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.in_flight += 1
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException:
+                self.failures += 1
+                self._release()
+                raise
+            if isinstance(result, AsyncIterator):
+                # a stream is generated as it is read, so it keeps the slot
+                return _LimitedStream(self, result)
+            self._release()
             return result
 
+        wait_func.limiter = self
         return wait_func
 
-    return final_decro
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+class _LimitedStream:
+    """Holds its limiter slot until the stream is exhausted, fails or is
+    closed (or garbage collected, if the caller just drops it)"""
+
+    def __init__(self, limiter: AsyncLimiter, stream: AsyncIterator):
+        self._limiter = limiter
+        self._stream = stream
+        self._held = True
+
+    def _release(self):
+        if self._held:
+            self._held = False
+            self._limiter._release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._release()
+            raise
+        except BaseException:
+            if self._held:
+                self._limiter.failures += 1
+            self._release()
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self._stream, "aclose"):
+                await self._stream.aclose()
+        finally:
+            self._release()
+
+    def __del__(self):
+        self._release()
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key
+    await the running call instead of starting their own.
+
+    The call runs as a task shielded from its callers, so a caller giving up
+    does not cancel the work others are waiting for.
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, func, *args, **kwargs):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(partial(self._done, key))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # every caller may have left; don't warn about an unretrieved error
+            task.exception()
+
+
+def limit_async_func_call(
+    max_size: int,
+    requests_per_minute: float = None,
+    tokens_per_minute: float = None,
+    token_counter: callable = None,
+):
+    """Add restriction of maximum async calling times for a async func.
+
+    The wrapped function exposes its AsyncLimiter as ``.limiter``.
+    """
+    return AsyncLimiter(
+        max_size,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        token_counter=token_counter,
+    )
+
+
+def count_embedding_tokens(texts: list[str], *args, model_name="gpt-4o", **kwargs):
+    return sum(len(encode_string_by_tiktoken(t, model_name)) for t in texts)
+
+
+def count_llm_tokens(
+    prompt,
+    system_prompt=None,
+    history_messages=[],
+    *args,
+    model_name="gpt-4o",
+    **kwargs,
+):
+    contents = [prompt, system_prompt or ""] + [m["content"] for m in history_messages]
+    return sum(len(encode_string_by_tiktoken(c, model_name)) for c in contents)
 
 
 @dataclass
@@ -60,11 +318,154 @@ class EmbeddingFunc:
     embedding_dim: int
     max_token_size: int
     func: callable
+    # identifies the model in persistent caches; set it when switching models
+    model_name: str = ""
+    # server limit on the total tokens of one request, None for no limit
+    max_batch_tokens: int = None
 
     async def __call__(self, *args, **kwargs) -> np.ndarray:
         return await self.func(*args, **kwargs)
 
 
+@dataclass
+class CachedEmbeddingFunc(EmbeddingFunc):
+    """EmbeddingFunc that only sends texts it has not embedded before to func.
+
+    Vectors are keyed by the md5 of the effective model (a call-time ``model=``
+    overrides ``model_name``, which is required) and the text, and stored in
+    ``cache_dir`` as ``embedding_cache_<model>_<dim>.keys`` (16-byte digests)
+    plus ``.f32`` (raw float32 rows), both append-only. Up to
+    ``max_memory_items`` vectors are kept in an in-memory LRU; older ones are
+    read back through ``np.memmap``.
+    """
+
+    cache_dir: str = "."
+    max_memory_items: int = 10000
+
+    def __post_init__(self):
+        if not self.model_name:
+            raise ValueError(
+                "CachedEmbeddingFunc needs a model_name, otherwise vectors of "
+                "different models would share cache entries"
+            )
+        slug = re.sub(r"[^0-9A-Za-z.-]+", "-", self.model_name).strip("-")
+        base_name = os.path.join(
+            self.cache_dir, f"embedding_cache_{slug}_{self.embedding_dim}"
+        )
+        self._key_file, self._vector_file = base_name + ".keys", base_name + ".f32"
+        self._row_bytes = self.embedding_dim * 4
+        # the files are opened and indexed on the first call, see _open
+        self._rows: dict[bytes, int] = None
+        self._memory: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._matrix = None
+        self._inflight: dict[bytes, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _open(self):
+        n_rows = 0
+        if os.path.exists(self._key_file) and os.path.exists(self._vector_file):
+            n_rows = min(
+                os.path.getsize(self._key_file) // 16,
+                os.path.getsize(self._vector_file) // self._row_bytes,
+            )
+        with open(self._key_file, "ab") as f:
+            f.truncate(n_rows * 16)
+        with open(self._vector_file, "ab") as f:
+            f.truncate(n_rows * self._row_bytes)
+        with open(self._key_file, "rb") as f:
+            keys = f.read()
+        self._rows = {keys[i * 16 : (i + 1) * 16]: i for i in range(n_rows)}
+        logger.info(f"Load embedding cache {self._key_file} with {n_rows} vectors")
+
+    def _lookup(self, key: bytes):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        if self._matrix is None or row >= len(self._matrix):
+            self._matrix = np.memmap(
+                self._vector_file,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self._rows), self.embedding_dim),
+            )
+        vector = np.array(self._matrix[row])
+        self._remember(key, vector)
+        return vector
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _store(self, keys: list[bytes], vectors: np.ndarray):
+        # vectors first: a key without its vector is dropped on the next open
+        with open(self._vector_file, "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self._key_file, "ab") as f:
+            f.write(b"".join(keys))
+        for key, vector in zip(keys, vectors):
+            self._rows[key] = len(self._rows)
+            self._remember(key, vector)
+
+    async def __call__(self, texts: list[str], *args, **kwargs) -> np.ndarray:
+        if self._rows is None:
+            self._open()
+        model = (kwargs.get("model") or self.model_name).encode() + b"\0"
+        keys = [md5(model + text.encode()).digest() for text in texts]
+        found = {key: self._lookup(key) for key in set(keys)}
+        missing = {key: text for key, text in zip(keys, texts) if found[key] is None}
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        # texts another call is already embedding are awaited, not sent again
+        shared = {key: self._inflight[key] for key in missing if key in self._inflight}
+        self.coalesced += len(shared)
+        own = {key: text for key, text in missing.items() if key not in shared}
+        if own:
+            found.update(await self._embed(own, *args, **kwargs))
+        for key, future in shared.items():
+            try:
+                found[key] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the owning call was cancelled, embed it ourselves
+                found[key] = (await self([missing[key]], *args, **kwargs))[0]
+        return np.stack([found[key] for key in keys])
+
+    async def _embed(self, texts: dict[bytes, str], *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in texts}
+        self._inflight.update(futures)
+        try:
+            vectors = np.asarray(
+                await self.func(list(texts.values()), *args, **kwargs),
+                dtype=np.float32,
+            )
+            # another call may have stored some of these while we awaited
+            new_keys = [key for key in texts if key not in self._rows]
+            new_vectors = vectors[[key not in self._rows for key in texts]]
+            self._store(new_keys, new_vectors)
+            for future, vector in zip(futures.values(), vectors):
+                future.set_result(vector)
+            return dict(zip(texts.keys(), vectors))
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+                future.exception()
+            raise
+        finally:
+            for key, future in futures.items():
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+                future.cancel()
+
+
 def wrap_embedding_func_with_attrs(**kwargs):
     """Wrap a function with attributes"""
 
@@ -87,6 +488,23 @@ def write_json(json_obj, file_name):
         json.dump(json_obj, f, indent=2, ensure_ascii=False)
 
 
+def write_bytes_atomic(data: bytes, file_name):
+    """Write to a temp file, fsync, then rename over file_name"""
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file_name)
+
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """L2-normalize rows as float32 so a dot product is the cosine similarity"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
 def compute_args_hash(*args):
     return md5(str(args).encode()).hexdigest()
 
@@ -95,20 +513,165 @@ def compute_mdhash_id(content, prefix: str = ""):
     return prefix + md5(content.encode()).hexdigest()
 
 
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
+
+@dataclass
+class RetrievalCache:
+    """LRU of vector search results (chunk ids and scores) per normalized
+    query and top_k. Entries are stamped with the index generation they were
+    computed at and only served while the index is still at it."""
+
+    max_items: int = 4096
+
+    def __post_init__(self):
+        self._entries: OrderedDict[tuple, tuple[int, list[dict]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query: str, top_k: int, generation: int):
+        key = (normalize_query(query), top_k)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, query: str, top_k: int, generation: int, results: list[dict]):
+        key = (normalize_query(query), top_k)
+        self._entries[key] = (
+            generation,
+            [{"id": r["id"], "distance": r["distance"]} for r in results],
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+
+class StopSequenceFilter:
+    """Cuts a stream of text deltas at the first stop sequence.
+
+    ``feed`` returns the text that is safe to emit: a tail that could still
+    grow into a stop sequence is held back until the next delta or ``flush``.
+    """
+
+    def __init__(self, stop: list[str]):
+        self.stop = [s for s in stop or [] if s]
+        self.text = ""
+        self.stopped = False
+        self._emitted = 0
+        self._end = None
+
+    def feed(self, delta: str) -> str:
+        if self.stopped:
+            return ""
+        self.text += delta
+        longest = max((len(s) for s in self.stop), default=0)
+        start = max(self._emitted - longest + 1, 0)
+        found = [(i, s) for s in self.stop if (i := self.text.find(s, start)) != -1]
+        if found:
+            index, stop = min(found)
+            self.stopped = True
+            self._end = index + len(stop)
+            return self._emit(index)
+        held = 0
+        for stop in self.stop:
+            for size in range(min(len(stop) - 1, len(self.text)), held, -1):
+                if self.text.endswith(stop[:size]):
+                    held = size
+                    break
+        return self._emit(len(self.text) - held)
+
+    def flush(self) -> str:
+        return "" if self.stopped else self._emit(len(self.text))
+
+    @property
+    def result(self) -> str:
+        """The whole text up to and including the stop sequence"""
+        return self.text if self._end is None else self.text[: self._end]
+
+    def _emit(self, end: int) -> str:
+        out = self.text[self._emitted : end]
+        self._emitted = max(end, self._emitted)
+        return out
+
+
+@dataclass
+class TiktokenTokenizer:
+    encoding: tiktoken.Encoding
+
+    def encode(self, content: str) -> list[int]:
+        return self.encoding.encode(content)
+
+    def decode(self, tokens: list[int]) -> str:
+        return self.encoding.decode(tokens)
+
+    def token_offsets(self, content: str) -> list[int]:
+        """Start character offset of every token of content"""
+        return self.encoding.decode_with_offsets(self.encoding.encode(content))[1]
+
+
+@dataclass
+class HFTokenizer:
+    tokenizer: object
+
+    def encode(self, content: str) -> list[int]:
+        return self.tokenizer.encode(content, add_special_tokens=False)
+
+    def decode(self, tokens: list[int]) -> str:
+        return self.tokenizer.decode(tokens)
+
+    def token_offsets(self, content: str) -> list[int]:
+        encoded = self.tokenizer(
+            content, add_special_tokens=False, return_offsets_mapping=True
+        )
+        return [start for start, _ in encoded["offset_mapping"]]
+
+
+def register_tokenizer(model_name: str, tokenizer):
+    """Use tokenizer for model_name, e.g. the HF tokenizer an LLM is already using"""
+    if not hasattr(tokenizer, "token_offsets"):
+        tokenizer = HFTokenizer(tokenizer)
+    TOKENIZERS[model_name] = tokenizer
+
+
+def get_tokenizer(model_name: str = "gpt-4o"):
+    """Tokenizer for model_name, cached per model.
+
+    Resolves a tiktoken model name, then a tiktoken encoding name, then a
+    Hugging Face tokenizer name or path.
+    """
+    if model_name not in TOKENIZERS:
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = None
+        if encoding is None:
+            try:
+                encoding = tiktoken.get_encoding(model_name)
+            except ValueError:
+                encoding = None
+        if encoding is not None:
+            TOKENIZERS[model_name] = TiktokenTokenizer(encoding)
+        else:
+            from transformers import AutoTokenizer
+
+            register_tokenizer(
+                model_name,
+                AutoTokenizer.from_pretrained(model_name, trust_remote_code=True),
+            )
+    return TOKENIZERS[model_name]
+
+
 def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o"):
-    global ENCODER
-    if ENCODER is None:
-        ENCODER = tiktoken.encoding_for_model(model_name)
-    tokens = ENCODER.encode(content)
-    return tokens
+    return get_tokenizer(model_name).encode(content)
 
 
 def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
-    global ENCODER
-    if ENCODER is None:
-        ENCODER = tiktoken.encoding_for_model(model_name)
-    content = ENCODER.decode(tokens)
-    return content
+    return get_tokenizer(model_name).decode(tokens)
 
 
 def truncate_list_by_token_size(list_data: list, key: callable, max_token_size: int):
@@ -124,6 +687,8 @@ def truncate_list_by_token_size(list_data: list, key: callable, max_token_size:
 
 
 def load_data():
+    import pandas as pd
+
     data = pd.read_csv("data/zt_resource.csv", encoding="utf-8")
     return data
 
@@ -135,6 +700,8 @@ async def process_asset(
     id,
     code,
 ):
+    from openai import APIStatusError, BadRequestError
+
     async with semaphore:
         messages = [
             {"role": "user", "content": prompt.format(code=code)},
@@ -165,6 +732,8 @@ async def tag_scripts(data):
     Args:
         yolo_data (dict): 房间布局yolo数据
     """
+    from openai import AsyncOpenAI
+
     client = AsyncOpenAI(
         api_key="test",
         base_url=f"http://10.3.2.203:8000/v1",
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import argparse
+import torch
+from smolrag.llm import (
+    HFGenerationScheduler,
+    prepare_hf_model,
+    select_torch_device,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Local LLM throughput: fp32 vs bf16 vs dynamic int8"
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=None,
+        help="HF model name or path; a random Qwen2-shaped model if omitted",
+    )
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--prompts", type=int, default=16)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--variants", type=str, nargs="+", default=["fp32", "bf16", "int8"]
+    )
+    args = parser.parse_args()
+    return args
+
+
+def random_model():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+    vocab = {c: i for i, c in enumerate(sorted(pre_tokenizers.ByteLevel.alphabet()))}
+    vocab["<eos>"] = len(vocab)
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="<eos>", pad_token="<eos>"
+    )
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=len(vocab),
+        hidden_size=512,
+        intermediate_size=1536,
+        num_hidden_layers=8,
+        num_attention_heads=8,
+        num_key_value_heads=2,
+        eos_token_id=vocab["<eos>"],
+    )
+    return Qwen2ForCausalLM(config), hf_tokenizer
+
+
+def load(args):
+    if args.model is None:
+        return random_model()
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    hf_tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    if hf_tokenizer.pad_token is None:
+        hf_tokenizer.pad_token = hf_tokenizer.eos_token
+    hf_model = AutoModelForCausalLM.from_pretrained(
+        args.model, torch_dtype=torch.float32, trust_remote_code=True
+    )
+    return hf_model, hf_tokenizer
+
+
+async def run(scheduler, prompts):
+    max_new_tokens = scheduler.max_new_tokens
+    scheduler.max_new_tokens = 1
+    start = time.perf_counter()
+    await scheduler.generate(prompts[0])
+    first_token = time.perf_counter() - start
+    scheduler.max_new_tokens = max_new_tokens
+    start = time.perf_counter()
+    await asyncio.gather(*[scheduler.generate(p) for p in prompts])
+    elapsed = time.perf_counter() - start
+    return first_token, len(prompts) * max_new_tokens / elapsed
+
+
+def main(args):
+    device = select_torch_device(args.device)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    print(f"device {device}, {torch.get_num_threads()} threads")
+    prompts = [
+        f"Question {i}: what does the retrieved context say about topic {i}?"
+        for i in range(args.prompts)
+    ]
+    settings = {
+        "fp32": {},
+        "bf16": {"dtype": "bfloat16"},
+        "int8": {"quantize": "int8"},
+    }
+    baseline = None
+    for variant in args.variants:
+        hf_model, hf_tokenizer = load(args)
+        hf_model = prepare_hf_model(hf_model, device, **settings[variant])
+        # suppress EOS so every variant generates the same number of tokens
+        hf_model.generation_config.min_new_tokens = args.max_new_tokens
+        scheduler = HFGenerationScheduler(
+            hf_model,
+            hf_tokenizer,
+            max_batch_size=args.batch_size,
+            max_new_tokens=args.max_new_tokens,
+            stop=None,
+        )
+        # warm up kernels before timing
+        asyncio.run(run(scheduler, prompts[:1]))
+        first_token, throughput = asyncio.run(run(scheduler, prompts))
+        scheduler.close()
+        baseline = baseline or throughput
+        print(
+            f"{variant:>5}: first token {first_token * 1000:.0f} ms, "
+            f"{throughput:.0f} tokens/s ({throughput / baseline:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main(get_args())
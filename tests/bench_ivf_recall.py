@@ -0,0 +1,79 @@
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+import numpy as np
+from smolrag.storage import IVFVectorDBStorage
+from smolrag.utils import EmbeddingFunc, normalize_embeddings
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="IVF recall@k vs exact search")
+    parser.add_argument("--num", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--n_probe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+    return args
+
+
+def make_data(args, rng):
+    centers = rng.normal(size=(args.clusters, args.dim))
+    labels = rng.integers(0, args.clusters, size=args.num)
+    data = centers[labels] + 1.2 * rng.normal(size=(args.num, args.dim))
+    queries = data[rng.choice(args.num, args.queries, replace=False)]
+    queries = queries + 0.5 * rng.normal(size=queries.shape)
+    return data.astype(np.float32), normalize_embeddings(queries)
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    data, queries = make_data(args, rng)
+
+    async def embed(texts):
+        return data[[int(t) for t in texts]]
+
+    working_dir = tempfile.mkdtemp()
+    storage = IVFVectorDBStorage(
+        namespace="bench",
+        global_config={
+            "working_dir": working_dir,
+            "embedding_batch_num": 4096,
+            "vector_db_storage_cls_kwargs": {"min_train_size": 1},
+        },
+        embedding_func=EmbeddingFunc(
+            embedding_dim=args.dim, max_token_size=8192, func=embed
+        ),
+    )
+    await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(args.num)})
+    start = time.perf_counter()
+    await storage.index_done_callback()
+    await storage._train_task
+    print(
+        f"Trained {len(storage._centroids)} lists on {args.num} x {args.dim} "
+        f"in {time.perf_counter() - start:.2f}s (working dir {working_dir})"
+    )
+
+    start = time.perf_counter()
+    exact = [
+        {r["id"] for r in super(IVFVectorDBStorage, storage)._search(q, args.top_k)}
+        for q in queries
+    ]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"{'n_probe':>8} {'recall@' + str(args.top_k):>10} {'ms/query':>10}")
+    print(f"{'exact':>8} {1.0:>10.3f} {exact_ms:>10.3f}")
+
+    for n_probe in args.n_probe:
+        storage.n_probe = n_probe
+        start = time.perf_counter()
+        approx = [{r["id"] for r in storage._search(q, args.top_k)} for q in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([len(a & e) / len(e) for a, e in zip(approx, exact)])
+        print(f"{n_probe:>8} {recall:>10.3f} {ann_ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(get_args()))
@@ -0,0 +1,78 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from smolrag.storage import embed_in_batches
+from smolrag.utils import EmbeddingFunc, register_tokenizer
+
+
+class CharTokenizer:
+    """One token per character, so tests need no tokenizer download"""
+
+    def encode(self, content):
+        return [ord(c) for c in content]
+
+    def decode(self, tokens):
+        return "".join(chr(t) for t in tokens)
+
+    def token_offsets(self, content):
+        return list(range(len(content)))
+
+
+register_tokenizer("chars", CharTokenizer())
+
+
+def embedding_func(fail=None, **kwargs):
+    batches = []
+
+    async def embed(texts):
+        batches.append(list(texts))
+        if fail is not None and fail(texts):
+            raise fail.error
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+    return EmbeddingFunc(embedding_dim=2, func=embed, **kwargs), batches
+
+
+def test_budget_from_embedding_func():
+    func, batches = embedding_func(max_token_size=10, max_batch_tokens=20)
+    contents = ["x" * n for n in (8, 8, 8, 3, 3)]
+    embeddings = asyncio.run(
+        embed_in_batches(func, contents, 32, tiktoken_model="chars")
+    )
+    assert embeddings[:, 0].tolist() == [8, 8, 8, 3, 3]
+    assert all(sum(map(len, batch)) <= 20 for batch in batches)
+    assert len(batches) == 2
+
+
+def test_truncates_text_over_max_token_size():
+    func, batches = embedding_func(max_token_size=5)
+    embeddings = asyncio.run(
+        embed_in_batches(func, ["abcdefgh", "ab"], 32, tiktoken_model="chars")
+    )
+    assert embeddings[:, 0].tolist() == [5, 2]
+    assert sorted(batches[0]) == ["ab", "abcde"]
+
+
+def test_splits_only_size_errors():
+    def too_big(texts):
+        return len(texts) > 2
+
+    too_big.error = RuntimeError("CUDA out of memory")
+    func, batches = embedding_func(fail=too_big, max_token_size=100)
+    contents = [str(i) for i in range(8)]
+    embeddings = asyncio.run(
+        embed_in_batches(func, contents, 8, tiktoken_model="chars")
+    )
+    assert len(embeddings) == 8
+    assert [len(b) for b in batches] == [8, 4, 4, 2, 2, 2, 2]
+
+    def always(texts):
+        return True
+
+    always.error = ValueError("invalid api key")
+    func, batches = embedding_func(fail=always, max_token_size=100)
+    with pytest.raises(ValueError):
+        asyncio.run(embed_in_batches(func, contents, 8, tiktoken_model="chars"))
+    assert len(batches) == 1
@@ -0,0 +1,63 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from smolrag.utils import CachedEmbeddingFunc
+
+
+def test_cache_keys_include_the_model(tmp_path):
+    calls = []
+
+    async def embed(texts, model="small"):
+        calls.append((model, list(texts)))
+        offset = 0.0 if model == "small" else 100.0
+        return np.array([[len(t) + offset, 1.0] for t in texts])
+
+    async def run():
+        cached = CachedEmbeddingFunc(
+            embedding_dim=2,
+            max_token_size=8192,
+            func=embed,
+            model_name="small",
+            cache_dir=str(tmp_path),
+        )
+        small = await cached(["a", "bb"])
+        large = await cached(["a", "bb"], model="large")
+        assert (large[:, 0] == small[:, 0] + 100).all()
+        assert (await cached(["bb"], model="large"))[0, 0] == 102
+        assert (await cached(["bb"]))[0, 0] == 2
+        assert calls == [("small", ["a", "bb"]), ("large", ["a", "bb"])]
+
+    asyncio.run(run())
+
+
+def test_cache_requires_model_name(tmp_path):
+    async def embed(texts):
+        return np.zeros((len(texts), 2))
+
+    with pytest.raises(ValueError):
+        CachedEmbeddingFunc(
+            embedding_dim=2, max_token_size=8192, func=embed, cache_dir=str(tmp_path)
+        )
+
+
+def test_cache_files_opened_on_first_call(tmp_path):
+    async def embed(texts):
+        return np.array([[len(t), 1.0] for t in texts])
+
+    def open_cache():
+        return CachedEmbeddingFunc(
+            embedding_dim=2,
+            max_token_size=8192,
+            func=embed,
+            model_name="small",
+            cache_dir=str(tmp_path),
+        )
+
+    cached = open_cache()
+    assert list(tmp_path.iterdir()) == []
+    asyncio.run(cached(["a", "bb"]))
+    cached = open_cache()
+    assert (asyncio.run(cached(["bb"])) == [[2, 1]]).all()
+    assert cached.hits == 1 and cached.misses == 0
@@ -0,0 +1,121 @@
+import asyncio
+from dataclasses import dataclass, field
+
+from smolrag.base import StorageNameSpace
+from smolrag.storage import StorageFlusher
+
+
+@dataclass
+class FakeStorage(StorageNameSpace):
+    commits: list = field(default_factory=list)
+
+    async def index_done_callback(self):
+        self.commits.append(self.namespace)
+
+
+def fake_storages(*names):
+    commits = []
+    storages = [FakeStorage(name, {}, commits) for name in names]
+    return storages, commits
+
+
+def test_flush_commits_dirty_storages_in_order():
+    storages, commits = fake_storages("vdb", "chunks", "docs")
+    flusher = StorageFlusher(lambda: storages)
+
+    async def run():
+        storages[2].mark_dirty(10)
+        storages[0].mark_dirty(10)
+        await flusher.flush()
+        assert commits == ["vdb", "docs"]
+        # clean storages are skipped
+        await flusher.flush()
+        assert commits == ["vdb", "docs"]
+        storages[1].mark_dirty()
+        await flusher.flush([storages[2], storages[1]])
+        assert commits == ["vdb", "docs", "chunks"]
+
+    asyncio.run(run())
+    assert flusher.dirty_bytes() == 0 and flusher.flushes == 3
+
+
+def test_failed_commit_stays_dirty():
+    storages, commits = fake_storages("vdb", "docs")
+
+    async def fail():
+        raise OSError("disk full")
+
+    storages[1].index_done_callback = fail
+    flusher = StorageFlusher(lambda: storages)
+
+    async def run():
+        storages[0].mark_dirty(5)
+        storages[1].mark_dirty(7)
+        try:
+            await flusher.flush()
+        except OSError:
+            pass
+        assert commits == ["vdb"]
+        assert storages[1].dirty_bytes == 7
+
+    asyncio.run(run())
+
+
+def test_schedule_debounces_until_interval():
+    storages, commits = fake_storages("vdb", "docs")
+    flusher = StorageFlusher(lambda: storages, interval=0.05)
+
+    async def run():
+        for _ in range(5):
+            storages[0].mark_dirty()
+            storages[1].mark_dirty()
+            await flusher.schedule()
+        assert commits == []
+        await asyncio.sleep(0.1)
+        assert commits == ["vdb", "docs"]
+        # the next write starts a new interval
+        storages[0].mark_dirty()
+        await flusher.schedule()
+        assert commits == ["vdb", "docs"]
+        await asyncio.sleep(0.1)
+        assert commits == ["vdb", "docs", "vdb"]
+
+    asyncio.run(run())
+    assert flusher.flushes == 3
+
+
+def test_schedule_flushes_at_dirty_limit():
+    storages, commits = fake_storages("vdb")
+    flusher = StorageFlusher(lambda: storages, interval=60, max_dirty_bytes=100)
+
+    async def run():
+        storages[0].mark_dirty(60)
+        await flusher.schedule()
+        assert commits == []
+        storages[0].mark_dirty(60)
+        await flusher.schedule()
+        assert commits == ["vdb"]
+        flusher.interval = 0
+        storages[0].mark_dirty()
+        await flusher.schedule()
+        assert commits == ["vdb", "vdb"]
+
+    asyncio.run(run())
+
+
+def test_detach_leaves_nothing_on_the_loop():
+    storages, commits = fake_storages("vdb")
+    flusher = StorageFlusher(lambda: storages, interval=0.01)
+    loop = asyncio.new_event_loop()
+    try:
+        storages[0].mark_dirty()
+        loop.run_until_complete(flusher.schedule())
+        loop.run_until_complete(flusher.detach())
+        loop.run_until_complete(asyncio.sleep(0.02))
+        assert not asyncio.all_tasks(loop)
+        # the timer is gone, the changes are pending until the next schedule
+        assert commits == [] and flusher.dirty_bytes() == 1
+        loop.run_until_complete(flusher.schedule())
+        assert commits == ["vdb"]
+    finally:
+        loop.close()
@@ -0,0 +1,176 @@
+import asyncio
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from smolrag import llm
+from smolrag.llm import HFGenerationScheduler, close_hf_schedulers, get_hf_scheduler
+
+
+def tiny_model():
+    # a byte-level tokenizer and a random 2-layer GPT-2, nothing is downloaded
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    vocab = {c: i for i, c in enumerate(sorted(pre_tokenizers.ByteLevel.alphabet()))}
+    vocab["<eos>"] = len(vocab)
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="<eos>", pad_token="<eos>"
+    )
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(vocab),
+        n_positions=256,
+        n_embd=32,
+        n_layer=2,
+        n_head=2,
+        initializer_range=2.0,
+        eos_token_id=vocab["<eos>"],
+        bos_token_id=vocab["<eos>"],
+    )
+    return GPT2LMHeadModel(config).eval(), hf_tokenizer
+
+
+PROMPTS = [f"question {i} " * (i % 4 + 1) for i in range(12)]
+
+
+async def generate_all(scheduler, prompts=PROMPTS):
+    try:
+        return await asyncio.gather(*[scheduler.generate(p) for p in prompts])
+    finally:
+        scheduler.close()
+
+
+def test_batched_matches_unbatched():
+    model, tokenizer = tiny_model()
+    batched = HFGenerationScheduler(model, tokenizer, 8, 0.05, max_new_tokens=20)
+    single = HFGenerationScheduler(model, tokenizer, 1, 0, max_new_tokens=20)
+    outputs = asyncio.run(generate_all(batched))
+    assert outputs == asyncio.run(generate_all(single))
+    assert batched.batches == 2 and batched.sequences == len(PROMPTS)
+
+
+def test_stop_string_truncates():
+    model, tokenizer = tiny_model()
+    full = asyncio.run(
+        generate_all(HFGenerationScheduler(model, tokenizer, max_new_tokens=20))
+    )[0]
+    stop = full[3:5]
+    scheduler = HFGenerationScheduler(model, tokenizer, max_new_tokens=20, stop=stop)
+    out = asyncio.run(generate_all(scheduler, PROMPTS[:1]))[0]
+    assert out == full[: full.find(stop) + len(stop)]
+
+
+def test_stream_matches_generate():
+    model, tokenizer = tiny_model()
+    scheduler = HFGenerationScheduler(model, tokenizer, 4, 0.05, max_new_tokens=20)
+
+    async def collect(prompt):
+        return [piece async for piece in scheduler.stream(prompt)]
+
+    async def run():
+        try:
+            full = await asyncio.gather(*[scheduler.generate(p) for p in PROMPTS[:4]])
+            streamed = await asyncio.gather(*[collect(p) for p in PROMPTS[:4]])
+            return full, streamed
+        finally:
+            scheduler.close()
+
+    full, streamed = asyncio.run(run())
+    assert ["".join(pieces) for pieces in streamed] == full
+    assert all(len(pieces) > 1 for pieces in streamed)
+
+
+def test_prefix_cache_matches_full_prefill():
+    model, tokenizer = tiny_model()
+    system = "---Role---\nYou answer questions about the documents below.\n"
+    prompts = [f"{system}doc {i}: " + f"fact {i} " * (i % 3 + 1) for i in range(6)]
+
+    def run(min_prefix_tokens):
+        scheduler = HFGenerationScheduler(
+            model, tokenizer, 1, 0, 20, min_prefix_tokens=min_prefix_tokens
+        )
+        return asyncio.run(generate_all(scheduler, prompts)), scheduler
+
+    uncached, _ = run(0)
+    cached, scheduler = run(32)
+    assert cached == uncached
+    assert scheduler.prefix_builds == 1
+    assert scheduler.prefix_tokens_reused >= 32 * (len(prompts) - 1)
+
+
+def test_evicted_scheduler_is_closed(monkeypatch):
+    model, tokenizer = tiny_model()
+    monkeypatch.setattr(llm, "initialize_hf_model", lambda *args: (model, tokenizer))
+
+    async def run():
+        first = get_hf_scheduler("tiny", max_new_tokens=5)
+        assert get_hf_scheduler("tiny", max_new_tokens=5) is first
+        await first.generate(PROMPTS[0])
+        second = get_hf_scheduler("tiny", max_new_tokens=6)
+        assert list(llm._hf_schedulers.values()) == [second]
+        # the old worker stops instead of being orphaned, and takes no new work
+        with pytest.raises(RuntimeError):
+            await first.generate(PROMPTS[0])
+        assert len(await second.generate(PROMPTS[0])) > 0
+        close_hf_schedulers()
+        assert not llm._hf_schedulers and second._thread is None
+
+    try:
+        asyncio.run(run())
+    finally:
+        close_hf_schedulers()
+    assert not any(t.name == "hf-generate" for t in threading.enumerate())
+
+
+def test_closed_scheduler_releases_its_model(monkeypatch):
+    models = []
+
+    def initialize(*args):
+        model, tokenizer = tiny_model()
+        models.append(weakref.ref(model))
+        return model, tokenizer
+
+    monkeypatch.setattr(llm, "initialize_hf_model", initialize)
+
+    async def run():
+        first = get_hf_scheduler("tiny", max_new_tokens=5)
+        await first.generate(PROMPTS[0])
+        await get_hf_scheduler("tiny", dtype="bfloat16").generate(PROMPTS[0])
+        return first
+
+    try:
+        # a caller may still hold the evicted scheduler, but not its model
+        evicted = asyncio.run(run())
+        time.sleep(0.1)  # the evicted worker drops the model as it exits
+        gc.collect()
+        assert evicted.hf_model is None
+        assert [ref() is None for ref in models] == [True, False]
+    finally:
+        close_hf_schedulers()
+    gc.collect()
+    assert models[1]() is None
+
+
+if __name__ == "__main__":
+    model, tokenizer = tiny_model()
+    for max_batch_size in (1, 8):
+        scheduler = HFGenerationScheduler(
+            model, tokenizer, max_batch_size, max_new_tokens=100
+        )
+        start = time.perf_counter()
+        asyncio.run(generate_all(scheduler))
+        elapsed = time.perf_counter() - start
+        print(
+            f"max_batch_size={max_batch_size}: "
+            f"{len(PROMPTS) * 100 / elapsed:.0f} tokens/s, {scheduler.batches} batches"
+        )
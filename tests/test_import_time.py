@@ -0,0 +1,44 @@
+import json
+import os
+import subprocess
+import sys
+
+# seconds; override with SMOLRAG_IMPORT_BUDGET on slow machines
+IMPORT_BUDGET = float(os.environ.get("SMOLRAG_IMPORT_BUDGET", "1.0"))
+LAZY_MODULES = ["torch", "transformers", "openai", "pandas"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import smolrag
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def measure_import():
+    # a fresh interpreter, so nothing is already imported or cached in memory
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=root,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def test_import_time():
+    result = measure_import()
+    assert result["loaded"] == [], f"imported eagerly: {result['loaded']}"
+    assert (
+        result["elapsed"] < IMPORT_BUDGET
+    ), f"import smolrag took {result['elapsed']:.3f}s, budget {IMPORT_BUDGET}s"
+
+
+if __name__ == "__main__":
+    result = measure_import()
+    print(f"import smolrag: {result['elapsed'] * 1000:.1f} ms")
+    print(f"heavy modules loaded: {result['loaded'] or 'none'}")
+    test_import_time()
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+
+from smolrag.storage import LogKVStorage, SqliteKVStorage
+
+
+def open_log(working_dir, namespace="docs"):
+    return LogKVStorage(
+        namespace=namespace,
+        global_config={"working_dir": working_dir},
+        embedding_func=None,
+    )
+
+
+def test_log_roundtrip_and_reopen(tmp_path):
+    async def run():
+        kv = open_log(str(tmp_path))
+        assert await kv.upsert({"a": {"v": 1}, "b": {"v": 2}}) == {
+            "a": {"v": 1},
+            "b": {"v": 2},
+        }
+        # existing keys are kept, like JsonKVStorage
+        assert await kv.upsert({"a": {"v": 9}, "c": {"v": 3}}) == {"c": {"v": 3}}
+        await kv.index_done_callback()
+        kv = open_log(str(tmp_path))
+        assert await kv.get_by_ids(["a", "b", "c", "x"]) == [
+            {"v": 1},
+            {"v": 2},
+            {"v": 3},
+            None,
+        ]
+        assert await kv.filter_keys(["a", "x"]) == {"x"}
+
+    asyncio.run(run())
+
+
+def test_log_truncates_torn_tail(tmp_path):
+    async def run():
+        kv = open_log(str(tmp_path))
+        await kv.upsert({"a": {"v": 1}, "b": {"v": 2}})
+        await kv.index_done_callback()
+        file_name = kv._file_name
+        size = os.path.getsize(file_name)
+        # a crash in the middle of an append leaves a partial last line
+        with open(file_name, "ab") as f:
+            f.write(b'0badc0de\t"c"\t{"v": ')
+        kv = open_log(str(tmp_path))
+        assert os.path.getsize(file_name) == size
+        assert await kv.all_keys() == ["a", "b"]
+        await kv.upsert({"c": {"v": 3}})
+        await kv.index_done_callback()
+        kv = open_log(str(tmp_path))
+        assert await kv.get_by_id("c") == {"v": 3}
+
+    asyncio.run(run())
+
+
+def test_log_migrates_legacy_json(tmp_path):
+    async def run():
+        with open(tmp_path / "kv_store_docs.json", "w") as f:
+            json.dump({"a": {"v": 1}, "b": {"v": 2}}, f)
+        kv = open_log(str(tmp_path))
+        assert await kv.get_by_id("a") == {"v": 1}
+        # durable without a commit, and not migrated twice
+        kv = open_log(str(tmp_path))
+        assert sorted(await kv.all_keys()) == ["a", "b"]
+        assert len(kv._index) == 2
+
+    asyncio.run(run())
+
+
+def test_sqlite_projection_and_filter_keys(tmp_path):
+    async def run():
+        kv = SqliteKVStorage(
+            namespace="chunks",
+            global_config={"working_dir": str(tmp_path)},
+            embedding_func=None,
+        )
+        await kv.upsert(
+            {
+                "a": {"content": "alpha", "tokens": 3, "a.b": [1, 2], "none": None},
+                "b": {"content": "beta", "tokens": 5},
+            }
+        )
+        assert await kv.get_by_ids(["b", "x", "a", "b"], fields={"tokens"}) == [
+            {"tokens": 5},
+            None,
+            {"tokens": 3},
+            {"tokens": 5},
+        ]
+        # missing fields are left out; dotted names and nulls round-trip
+        assert await kv.get_by_ids(["a", "b"], fields={"a.b", "none"}) == [
+            {"a.b": [1, 2], "none": None},
+            {},
+        ]
+        assert await kv.get_by_id("b") == {"content": "beta", "tokens": 5}
+        assert await kv.filter_keys(["a", "x", "y", "b"]) == {"x", "y"}
+        assert await kv.filter_keys([]) == set()
+        assert await kv.upsert({"a": {"content": "new"}, "c": {}}) == {"c": {}}
+        assert sorted(await kv.all_keys()) == ["a", "b", "c"]
+
+    asyncio.run(run())
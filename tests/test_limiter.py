@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from smolrag.utils import AsyncLimiter, FifoSemaphore
+
+
+def test_semaphore_is_fifo():
+    async def run():
+        semaphore = FifoSemaphore(1)
+        order = []
+
+        async def worker(i):
+            await semaphore.acquire()
+            order.append(i)
+            await asyncio.sleep(0)
+            semaphore.release()
+
+        await asyncio.gather(*[worker(i) for i in range(5)])
+        assert order == list(range(5))
+        assert semaphore._value == 1
+
+    asyncio.run(run())
+
+
+def test_semaphore_cancelled_waiter_already_popped():
+    async def run():
+        semaphore = FifoSemaphore(1)
+        await semaphore.acquire()
+        first = asyncio.create_task(semaphore.acquire())
+        second = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        first.cancel()
+        # release() pops the cancelled future before its waiter wakes up
+        semaphore.release()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await second
+        assert not semaphore._waiters and semaphore._value == 0
+        semaphore.release()
+        assert semaphore._value == 1
+
+    asyncio.run(run())
+
+
+def test_semaphore_cancelled_after_handover_passes_slot_on():
+    async def run():
+        semaphore = FifoSemaphore(1)
+        await semaphore.acquire()
+        first = asyncio.create_task(semaphore.acquire())
+        second = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        semaphore.release()  # hands the slot to first
+        first.cancel()  # ...which is cancelled before it runs
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(second, 1)
+
+    asyncio.run(run())
+
+
+def test_limiter_releases_slot_on_error_and_cancel():
+    async def run():
+        limiter = AsyncLimiter(1)
+        gate = asyncio.Event()
+
+        @limiter
+        async def call(mode):
+            if mode == "raise":
+                raise ValueError(mode)
+            if mode == "block":
+                await gate.wait()
+            return mode
+
+        with pytest.raises(ValueError):
+            await call("raise")
+        blocked = asyncio.create_task(call("block"))
+        queued = asyncio.create_task(call("queued"))
+        await asyncio.sleep(0.01)
+        assert limiter.stats()["in_flight"] == 1
+        assert limiter.stats()["queued"] == 1
+        blocked.cancel()
+        assert await asyncio.wait_for(queued, 1) == "queued"
+        stats = limiter.stats()
+        assert stats["in_flight"] == 0 and stats["queued"] == 0
+        assert stats["calls"] == 3 and stats["failures"] == 2
+        assert limiter._semaphore._value == 1
+
+    asyncio.run(run())
+
+
+def test_limiter_holds_slot_while_streaming():
+    async def run():
+        limiter = AsyncLimiter(1)
+
+        @limiter
+        async def call(n):
+            async def pieces():
+                for i in range(n):
+                    yield str(i)
+
+            return pieces()
+
+        stream = await call(3)
+        queued = asyncio.create_task(call(1))
+        await asyncio.sleep(0.01)
+        assert not queued.done() and limiter.stats()["in_flight"] == 1
+        assert [piece async for piece in stream] == ["0", "1", "2"]
+        second = await asyncio.wait_for(queued, 1)
+        # closing a stream early, even before reading it, frees the slot too
+        await second.aclose()
+        third = await asyncio.wait_for(call(1), 1)
+        del third
+        await asyncio.wait_for(call(1), 1)
+        assert limiter.stats()["calls"] == 4
+
+    asyncio.run(run())
@@ -0,0 +1,81 @@
+import asyncio
+
+import numpy as np
+
+from smolrag import SmolRAG
+from smolrag.utils import EmbeddingFunc
+
+
+async def embed(texts):
+    return np.ones((len(texts), 8))
+
+
+def make_rag(working_dir, calls, **kwargs):
+    async def complete(prompt, system_prompt=None, history_messages=[], **kwargs):
+        calls.append(kwargs)
+        if kwargs.get("stream"):
+
+            async def pieces():
+                yield "streamed "
+                yield prompt
+
+            return pieces()
+        return f"answer {prompt}"
+
+    return SmolRAG(
+        working_dir=working_dir,
+        llm_model_func=complete,
+        embedding_func=EmbeddingFunc(8, 8192, embed, model_name="ones"),
+        **kwargs,
+    )
+
+
+def test_cache_hits_skip_the_limiter(tmp_path):
+    calls = []
+    rag = make_rag(str(tmp_path), calls)
+
+    async def run():
+        try:
+            first = await rag.llm_model_func("q", system_prompt="s")
+            assert await rag.llm_model_func("q", system_prompt="s") == first
+            await rag.llm_model_func("q", system_prompt="other")
+        finally:
+            await rag.aclose()
+
+    asyncio.run(run())
+    assert len(calls) == 2 and rag.limiter_stats()["llm"]["calls"] == 2
+    assert "hashing_kv" not in calls[0] and "global_config" in calls[0]
+
+
+def test_streamed_answer_is_cached(tmp_path):
+    calls = []
+    rag = make_rag(str(tmp_path), calls)
+
+    async def run():
+        try:
+            pieces = await rag.llm_model_func("q", stream=True)
+            assert [p async for p in pieces] == ["streamed ", "q"]
+            assert await rag.llm_model_func("q") == "streamed q"
+            pieces = await rag.llm_model_func("q", stream=True)
+            assert [p async for p in pieces] == ["streamed q"]
+        finally:
+            await rag.aclose()
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_disabled_cache_still_passes_config(tmp_path):
+    calls = []
+    rag = make_rag(str(tmp_path), calls, enable_llm_cache=False)
+
+    async def run():
+        try:
+            await rag.llm_model_func("q")
+            await rag.llm_model_func("q")
+        finally:
+            await rag.aclose()
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert calls[0]["global_config"]["llm_model_name"] == rag.llm_model_name
@@ -0,0 +1,68 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from smolrag.base import QueryParam
+from smolrag.operate import naive_query, naive_query_stream
+from smolrag.storage import JsonKVStorage, NanoVectorDBStorage
+from smolrag.utils import EmbeddingFunc
+
+ANSWER = "The user model stores the username. See UserModel.cs for the model."
+
+
+async def embed(texts):
+    return np.ones((len(texts), 2), dtype=np.float32)
+
+
+async def echo_complete(prompt, system_prompt=None, history_messages=[], **kwargs):
+    # echoes the question and ignores stop, like some local models
+    text = f"{prompt}\nmodel\n {ANSWER}  <|COMPLETE|> and more"
+    return await stream_or_text(text, kwargs)
+
+
+async def plain_complete(prompt, system_prompt=None, history_messages=[], **kwargs):
+    return await stream_or_text(f" {ANSWER} ", kwargs)
+
+
+async def stream_or_text(text, kwargs):
+    if not kwargs.get("stream"):
+        return text
+
+    async def pieces():
+        for i in range(0, len(text), 3):
+            yield text[i : i + 3]
+
+    return pieces()
+
+
+@pytest.mark.parametrize("complete", [echo_complete, plain_complete])
+def test_streamed_answer_matches_full_answer(tmp_path, complete):
+    global_config = {
+        "working_dir": str(tmp_path),
+        "embedding_batch_num": 32,
+        "llm_model_func": complete,
+        "llm_stop_sequences": ["<|COMPLETE|>"],
+    }
+
+    async def run():
+        chunks_vdb = NanoVectorDBStorage(
+            namespace="chunks",
+            global_config=global_config,
+            embedding_func=EmbeddingFunc(2, 8192, embed),
+        )
+        text_chunks = JsonKVStorage(
+            namespace="text_chunks", global_config=global_config, embedding_func=None
+        )
+        chunk = {"content": "A comes first", "tokens": 3}
+        await chunks_vdb.upsert({"c": chunk})
+        await text_chunks.upsert({"c": chunk})
+        args = ("what is A?", chunks_vdb, text_chunks, QueryParam(), global_config)
+        full = await naive_query(*args)
+        pieces = [piece async for piece in naive_query_stream(*args)]
+        return full, pieces
+
+    full, pieces = asyncio.run(run())
+    # only a leading echo is removed, the words user and model are kept
+    assert full == ANSWER
+    assert "".join(pieces) == full and len(pieces) > 1
@@ -0,0 +1,82 @@
+import asyncio
+import gc
+import weakref
+
+import pytest
+
+pytest.importorskip("openai")
+
+from smolrag import llm
+from smolrag.llm import close_openai_clients, get_openai_async_client
+
+
+def test_clients_are_shared_per_loop_and_closed():
+    async def run():
+        client = get_openai_async_client("http://a", "key")
+        assert get_openai_async_client("http://a", "key") is client
+        assert get_openai_async_client("http://b", "key") is not client
+        await close_openai_clients()
+        assert client.is_closed()
+        assert get_openai_async_client("http://a", "key") is not client
+        await close_openai_clients()
+        return client
+
+    first = asyncio.run(run())
+    assert asyncio.run(run()) is not first
+
+
+def test_evicted_clients_are_closed(monkeypatch):
+    monkeypatch.setattr(llm, "_max_openai_clients_per_loop", 2)
+
+    async def run():
+        oldest = get_openai_async_client("http://0", "key")
+        get_openai_async_client("http://1", "key")
+        get_openai_async_client("http://2", "key")
+        await asyncio.sleep(0.01)
+        assert oldest.is_closed()
+        assert len(llm._openai_clients[asyncio.get_running_loop()]) == 2
+        await close_openai_clients()
+
+    asyncio.run(run())
+
+
+def test_clients_go_away_with_their_loop():
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.call_soon(lambda: get_openai_async_client("http://a", "key"))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert loop in llm._openai_clients
+    loop.close()
+    loop_ref = weakref.ref(loop)
+    del loop
+    gc.collect()
+    # the registry does not keep a closed loop (and its clients) alive
+    assert loop_ref() is None
+
+
+def test_instance_close_keeps_shared_clients(tmp_path):
+    import numpy as np
+
+    from smolrag import SmolRAG
+    from smolrag.utils import EmbeddingFunc
+
+    async def embed(texts):
+        return np.ones((len(texts), 8))
+
+    async def run():
+        rags = [
+            SmolRAG(
+                working_dir=str(tmp_path), embedding_func=EmbeddingFunc(8, 8192, embed)
+            )
+            for _ in range(2)
+        ]
+        client = get_openai_async_client("http://a", "key")
+        # the other instance may be in the middle of a request with it
+        await rags[0].aclose()
+        assert not client.is_closed()
+        assert get_openai_async_client("http://a", "key") is client
+        await rags[1].aclose()
+        await close_openai_clients()
+        assert client.is_closed()
+
+    asyncio.run(run())
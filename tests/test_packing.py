@@ -0,0 +1,85 @@
+import itertools
+import random
+
+from smolrag.operate import (
+    _knapsack,
+    _merge_overlapping_chunks,
+    pack_chunks_by_token_size,
+)
+
+DOC = "".join(chr(ord("a") + i % 26) for i in range(100))
+
+
+def chunk(index, start, end, doc_id="d1"):
+    # one token per character, so merged token counts are exact
+    return {
+        "content": DOC[start:end],
+        "tokens": end - start,
+        "full_doc_id": doc_id,
+        "chunk_order_index": index,
+        "start": start,
+        "end": end,
+    }
+
+
+def test_merge_joins_overlapping_neighbours():
+    chunks = [
+        chunk(1, 20, 50),
+        chunk(0, 0, 30),
+        chunk(5, 80, 100),
+        chunk(2, 40, 70),
+        chunk(1, 20, 50, doc_id="d2"),
+    ]
+    units = _merge_overlapping_chunks(chunks, [0.5, 0.4, 0.3, 0.2, 0.1])
+    merged = [u for u in units if u["full_doc_id"] == "d1" and u["start"] == 0]
+    assert len(units) == 3 and len(merged) == 1
+    unit = merged[0]
+    assert unit["content"] == DOC[0:70] and unit["tokens"] == 70
+    assert unit["end"] == 70 and unit["chunk_order_index"] == 2
+    assert abs(unit["score"] - 1.1) < 1e-9 and unit["rank"] == 0
+    # a gap in chunk order or another document is never merged
+    assert sorted((u["full_doc_id"], u["start"]) for u in units) == [
+        ("d1", 0),
+        ("d1", 80),
+        ("d2", 20),
+    ]
+
+
+def test_knapsack_is_optimal():
+    rng = random.Random(0)
+    for _ in range(300):
+        n = rng.randint(1, 9)
+        weights = [rng.randint(1, 600) for _ in range(n)]
+        values = [rng.random() for _ in range(n)]
+        capacity = rng.randint(50, 1024)
+        chosen = _knapsack(weights, values, capacity)
+        assert chosen == sorted(set(chosen))
+        assert sum(weights[i] for i in chosen) <= capacity
+        best = max(
+            sum(values[i] for i in subset)
+            for size in range(n + 1)
+            for subset in itertools.combinations(range(n), size)
+            if sum(weights[i] for i in subset) <= capacity
+        )
+        assert abs(sum(values[i] for i in chosen) - best) < 1e-9
+
+
+def test_knapsack_never_overfills_large_budgets():
+    rng = random.Random(1)
+    for _ in range(50):
+        weights = [rng.randint(1, 5000) for _ in range(30)]
+        values = [rng.random() for _ in range(30)]
+        capacity = rng.randint(1025, 20000)
+        chosen = _knapsack(weights, values, capacity)
+        assert sum(weights[i] for i in chosen) <= capacity
+
+
+def test_pack_keeps_best_units_in_relevance_order():
+    chunks = [chunk(0, 0, 40), chunk(3, 60, 80), chunk(5, 85, 100)]
+    # everything fits: nothing is dropped
+    units = pack_chunks_by_token_size(chunks, [0.9, 0.5, 0.4], 100)
+    assert [u["start"] for u in units] == [0, 60, 85]
+    # 40 tokens: the two smaller chunks together beat the best one alone
+    units = pack_chunks_by_token_size(chunks, [0.9, 0.5, 0.45], 40)
+    assert [u["start"] for u in units] == [60, 85]
+    assert pack_chunks_by_token_size(chunks, [0.9, 0.5, 0.4], 0) == []
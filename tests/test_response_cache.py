@@ -0,0 +1,88 @@
+import asyncio
+
+import numpy as np
+
+import smolrag.storage
+from smolrag.storage import MemmapVectorDBStorage, SemanticResponseCache
+from smolrag.utils import EmbeddingFunc
+
+QUESTIONS = ["what is a", "what is b", "what is c"]
+
+
+async def embed(texts):
+    # one axis per known question; a trailing "?" barely moves the vector
+    vectors = np.zeros((len(texts), len(QUESTIONS) + 1), dtype=np.float32)
+    for i, text in enumerate(texts):
+        vectors[i, QUESTIONS.index(text.rstrip("?"))] = 1.0
+        vectors[i, -1] = 0.1 * text.endswith("?")
+    return vectors
+
+
+def semantic_cache(working_dir, **kwargs):
+    vdb = MemmapVectorDBStorage(
+        namespace="llm_semantic_cache",
+        global_config={"working_dir": working_dir, "embedding_batch_num": 32},
+        embedding_func=EmbeddingFunc(
+            embedding_dim=len(QUESTIONS) + 1, max_token_size=8192, func=embed
+        ),
+        meta_fields={"fingerprint", "response", "created"},
+    )
+    return SemanticResponseCache(vdb=vdb, **kwargs)
+
+
+def test_lookup_needs_similar_question_and_same_fingerprint(tmp_path):
+    async def run():
+        cache = semantic_cache(str(tmp_path), similarity_threshold=0.9)
+        await cache.put("what is a", "fp", "A")
+        assert await cache.get("what is a?", "fp") == "A"
+        assert await cache.get("what is a", "other") is None
+        assert await cache.get("what is b", "fp") is None
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+    asyncio.run(run())
+
+
+def test_lru_eviction(tmp_path):
+    async def run():
+        cache = semantic_cache(str(tmp_path), max_entries=2)
+        await cache.put("what is a", "fp", "A")
+        await cache.put("what is b", "fp", "B")
+        assert await cache.get("what is a", "fp") == "A"
+        await cache.put("what is c", "fp", "C")
+        assert await cache.get("what is b", "fp") is None
+        assert await cache.get("what is a", "fp") == "A"
+        assert await cache.get("what is c", "fp") == "C"
+        assert cache.stats()["evictions"] == 1
+        assert len(await cache.vdb.all_items()) == 2
+
+        # entries are reloaded from the namespace, oldest first
+        await cache.index_done_callback()
+        reloaded = semantic_cache(str(tmp_path), max_entries=2)
+        await reloaded.put("what is b", "fp", "B")
+        assert await reloaded.get("what is a", "fp") is None
+        assert await reloaded.get("what is c", "fp") == "C"
+
+    asyncio.run(run())
+
+
+def test_ttl_expiry(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(smolrag.storage.time, "time", lambda: now[0])
+
+    async def run():
+        cache = semantic_cache(str(tmp_path), ttl=10)
+        await cache.put("what is a", "fp", "A")
+        now[0] += 5
+        await cache.put("what is b", "fp", "B")
+        now[0] += 6
+        assert await cache.get("what is a", "fp") is None
+        assert await cache.get("what is b", "fp") == "B"
+        # expired entries are deleted on the next insert
+        await cache.put("what is c", "fp", "C")
+        assert sorted(item["response"] for item in await cache.vdb.all_items()) == [
+            "B",
+            "C",
+        ]
+        assert cache.stats() == {"entries": 2, "hits": 1, "misses": 1, "evictions": 1}
+
+    asyncio.run(run())
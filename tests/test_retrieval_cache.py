@@ -0,0 +1,56 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from smolrag.base import QueryParam
+from smolrag.operate import _retrieve
+from smolrag.storage import MemmapVectorDBStorage, NanoVectorDBStorage
+from smolrag.utils import EmbeddingFunc, RetrievalCache
+
+
+def test_entries_expire_with_the_generation():
+    cache = RetrievalCache(max_items=2)
+    cache.put("What  is A?", 5, 0, [{"id": "a", "distance": 0.9, "content": "x"}])
+    assert cache.get("what is a?", 5, 0) == [{"id": "a", "distance": 0.9}]
+    assert cache.get("what is a?", 3, 0) is None
+    assert cache.get("what is a?", 5, 1) is None
+    cache.put("b", 5, 0, [])
+    cache.put("c", 5, 0, [])
+    assert cache.get("what is a?", 5, 0) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+@pytest.mark.parametrize("cls", [NanoVectorDBStorage, MemmapVectorDBStorage])
+def test_writes_invalidate_cached_searches(tmp_path, cls):
+    embedded = []
+
+    async def embed(texts):
+        embedded.extend(texts)
+        return np.array([[1.0, len(t)] for t in texts], dtype=np.float32)
+
+    async def run():
+        vdb = cls(
+            namespace="chunks",
+            global_config={"working_dir": str(tmp_path), "embedding_batch_num": 32},
+            embedding_func=EmbeddingFunc(2, 8192, embed),
+        )
+        await vdb.upsert({"a": {"content": "a"}, "b": {"content": "bb"}})
+        cache = RetrievalCache()
+        param = QueryParam(top_k=1)
+
+        async def search(query):
+            embedded.clear()
+            results = (await _retrieve([query], vdb, param, cache))[0]
+            return [r["id"] for r in results], bool(embedded)
+
+        assert await search("q") == (["a"], True)
+        assert await search(" Q ") == (["a"], False)
+        await vdb.upsert({"c": {"content": "c"}})
+        assert (await search("q"))[1]
+        await vdb.delete(["a"])
+        ids, searched = await search("q")
+        assert searched and "a" not in ids
+        assert await search("q") == (ids, False)
+
+    asyncio.run(run())
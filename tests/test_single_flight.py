@@ -0,0 +1,128 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from smolrag.utils import CachedEmbeddingFunc, SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    calls = []
+
+    async def work(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do("k", work, 21) for _ in range(5)])
+        assert results == [42] * 5 and calls == [21]
+        assert flights.coalesced == 4 and not flights._inflight
+        # a later call runs again
+        assert await flights.do("k", work, 1) == 2 and len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_call():
+    finished = []
+
+    async def work():
+        await asyncio.sleep(0.02)
+        finished.append(True)
+        return "done"
+
+    async def run():
+        flights = SingleFlight()
+        first = asyncio.create_task(flights.do("k", work))
+        second = asyncio.create_task(flights.do("k", work))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await second == "done"
+        # with every caller gone the call still completes and is forgotten
+        lonely = asyncio.create_task(flights.do("j", work))
+        await asyncio.sleep(0.005)
+        lonely.cancel()
+        await asyncio.sleep(0.03)
+        assert finished == [True, True] and not flights._inflight
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_caller():
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(
+            *[flights.do("k", work) for _ in range(3)], return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+        assert not flights._inflight
+
+    asyncio.run(run())
+
+
+def test_embedding_waiter_takes_over_when_owner_is_cancelled(tmp_path):
+    calls = []
+
+    async def embed(texts):
+        calls.append(list(texts))
+        await asyncio.sleep(0.02)
+        return np.array([[len(t), 1.0] for t in texts])
+
+    async def run():
+        cached = CachedEmbeddingFunc(
+            embedding_dim=2,
+            max_token_size=8192,
+            func=embed,
+            model_name="len",
+            cache_dir=str(tmp_path),
+        )
+        owner = asyncio.create_task(cached(["abc", "de"]))
+        await asyncio.sleep(0.005)
+        waiter = asyncio.create_task(cached(["abc"]))
+        await asyncio.sleep(0.005)
+        assert cached.coalesced == 1
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        assert (await waiter)[0].tolist() == [3.0, 1.0]
+        assert calls == [["abc", "de"], ["abc"]]
+        assert not cached._inflight
+
+    asyncio.run(run())
+
+
+def test_uncached_embeddings_are_coalesced(tmp_path):
+    from smolrag import SmolRAG
+    from smolrag.utils import EmbeddingFunc
+
+    calls = []
+
+    async def embed(texts):
+        calls.append(list(texts))
+        await asyncio.sleep(0.01)
+        return np.array([[len(t), 1.0] for t in texts])
+
+    # no model_name: the embedding cache is off
+    rag = SmolRAG(
+        working_dir=str(tmp_path), embedding_func=EmbeddingFunc(2, 8192, embed)
+    )
+
+    async def run():
+        results = await asyncio.gather(
+            *[rag.embedding_func(["abc", "de"]) for _ in range(3)],
+            rag.embedding_func(["de"]),
+        )
+        assert [r.tolist() for r in results[:3]] == [[[3.0, 1.0], [2.0, 1.0]]] * 3
+        assert calls == [["abc", "de"], ["de"]]
+        assert rag.embedding_func.embedding_dim == 2
+        await rag.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,189 @@
+import asyncio
+import os
+
+import numpy as np
+
+from smolrag.storage import (
+    IVFVectorDBStorage,
+    MemmapVectorDBStorage,
+    QuantizedVectorDBStorage,
+)
+from smolrag.utils import EmbeddingFunc, normalize_embeddings
+
+DIM = 16
+
+
+def vectors(n, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, DIM)).astype(np.float32)
+
+
+def open_storage(cls, working_dir, data, **kwargs):
+    async def embed(texts):
+        return data[[int(t) for t in texts]]
+
+    return cls(
+        namespace="chunks",
+        global_config={
+            "working_dir": working_dir,
+            "embedding_batch_num": 64,
+            "vector_db_storage_cls_kwargs": kwargs,
+        },
+        embedding_func=EmbeddingFunc(
+            embedding_dim=DIM, max_token_size=8192, func=embed
+        ),
+    )
+
+
+def test_memmap_reuses_deleted_rows(tmp_path):
+    data = vectors(20)
+
+    async def run():
+        storage = open_storage(MemmapVectorDBStorage, str(tmp_path), data)
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(10)})
+        await storage.delete([f"v-{i}" for i in range(0, 10, 2)])
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(10, 15)})
+        assert len(storage._ids) == 10
+        await storage.index_done_callback()
+        assert os.path.getsize(storage._vector_file) == 10 * DIM * 4
+
+        storage = open_storage(MemmapVectorDBStorage, str(tmp_path), data)
+        for i in [1, 3, 10, 14]:
+            assert (await storage.query(str(i), top_k=1))[0]["id"] == f"v-{i}"
+        assert (await storage.query("0", top_k=1))[0]["id"] != "v-0"
+
+    asyncio.run(run())
+
+
+def test_memmap_compacts_sidecar_and_tail(tmp_path):
+    data = vectors(2000)
+
+    async def run():
+        storage = open_storage(MemmapVectorDBStorage, str(tmp_path), data)
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(2000)})
+        await storage.delete([f"v-{i}" for i in range(100, 2000)])
+        await storage.index_done_callback()
+        assert len(storage._ids) == 100 and storage._meta_lines == 100
+        assert os.path.getsize(storage._vector_file) == 100 * DIM * 4
+        with open(storage._meta_file) as f:
+            assert len(f.readlines()) == 100
+
+        storage = open_storage(MemmapVectorDBStorage, str(tmp_path), data)
+        assert sorted(r["id"] for r in await storage.all_items()) == sorted(
+            f"v-{i}" for i in range(100)
+        )
+        assert (await storage.query("42", top_k=1))[0]["id"] == "v-42"
+
+    asyncio.run(run())
+
+
+def test_ivf_trains_appends_deletes_and_reopens(tmp_path):
+    data = vectors(1200)
+    ivf = dict(min_train_size=500, n_lists=16, n_probe=2)
+
+    async def self_recall(storage, ids):
+        found = [(await storage.query(str(i), top_k=1))[0]["id"] for i in ids]
+        return np.mean([f == f"v-{i}" for f, i in zip(found, ids)])
+
+    async def run():
+        storage = open_storage(IVFVectorDBStorage, str(tmp_path), data, **ivf)
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(1000)})
+        await storage.index_done_callback()
+        assert storage._train_task is not None and storage._centroids is None
+        # the worker thread trains on a snapshot; these rows arrive meanwhile
+        await asyncio.sleep(0)
+        assert storage._written_while_training is not None
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(1000, 1200)})
+        await storage._train_task
+        assert len(storage._centroids) == 16
+        assert sum(len(rows) for rows in storage._lists) == 1200
+        assert await self_recall(storage, range(0, 1000, 7)) == 1
+        assert await self_recall(storage, range(1000, 1200)) == 1
+
+        await storage.delete([f"v-{i}" for i in range(0, 100)])
+        assert sum(len(rows) for rows in storage._lists) == 1100
+        found = {r["id"] for r in await storage.query("5", top_k=20)}
+        assert not found & {f"v-{i}" for i in range(100)}
+        await storage.index_done_callback()
+
+        storage = open_storage(IVFVectorDBStorage, str(tmp_path), data, **ivf)
+        assert storage._centroids is not None
+        assert sum(len(rows) for rows in storage._lists) == 1100
+        assert await self_recall(storage, range(100, 1200, 5)) == 1
+
+    asyncio.run(run())
+
+
+def recall(storage, exact, queries, top_k=5):
+    found = [{r["id"] for r in storage._search(q, top_k)} for q in queries]
+    return np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+
+
+def test_quantized_recall_and_rescore(tmp_path):
+    data = vectors(3000)
+    queries = normalize_embeddings(data[:50] + 0.3 * vectors(50, seed=1))
+    items = {f"v-{i}": {"content": str(i)} for i in range(len(data))}
+
+    async def build(name, **kwargs):
+        os.makedirs(tmp_path / name)
+        storage = open_storage(
+            QuantizedVectorDBStorage, str(tmp_path / name), data, **kwargs
+        )
+        await storage.upsert(items)
+        await storage.index_done_callback()
+        if storage._train_task is not None:
+            await storage._train_task
+        return storage
+
+    async def run():
+        exact_storage = open_storage(MemmapVectorDBStorage, str(tmp_path), data)
+        await exact_storage.upsert(items)
+        exact = [{r["id"] for r in exact_storage._search(q, 5)} for q in queries]
+
+        assert recall(await build("f16", quantization="float16"), exact, queries) == 1
+        assert recall(await build("int8", quantization="int8"), exact, queries) >= 0.95
+
+        pq = dict(quantization="pq", pq_subspaces=4, pq_train_size=1000)
+        coarse = await build("pq", **pq)
+        assert coarse._codebook is not None and coarse._float_fh is None
+        rescored = await build("pq_rescore", rescore_candidates=50, **pq)
+        assert recall(rescored, exact, queries) > recall(coarse, exact, queries)
+        assert recall(rescored, exact, queries) >= 0.95
+        # re-scored results carry the exact float32 similarity
+        for q in queries[:5]:
+            top = rescored._search(q, 5)
+            rows = [rescored._rows[r["id"]] for r in top]
+            np.testing.assert_allclose(
+                [r["distance"] for r in top],
+                exact_storage._matrix[rows] @ q,
+                rtol=1e-5,
+            )
+
+    asyncio.run(run())
+
+
+def test_pq_codes_rows_upserted_while_training(tmp_path):
+    data = vectors(2200)
+    pq = dict(quantization="pq", pq_subspaces=8, pq_train_size=2000)
+
+    async def self_recall(storage, ids):
+        found = [{r["id"] for r in await storage.query(str(i), top_k=5)} for i in ids]
+        return np.mean([f"v-{i}" in f for f, i in zip(found, ids)])
+
+    async def run():
+        storage = open_storage(QuantizedVectorDBStorage, str(tmp_path), data, **pq)
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(2000)})
+        await storage.index_done_callback()
+        await asyncio.sleep(0)
+        assert storage._written_while_training is not None
+        await storage.upsert({f"v-{i}": {"content": str(i)} for i in range(2000, 2200)})
+        await storage._train_task
+        assert storage._codebook is not None
+        old = await self_recall(storage, range(0, 2000, 10))
+        assert old >= 0.9
+        assert await self_recall(storage, range(2000, 2200)) >= old - 0.05
+        await storage.index_done_callback()
+
+        storage = open_storage(QuantizedVectorDBStorage, str(tmp_path), data, **pq)
+        assert await self_recall(storage, range(2000, 2200)) >= old - 0.05
+
+    asyncio.run(run())